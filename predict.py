@@ -1,12 +1,15 @@
 # Prediction interface for Cog ⚙️
 # https://github.com/replicate/cog/blob/main/docs/python.md
 
+import asyncio
 import json
 import os
 import re
+import shutil
 import subprocess  # Для запуска внешних процессов
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from cog import BasePredictor, Input, Path
 from time import perf_counter
 from contextlib import contextmanager
@@ -21,10 +24,23 @@ def catchtime(tag: str) -> Callable[[], float]:
     print(f'[Timer: {tag}]: {perf_counter() - start:.3f} seconds')
 
 
+LORA_DIR = "/src/models/Lora"
 FLUX_CHECKPOINT_URL = "https://civitai.com/api/download/models/691639?type=Model&format=SafeTensor&size=full&fp=fp32&token=18b51174c4d9ae0451a3dedce1946ce3"
 sys.path.extend(["/src"])
 
 
+def weights_cache_max_bytes(base_dir: str) -> int:
+    """
+    Бюджет кэша LoRA: WEIGHTS_CACHE_MAX_GB, если задан, иначе половина диска, на котором лежит base_dir.
+    """
+    if os.environ.get("WEIGHTS_CACHE_MAX_GB"):
+        return int(float(os.environ["WEIGHTS_CACHE_MAX_GB"]) * 2**30)
+
+    while not os.path.exists(base_dir):
+        base_dir = os.path.dirname(base_dir)
+    return shutil.disk_usage(base_dir).total // 2
+
+
 def download_base_weights(url: str, dest: Path):
     """
     Загружает базовые веса модели.
@@ -42,36 +58,98 @@ def download_base_weights(url: str, dest: Path):
     print("downloading took: ", time.time() - start)  # Выводим время загрузки
 
 
+def save_output_image(image, filename: str, output_format: str, output_quality: int) -> None:
+    """
+    Единственный шаг кодирования результата: PIL-изображение сразу пишется в файл.
+    """
+    if output_format == "webp":
+        image.save(fp=filename, format="WEBP", quality=output_quality)
+    else:
+        image.save(fp=filename, format="PNG")
+
+
+def save_output_images(images, filenames: list[str], output_format: str, output_quality: int, max_workers: int) -> None:
+    """
+    Сохраняет пачку изображений; при max_workers > 1 кодирование PNG/WebP идет в пуле потоков.
+    """
+    if max_workers <= 1 or len(images) <= 1:
+        for image, filename in zip(images, filenames):
+            save_output_image(image, filename, output_format, output_quality)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(images))) as executor:
+        futures = [
+            executor.submit(save_output_image, image, filename, output_format, output_quality)
+            for image, filename in zip(images, filenames)
+        ]
+        for future in futures:
+            future.result()
+
+
 class Predictor(BasePredictor):
-    weights_cache = WeightsDownloadCache()
+    weights_cache = WeightsDownloadCache(base_dir=LORA_DIR, max_bytes=weights_cache_max_bytes(LORA_DIR))
 
-    def _download_loras(self, lora_urls: list[str]):
-        lora_paths = []
+    def _start_lora_downloads(self, lora_urls: list[str]) -> list:
+        """
+        Запускает загрузку всех LoRA параллельно и сразу возвращает управление.
+
+        Возвращает список (url, future, optional, cache_args) в порядке lora_urls; optional=True означает,
+        что ошибку загрузки можно пропустить. Файлы закреплены в кэше, пока не вызван _release_lora_downloads.
+        """
+        downloads = []
 
         for url in lora_urls:
             if re.match(r"^https?://replicate.delivery/[a-zA-Z0-9_-]+/[a-zA-Z0-9_-]+/trained_model.tar", url):
                 print(f"Downloading LoRA weights from - Replicate URL: {url}")
-                lora_path = self.weights_cache.ensure(
-                    url=url,
-                    mv_from="output/flux_train_replicate/lora.safetensors",
-                )
-                print(f"{lora_path=}")
-                lora_paths.append(lora_path)
+                cache_args = dict(mv_from="output/flux_train_replicate/lora.safetensors")
+                optional = False
             elif re.match(r"^https?://civitai.com/api/download/models/[0-9]+\?type=Model&format=SafeTensor", url):
                 # split url to get first part of the url, everythin before '?type'
                 civitai_slug = url.split('?type')[0]
                 print(f"Downloading LoRA weights from - Civitai URL: {civitai_slug}")
-                lora_path = self.weights_cache.ensure(url, file=True)
-                lora_paths.append(lora_path)
+                cache_args = dict(file=True)
+                optional = False
             elif url.endswith('.safetensors'):
                 print(f"Downloading LoRA weights from - safetensor URL: {url}")
-                try:
-                    lora_path = self.weights_cache.ensure(url, file=True)
-                except Exception as e:
-                    print(f"Error downloading LoRA weights: {e}")
-                    continue
-                print(f"{lora_path=}")
-                lora_paths.append(lora_path)
+                cache_args = dict(file=True)
+                optional = True
+            else:
+                downloads.append((url, None, True, None))
+                continue
+
+            future = self.weights_cache.ensure_async(url, pin=True, **cache_args)
+            downloads.append((url, future, optional, cache_args))
+
+        return downloads
+
+    def _release_lora_downloads(self, downloads: list) -> None:
+        """
+        Снимает закрепление LoRA в кэше; вызывать после того, как предсказание их загрузило (или упало).
+        """
+        for url, future, _, cache_args in downloads:
+            if future is not None:
+                self.weights_cache.release(url, **cache_args)
+
+    def _wait_lora_downloads(self, downloads: list) -> list:
+        """
+        Дожидается загрузок; для каждого URL возвращает путь к LoRA или None, если она пропущена.
+        """
+        lora_paths = []
+
+        for url, future, optional, _ in downloads:
+            if future is None:
+                lora_paths.append(None)
+                continue
+            try:
+                lora_path = future.result()
+            except Exception as e:
+                if not optional:
+                    raise
+                print(f"Error downloading LoRA weights: {e}")
+                lora_paths.append(None)
+                continue
+            print(f"{lora_path=}")
+            lora_paths.append(lora_path)
 
         files = [os.path.join(self.weights_cache.base_dir, f) for f in os.listdir(self.weights_cache.base_dir)]
         print(f'Available loras: {files}')
@@ -137,6 +215,11 @@ class Predictor(BasePredictor):
         # Устанавливаем unet тип на 'Automatic (fp16 LoRA)' для Flux, чтобы LoRA работали правильно
         shared.opts.set('forge_unet_storage_dtype', 'Automatic (fp16 LoRA)')
 
+        # torch.compile трансформера Flux (FLUX_COMPILE=1); размеры рядом с бакетами подгоняются под них,
+        # скомпилированные ядра сохраняются в кэше между перезапусками
+        shared.opts.set('flux_compile', os.environ.get('FLUX_COMPILE', '0') == '1')
+        shared.opts.set('flux_compile_buckets', os.environ.get('FLUX_COMPILE_BUCKETS', '768x1280, 1280x768, 1024x1024'))
+
         # Оптимизация памяти для лучшего качества и скорости с Flux
         if self.has_memory_management:
             # Выделяем больше памяти для загрузки весов модели (90% для весов, 10% для вычислений)
@@ -171,6 +254,10 @@ class Predictor(BasePredictor):
 
         from modules.api.api import Api
         from modules.call_queue import queue_lock
+        from modules_forge import main_thread
+
+        # Cog does not hand its main thread to main_thread.loop(), so processing runs on a worker thread
+        main_thread.start_worker()
 
         # Create a custom API class that patches the script handling functions
         class CustomApi(Api):
@@ -230,7 +317,7 @@ class Predictor(BasePredictor):
 
         self.api = CustomApi(app, queue_lock)
 
-    def predict(
+    async def predict(
         self,
         prompt: str = Input(description="Prompt"),
         negative_prompt: str = Input(
@@ -297,6 +384,10 @@ class Predictor(BasePredictor):
         seed: int = Input(
             description="Random seed. Leave blank to randomize the seed", default=-1
         ),
+        residual_cache_threshold: float = Input(
+            description="Пропуск шагов Flux, когда вход почти не меняется (TeaCache). 0 — выключено; 0.25 ≈ 1.5x, 0.4 ≈ 1.8x быстрее",
+            ge=0, le=1, default=0
+        ),
         # image: Path = Input(description="Grayscale input image"),
         enable_hr: bool = Input(
             description="Hires. fix",
@@ -360,91 +451,120 @@ class Predictor(BasePredictor):
             description="Enable ae",
             default=False
         ),
+        output_format: str = Input(
+            description="Формат выходных изображений",
+            choices=["png", "webp"],
+            default="png",
+        ),
+        output_quality: int = Input(
+            description="Качество WebP (для PNG игнорируется)", ge=1, le=100, default=90
+        ),
+        encode_workers: int = Input(
+            description="Сколько потоков кодируют изображения батча", ge=1, le=4, default=4
+        ),
     ) -> list[Path]:
         print("Cache version 105")
         """Run a single prediction on the model"""
-        from modules.extra_networks import ExtraNetworkParams
-        from modules import scripts
-        from modules.api.models import (
-            StableDiffusionTxt2ImgProcessingAPI,
-        )
-        from PIL import Image
-        import uuid
-        import base64
-        from io import BytesIO
-
-        if debug_flux_checkpoint_url:
-            self.setup(force_download_url=debug_flux_checkpoint_url)
-
-        lora_paths = self._download_loras(lora_urls)
-
-        payload = {
-            "prompt": prompt,
-            "negative_prompt": negative_prompt,
-            "width": width,
-            "height": height,
-            "batch_size": num_outputs,
-            "steps": num_inference_steps,
-            "cfg_scale": guidance_scale,
-            "seed": seed,
-            "do_not_save_samples": True,
-            "sampler_name": sampler,  # Используем выбранный пользователем sampler
-            "scheduler": scheduler,  # Устанавливаем scheduler для Flux
-            "enable_hr": enable_hr,
-            "hr_upscaler": hr_upscaler,
-            "hr_second_pass_steps": hr_steps,
-            "denoising_strength": denoising_strength if enable_hr else None,
-            "hr_scale": hr_scale,
-            "distilled_cfg_scale": distilled_guidance_scale,
-            "hr_additional_modules": [],
-        }
-
-        alwayson_scripts = {}
-
-        # Добавляем все скрипты в payload, если они есть
-        if alwayson_scripts:
-            payload["alwayson_scripts"] = alwayson_scripts
-
-        print(f"Финальный пейлоад: {payload=}")
-        print("Available scripts:", [script.title().lower() for script in scripts.scripts_txt2img.scripts])
-
-        req = dict(
-            txt2imgreq=StableDiffusionTxt2ImgProcessingAPI(**payload),
-            extra_network_data={
-                "lora": [
-                    ExtraNetworkParams(
-                        items=[
-                            lora_path.split('/')[-1].split('.safetensors')[0],
-                            str(lora_scale)
-                        ]
-                    )
-                    for lora_path, lora_scale in zip(lora_paths, lora_scales)
+
+        # with concurrent predictions (cog.yaml concurrency), requests that only differ in prompt and seed are batched by
+        # the API; the blocking work runs on a worker thread so the event loop keeps accepting them
+        def run_prediction() -> list[Path]:
+            from modules.extra_networks import ExtraNetworkParams
+            from modules import scripts
+            from modules.api.models import (
+                StableDiffusionTxt2ImgProcessingAPI,
+            )
+            import uuid
+
+            if debug_flux_checkpoint_url:
+                # replaces the checkpoint on disk and rebuilds the API, so no other prediction may run meanwhile
+                with self.api.queue_lock:
+                    self.setup(force_download_url=debug_flux_checkpoint_url)
+
+            payload = {
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "width": width,
+                "height": height,
+                "batch_size": num_outputs,
+                "steps": num_inference_steps,
+                "cfg_scale": guidance_scale,
+                "seed": seed,
+                "do_not_save_samples": True,
+                "sampler_name": sampler,  # Используем выбранный пользователем sampler
+                "scheduler": scheduler,  # Устанавливаем scheduler для Flux
+                "enable_hr": enable_hr,
+                "hr_upscaler": hr_upscaler,
+                "hr_second_pass_steps": hr_steps,
+                "denoising_strength": denoising_strength if enable_hr else None,
+                "hr_scale": hr_scale,
+                "distilled_cfg_scale": distilled_guidance_scale,
+                "residual_cache_threshold": residual_cache_threshold,
+                "hr_additional_modules": [],
+            }
+
+            alwayson_scripts = {}
+
+            # Добавляем все скрипты в payload, если они есть
+            if alwayson_scripts:
+                payload["alwayson_scripts"] = alwayson_scripts
+
+            print(f"Финальный пейлоад: {payload=}")
+            print("Available scripts:", [script.title().lower() for script in scripts.scripts_txt2img.scripts])
+
+            def resolve_extra_network_data():
+                with catchtime(tag="Wait for LoRA downloads"):
+                    lora_paths = self._wait_lora_downloads(lora_downloads)
+
+                extra_network_data = {
+                    "lora": [
+                        ExtraNetworkParams(
+                            items=[
+                                lora_path.split('/')[-1].split('.safetensors')[0],
+                                str(lora_scale)
+                            ]
+                        )
+                        for lora_path, lora_scale in zip(lora_paths, lora_scales)
+                        if lora_path is not None
+                    ]
+                }
+
+                for lora in extra_network_data['lora']:
+                    print(f"LoRA: {lora.items=}")
+
+                return extra_network_data
+
+            req = dict(
+                txt2imgreq=StableDiffusionTxt2ImgProcessingAPI(**payload),
+                extra_network_data=resolve_extra_network_data,
+                # resolve_extra_network_data вызывается уже под блокировкой, поэтому для батчинга LoRA задаются ключом
+                extra_network_key=(tuple(lora_urls), tuple(lora_scales)),
+                additional_modules={
+                    "clip_l.safetensors": enable_clip_l,
+                    "t5xxl_fp16.safetensors": enable_t5xxl_fp16,
+                    "ae.safetensors": enable_ae,
+                },
+            )
+
+            # LoRA качаются в фоне, пока загружается модель; ждем их только перед активацией
+            lora_downloads = self._start_lora_downloads(lora_urls)
+            try:
+                with catchtime(tag="Total Prediction Time"):
+                    # Получаем PIL-изображения напрямую, без PNG -> base64 -> PNG
+                    resp = self.api.text2imgapi(**req, result_type="pil")
+            finally:
+                # после text2imgapi LoRA уже загружены в модель, кэш может их вытеснять
+                self._release_lora_downloads(lora_downloads)
+
+            info = json.loads(resp.info)
+
+            with catchtime(tag="Total Encode Time"):
+                filenames = [
+                    "{}-{}.{}".format(info["all_seeds"][i % len(info["all_seeds"])], uuid.uuid1(), output_format)
+                    for i in range(len(resp.images))
                 ]
-            },
-            additional_modules={
-                "clip_l.safetensors": enable_clip_l,
-                "t5xxl_fp16.safetensors": enable_t5xxl_fp16,
-                "ae.safetensors": enable_ae,
-            },
-        )
-
-        for lora in req['extra_network_data']['lora']:
-            print(f"LoRA: {lora.items=}")
-
-        with catchtime(tag="Total Prediction Time"):
-            resp = self.api.text2imgapi(**req)
-
-        info = json.loads(resp.info)
-        outputs = []
-
-        with catchtime(tag="Total Encode Time"):
-            for i, image in enumerate(resp.images):
-                seed = info["all_seeds"][i]
-                gen_bytes = BytesIO(base64.b64decode(image))
-                gen_data = Image.open(gen_bytes)
-                filename = "{}-{}.png".format(seed, uuid.uuid1())
-                gen_data.save(fp=filename, format="PNG")
-                output = Path(filename)
-                outputs.append(output)
-
-        return outputs
+                save_output_images(resp.images, filenames, output_format, output_quality, max_workers=encode_workers)
+
+            return [Path(filename) for filename in filenames]
+
+        return await asyncio.to_thread(run_prediction)
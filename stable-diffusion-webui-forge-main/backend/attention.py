@@ -1,6 +1,9 @@
 import math
+import time
 import torch
 import einops
+import functools
+import threading
 
 from backend.args import args
 from backend import memory_management
@@ -93,7 +96,7 @@ def attention_basic(q, k, v, heads, mask=None, attn_precision=None, skip_reshape
     return out
 
 
-def attention_sub_quad(query, key, value, heads, mask=None, attn_precision=None, skip_reshape=False):
+def attention_sub_quad(query, key, value, heads, mask=None, attn_precision=None, skip_reshape=False, query_chunk_size=None):
     attn_precision = get_attn_precision(attn_precision)
 
     if skip_reshape:
@@ -127,9 +130,8 @@ def attention_sub_quad(query, key, value, heads, mask=None, attn_precision=None,
 
     kv_chunk_size_min = None
     kv_chunk_size = None
-    query_chunk_size = None
 
-    for x in [4096, 2048, 1024, 512, 256]:
+    for x in [4096, 2048, 1024, 512, 256] if query_chunk_size is None else [query_chunk_size]:
         count = mem_free_total / (batch_x_heads * bytes_per_token * x * 4.0)
         if count >= k_tokens:
             kv_chunk_size = k_tokens
@@ -429,26 +431,181 @@ def pytorch_attention_single_head_spatial(q, k, v):
 
 if memory_management.xformers_enabled():
     print("Using xformers cross attention")
-    attention_function = attention_xformers
+    attention_default = attention_xformers
 elif memory_management.pytorch_attention_enabled():
     print("Using pytorch cross attention")
-    attention_function = attention_pytorch
+    attention_default = attention_pytorch
 elif args.attention_split:
     print("Using split optimization for cross attention")
-    attention_function = attention_split
+    attention_default = attention_split
 else:
     print("Using sub quadratic optimization for cross attention")
-    attention_function = attention_sub_quad
+    attention_default = attention_sub_quad
 
 if memory_management.xformers_enabled_vae():
     print("Using xformers attention for VAE")
-    attention_function_single_head_spatial = xformers_attention_single_head_spatial
+    attention_single_head_spatial_default = xformers_attention_single_head_spatial
 elif memory_management.pytorch_attention_enabled():
     print("Using pytorch attention for VAE")
-    attention_function_single_head_spatial = pytorch_attention_single_head_spatial
+    attention_single_head_spatial_default = pytorch_attention_single_head_spatial
 else:
     print("Using split attention for VAE")
-    attention_function_single_head_spatial = normal_attention_single_head_spatial
+    attention_single_head_spatial_default = normal_attention_single_head_spatial
+
+
+def attention_candidates():
+    candidates = {'pytorch': attention_pytorch, 'split': attention_split}
+    if memory_management.xformers_enabled():
+        candidates['xformers'] = attention_xformers
+    for x in [512, 1024, 2048, 4096]:
+        candidates[f'sub_quad:{x}'] = functools.partial(attention_sub_quad, query_chunk_size=x)
+    return candidates
+
+
+def attention_single_head_spatial_candidates():
+    candidates = {'pytorch': pytorch_attention_single_head_spatial, 'split': normal_attention_single_head_spatial}
+    if memory_management.xformers_enabled_vae():
+        candidates['xformers'] = xformers_attention_single_head_spatial
+    return candidates
+
+
+class AttentionAutotuner:
+    """
+    Picks the fastest attention implementation per input shape. The first call of a shape times every candidate on
+    its actual inputs and returns the winner's output; later calls dispatch to the winner directly. Winners are kept
+    in memory and, when configured, in a persistent store keyed by device and torch version. Candidates that fail
+    (e.g. out of memory, or unsupported by xformers) are skipped; if all fail, the fixed default runs.
+    """
+
+    # a first run slower than this is taken as the measurement instead of timing more runs
+    SLOW_RUN = 0.25
+
+    def __init__(self, name, candidates):
+        self.name = name
+        self.candidates = candidates
+        self.implementations = {}
+        self.default = None
+        self.enabled = False
+        self.store = None
+        self.winners = {}
+        self.lock = threading.Lock()
+
+    def configure(self, enabled, default, store):
+        with self.lock:
+            self.implementations = self.candidates() if enabled else {}
+            self.default = default
+            self.store = store
+            self.winners.clear()
+            self.enabled = enabled
+
+    def store_key(self, key):
+        return f'{self.name}:{":".join(map(str, key))}'
+
+    def lookup(self, key):
+        winner = self.winners.get(key)
+        if winner is not None or self.store is None:
+            return winner
+
+        try:
+            winner = self.store.get(self.store_key(key))
+        except Exception as e:
+            print(f'[Attention] Failed to read autotune result: {e}')
+            return None
+
+        if winner is not None:
+            self.winners[key] = winner
+        return winner
+
+    def run(self, key, device, *args, **kwargs):
+        candidates = self.implementations
+        winner = self.lookup(key)
+
+        if winner in candidates:
+            return candidates[winner](*args, **kwargs)
+
+        best, best_time, best_out = None, math.inf, None
+        times = []
+
+        for label, fn in candidates.items():
+            try:
+                elapsed, out = self.measure(device, fn, args, kwargs, best_time)
+            except Exception:
+                memory_management.soft_empty_cache(True)
+                continue
+            times.append(f'{label} {elapsed * 1000:.2f}')
+            if elapsed < best_time:
+                best, best_time, best_out = label, elapsed, out
+            del out
+
+        if best is None:
+            return self.default(*args, **kwargs)
+
+        with self.lock:
+            self.winners[key] = best
+            if self.store is not None:
+                try:
+                    self.store[self.store_key(key)] = best
+                except Exception as e:
+                    print(f'[Attention] Failed to store autotune result: {e}')
+
+        print(f'[Attention] Autotuned {self.name} for {", ".join(map(str, key[:-1]))}: {best} (ms: {", ".join(times)})')
+        return best_out
+
+    def measure(self, device, fn, args, kwargs, limit):
+        synchronize = torch.cuda.synchronize if device.type == 'cuda' else lambda *_: None
+
+        synchronize(device)
+        start = time.perf_counter()
+        out = fn(*args, **kwargs)
+        synchronize(device)
+        elapsed = time.perf_counter() - start
+
+        # the first run includes one-off costs, time a few more unless it is slow anyway or already lost
+        if elapsed < self.SLOW_RUN and elapsed < limit * 3:
+            for _ in range(3):
+                start = time.perf_counter()
+                out = fn(*args, **kwargs)
+                synchronize(device)
+                elapsed = min(elapsed, time.perf_counter() - start)
+
+        return elapsed, out
+
+
+attention_autotuner = AttentionAutotuner('attention', attention_candidates)
+attention_single_head_spatial_autotuner = AttentionAutotuner('vae_attention', attention_single_head_spatial_candidates)
+
+
+# timing candidates while torch.compile traces would bake the benchmark into the graph
+is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', lambda: False)
+
+
+@functools.lru_cache(maxsize=None)
+def device_key(device):
+    return f'{memory_management.get_torch_device_name(device)}, torch {torch.__version__}'
+
+
+def attention_function(q, k, v, heads, mask=None, attn_precision=None, skip_reshape=False):
+    if not attention_autotuner.enabled or is_compiling():
+        return attention_default(q, k, v, heads, mask=mask, attn_precision=attn_precision, skip_reshape=skip_reshape)
+
+    dim_head = q.shape[-1] if skip_reshape else q.shape[-1] // heads
+    key = (q.shape[-2], k.shape[-2], heads, dim_head, q.dtype, mask is not None, device_key(q.device))
+    return attention_autotuner.run(key, q.device, q, k, v, heads, mask=mask, attn_precision=attn_precision, skip_reshape=skip_reshape)
+
+
+def attention_function_single_head_spatial(q, k, v):
+    if not attention_single_head_spatial_autotuner.enabled or is_compiling():
+        return attention_single_head_spatial_default(q, k, v)
+
+    B, C, H, W = q.shape
+    key = (H * W, C, q.dtype, device_key(q.device))
+    return attention_single_head_spatial_autotuner.run(key, q.device, q, k, v)
+
+
+def configure(autotune, store=None):
+    """autotune: whether attention_function and attention_function_single_head_spatial pick implementations per shape."""
+    attention_autotuner.configure(autotune, attention_default, store)
+    attention_single_head_spatial_autotuner.configure(autotune, attention_single_head_spatial_default, store)
 
 
 class AttentionProcessorForge:
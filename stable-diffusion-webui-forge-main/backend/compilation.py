@@ -0,0 +1,121 @@
+# Opt-in torch.compile of the block stacks of a model.
+#
+# Graphs are compiled with dynamic=False, so each one is specialized to a latent size, batch size and text length.
+# Only sizes listed as buckets are compiled, which bounds the number of graphs; requests close to a bucket are snapped
+# to it by snap(), other sizes run eagerly. Inductor's FX graph cache is pointed to a directory so that later processes
+# load the compiled kernels from there instead of compiling them again (Dynamo still traces once per process).
+# On CPU, inductor generates C++ kernels, so everything here can be exercised without a GPU; see
+# benchmarks/flux_compile.py.
+
+import os
+import time
+import torch
+
+
+SNAP_TOLERANCE = 0.125
+
+enabled = False
+buckets = []
+cache_dir = None
+
+
+def parse_buckets(text):
+    """'768x1280, 1024x1024' -> [(768, 1280), (1024, 1024)], as width x height in pixels."""
+
+    result = []
+    for item in text.replace(';', ',').split(','):
+        item = item.strip().lower()
+        if not item:
+            continue
+        width, height = item.split('x')
+        result.append((int(width), int(height)))
+    return result
+
+
+def configure(enable, bucket_text, directory):
+    global enabled, buckets, cache_dir
+
+    try:
+        buckets = parse_buckets(bucket_text or '')
+    except ValueError:
+        print(f'[Compile] Invalid resolution buckets: {bucket_text!r}, expected e.g. "768x1280, 1024x1024"')
+        buckets = []
+
+    enabled = bool(enable) and len(buckets) > 0
+    if not enabled:
+        return
+
+    import torch._dynamo
+    import torch._inductor.config
+
+    # one graph per bucket, batch size and text length, beyond the default limit of 8 per function
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 8 * len(buckets))
+
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = directory
+        os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(directory, 'triton'))
+        torch._inductor.config.fx_graph_cache = True
+        cache_dir = directory
+
+
+def snap(width, height):
+    """The nearest bucket if both sides are within SNAP_TOLERANCE of it, otherwise the size unchanged."""
+
+    if not enabled:
+        return width, height
+
+    best = min(buckets, key=lambda b: abs(b[0] - width) + abs(b[1] - height))
+    if abs(best[0] - width) <= best[0] * SNAP_TOLERANCE and abs(best[1] - height) <= best[1] * SNAP_TOLERANCE:
+        return best
+
+    return width, height
+
+
+class CompiledStack:
+    """
+    Calls fn compiled for bucket sizes between begin() and end(), and eagerly otherwise. Runs whose patches change what
+    the stack computes without changing its modules (online LoRA, ControlNet) are begun with allowed=False. A shape
+    that fails to compile runs eagerly from then on.
+    """
+
+    def __init__(self, fn, name):
+        self.fn = fn
+        self.name = name
+        self.compiled = None
+        self.active = False
+        self.compiled_keys = set()
+        self.failed_keys = set()
+
+    def begin(self, allowed=True):
+        self.active = enabled and allowed
+
+    def end(self):
+        self.active = False
+
+    def __call__(self, size, *args):
+        if not self.active or size not in buckets:
+            return self.fn(*args)
+
+        key = tuple((tuple(x.shape), x.dtype, x.device) for x in args if isinstance(x, torch.Tensor))
+        if key in self.failed_keys:
+            return self.fn(*args)
+
+        if self.compiled is None:
+            self.compiled = torch.compile(self.fn, dynamic=False)
+
+        if key in self.compiled_keys:
+            return self.compiled(*args)
+
+        start = time.perf_counter()
+        try:
+            result = self.compiled(*args)
+        except Exception as e:
+            print(f'[Compile] {self.name} failed to compile for {size[0]}x{size[1]}, batch {args[0].shape[0]}, running eagerly: {e}')
+            self.failed_keys.add(key)
+            return self.fn(*args)
+
+        self.compiled_keys.add(key)
+        print(f'[Compile] {self.name} compiled for {size[0]}x{size[1]}, batch {args[0].shape[0]} in {time.perf_counter() - start:.1f} s')
+        return result
+
@@ -0,0 +1,70 @@
+import threading
+
+
+class DequantizedWeightCache:
+    """
+    Keeps the dequantized weights of GGUF / NF4 Linear layers on the compute device for the duration of one sampling
+    run, so every layer is dequantized once per run instead of once per step. Layers are admitted in the order they
+    run during the first step, until the budget set by begin() is used up; end() drops everything.
+    """
+
+    def __init__(self):
+        self.fraction = 0.0
+        self.budget = 0
+        self.used = 0
+        self.active = False
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.fraction > 0
+
+    def begin(self, free_memory):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+            self.budget = int(max(free_memory, 0) * self.fraction)
+            self.active = self.budget > 0
+
+    def end(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+            self.active = False
+
+    def get(self, layer, x):
+        if not self.active:
+            return None
+
+        entry = self.entries.get(id(layer))
+        if entry is None:
+            return None
+
+        source, dtype, device, weight, bias = entry
+        if source is not layer.weight or dtype != x.dtype or device != x.device:
+            return None
+
+        return weight, bias
+
+    def put(self, layer, x, weight, bias):
+        if not self.active or id(layer) in self.entries:
+            return
+
+        size = weight.numel() * weight.element_size()
+        if bias is not None:
+            size += bias.numel() * bias.element_size()
+
+        with self.lock:
+            if self.used + size > self.budget:
+                return
+            self.entries[id(layer)] = (layer.weight, x.dtype, x.device, weight, bias)
+            self.used += size
+
+
+cache = DequantizedWeightCache()
+
+
+def configure(fraction):
+    cache.fraction = fraction
+    cache.end()
@@ -32,6 +32,7 @@ class ForgeDiffusionEngine:
         self.forge_objects_after_applying_lora = None
 
         self.current_lora_hash = str([])
+        self.cond_cache_namespace = None  # identifies the loaded weights for the conditioning cache; None disables it
 
         self.fix_for_webui_backward_compatibility()
 
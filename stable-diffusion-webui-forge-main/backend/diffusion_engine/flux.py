@@ -7,6 +7,7 @@ from backend.patcher.vae import VAE
 from backend.patcher.unet import UnetPatcher
 from backend.text_processing.classic_engine import ClassicTextProcessingEngine
 from backend.text_processing.t5_engine import T5TextProcessingEngine
+from backend.text_processing import cond_cache
 from backend.args import dynamic_args
 from backend.modules.k_prediction import PredictionFlux
 from backend import memory_management
@@ -80,12 +81,19 @@ class Flux(ForgeDiffusionEngine):
     def set_clip_skip(self, clip_skip):
         self.text_processing_engine_l.clip_skip = clip_skip
 
+    def encode_texts(self, texts):
+        memory_management.load_model_gpu(self.forge_objects.clip.patcher)
+        cond_l, pooled_l = self.text_processing_engine_l(texts)
+        cond_t5 = self.text_processing_engine_t5(texts)
+        return dict(crossattn=cond_t5, vector=pooled_l)
+
     @torch.inference_mode()
     def get_learned_conditioning(self, prompt: list[str]):
-        memory_management.load_model_gpu(self.forge_objects.clip.patcher)
-        cond_l, pooled_l = self.text_processing_engine_l(prompt)
-        cond_t5 = self.text_processing_engine_t5(prompt)
-        cond = dict(crossattn=cond_t5, vector=pooled_l)
+        if self.cond_cache_namespace is None:
+            cond = self.encode_texts(prompt)
+        else:
+            key_prefix = (self.cond_cache_namespace, self.current_lora_hash, self.text_processing_engine_l.clip_skip)
+            cond = cond_cache.cached_encode(self.encode_texts, prompt, key_prefix=key_prefix)
 
         if self.use_distilled_cfg_scale:
             distilled_cfg_scale = getattr(prompt, 'distilled_cfg_scale', 3.5) or 3.5
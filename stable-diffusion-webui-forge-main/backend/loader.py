@@ -12,6 +12,7 @@ from transformers import modeling_utils
 from backend import memory_management
 from backend.utils import read_arbitrary_config, load_torch_file, beautiful_print_gguf_state_dict_statics
 from backend.state_dict import try_filter_state_dict, load_state_dict
+from backend.native_checkpoint import find_native_checkpoint, load_native_checkpoint
 from backend.operations import using_forge_operations
 from backend.nn.vae import IntegratedAutoencoderKL
 from backend.nn.clip import IntegratedCLIP
@@ -443,19 +444,20 @@ def preprocess_state_dict(sd):
 
 
 def split_state_dict(sd, additional_state_dicts: list = None):
-    sd = load_torch_file(sd)
+    sd = load_torch_file(sd, use_mmap=True)
     sd = preprocess_state_dict(sd)
     guess = huggingface_guess.guess(sd)
 
     if isinstance(additional_state_dicts, list):
         for asd in additional_state_dicts:
-            asd = load_torch_file(asd)
+            asd = load_torch_file(asd, use_mmap=True)
             sd = replace_state_dict(sd, asd, guess)
             del asd
 
     guess.clip_target = guess.clip_target(sd)
     guess.model_type = guess.model_type(sd)
     guess.ztsnr = 'ztsnr' in sd
+    guess.state_dict_signature = {k: (list(v.shape), str(v.dtype)) for k, v in sd.items()}
 
     sd = guess.process_vae_state_dict(sd)
 
@@ -481,8 +483,13 @@ def split_state_dict(sd, additional_state_dicts: list = None):
 
 @torch.inference_mode()
 def forge_loader(sd, additional_state_dicts=None):
+    native_manifest = find_native_checkpoint(sd, additional_state_dicts=additional_state_dicts)
+
     try:
-        state_dicts, estimated_config = split_state_dict(sd, additional_state_dicts=additional_state_dicts)
+        if native_manifest is not None:
+            state_dicts, estimated_config = load_native_checkpoint(native_manifest)
+        else:
+            state_dicts, estimated_config = split_state_dict(sd, additional_state_dicts=additional_state_dicts)
     except:
         raise ValueError('Failed to recognize model type!')
     
@@ -2,12 +2,13 @@
 
 import sys
 import time
+import weakref
 import psutil
 import torch
 import platform
 
 from enum import Enum
-from backend import stream, utils
+from backend import stream, utils, placement
 from backend.args import args
 
 
@@ -341,15 +342,23 @@ def bake_gguf_model(model):
     if getattr(model, 'gguf_baked', False):
         return
 
+    # Weights kept in CPU memory stay unbaked on the GGUF memmap (baking copies them), unless computing on the CPU;
+    # dequantize_tensor bakes their device copies when they are cast for a forward pass.
+    bake_cpu_weights = get_torch_device().type == 'cpu'
+    all_baked = True
+
     for p in model.parameters():
         gguf_cls = getattr(p, 'gguf_cls', None)
         if gguf_cls is not None:
+            if p.device.type == 'cpu' and not bake_cpu_weights:
+                all_baked = all_baked and p.baked
+                continue
             gguf_cls.bake(p)
 
     global signal_empty_cache
     signal_empty_cache = True
 
-    model.gguf_baked = True
+    model.gguf_baked = all_baked
     return model
 
 
@@ -431,6 +440,18 @@ def build_module_profile(model, model_gpu_memory_when_using_cpu_swap):
 
     cpu_modules = all_modules
 
+    # with a stored profile of this model at this shape, keep the weights that the simulated schedule stalls on
+    plan = placement.stored_plan(model, model_gpu_memory_when_using_cpu_swap - mem_counter, stream.prefetch_layers)
+
+    if plan is not None:
+        names = {m: name for name, m in model.named_modules()}
+        for m in gpu_modules_only_extras.copy():
+            if names.get(m) in plan and mem_counter + m.weight_mem < model_gpu_memory_when_using_cpu_swap:
+                gpu_modules.append(m)
+                gpu_modules_only_extras.remove(m)
+                mem_counter += m.weight_mem
+        return gpu_modules, gpu_modules_only_extras, cpu_modules
+
     for m in sorted(gpu_modules_only_extras, key=lambda x: x.weight_mem).copy():
         if mem_counter + m.weight_mem < model_gpu_memory_when_using_cpu_swap:
             gpu_modules.append(m)
@@ -447,6 +468,7 @@ class LoadedModel:
         self.device = model.load_device
         self.inclusive_memory = 0
         self.exclusive_memory = 0
+        self.partially_unloaded = False
 
     def compute_inclusive_exclusive_memory(self):
         self.inclusive_memory = module_size(self.model.model, include_device=self.device)
@@ -522,7 +544,37 @@ class LoadedModel:
 
         return self.real_model
 
+    def partial_unload(self, memory_to_free):
+        # moves the largest layers to the offload device and runs them with CPU swap, like model_load does for models
+        # that never fit; returns the bytes freed
+        pin_memory = PIN_SHARED_MEMORY and is_device_cpu(self.model.offload_device)
+        candidates = [m for m in self.real_model.modules() if hasattr(m, 'parameters_manual_cast') and not hasattr(m, 'prev_parameters_manual_cast')]
+
+        freed = 0
+        for m in sorted(candidates, key=lambda x: module_size(x, include_device=self.device), reverse=True):
+            if freed >= memory_to_free:
+                break
+
+            size = module_size(m, include_device=self.device)
+            if size == 0:
+                continue
+
+            m.prev_parameters_manual_cast = m.parameters_manual_cast
+            m.parameters_manual_cast = True
+            m.to(self.model.offload_device)
+            if pin_memory:
+                m._apply(lambda x: x.pin_memory())
+            freed += size
+
+        if freed > 0:
+            self.model_accelerated = True
+            self.partially_unloaded = True
+
+        return freed
+
     def model_unload(self, avoid_model_moving=False):
+        self.partially_unloaded = False
+
         if self.model_accelerated:
             for m in self.real_model.modules():
                 if hasattr(m, "prev_parameters_manual_cast"):
@@ -559,6 +611,54 @@ def unload_model_clones(model):
         current_loaded_models.pop(i).model_unload(avoid_model_moving=True)
 
 
+class ResidencyStats:
+    def __init__(self):
+        self.last_use = None
+        self.reuse_interval = None  # moving average of load_models_gpu calls between two uses
+        self.seconds_per_byte = None  # measured cost of the last full load, including patching and baking
+
+
+residency_stats = weakref.WeakKeyDictionary()
+residency_clock = 0
+residency_bandwidth = 2 * 1024 * 1024 * 1024  # bytes per second, refined by every measured load
+RESIDENCY_HORIZON = 16  # reuse interval assumed for models that were used only once
+
+
+def get_residency_stats(model):
+    stats = residency_stats.get(model.model)
+    if stats is None:
+        stats = residency_stats[model.model] = ResidencyStats()
+    return stats
+
+
+def record_model_use(model):
+    stats = get_residency_stats(model)
+    if stats.last_use is not None:
+        interval = residency_clock - stats.last_use
+        stats.reuse_interval = interval if stats.reuse_interval is None else 0.5 * stats.reuse_interval + 0.5 * interval
+    stats.last_use = residency_clock
+
+
+def record_model_load(model, loaded_bytes, seconds):
+    global residency_bandwidth
+    if loaded_bytes < 64 * 1024 * 1024 or seconds <= 0:
+        return
+    get_residency_stats(model).seconds_per_byte = seconds / loaded_bytes
+    residency_bandwidth = 0.5 * residency_bandwidth + 0.5 * loaded_bytes / seconds
+
+
+def eviction_cost(loaded_model, resident_memory):
+    """Expected reload seconds caused by evicting this model, per byte freed and per load until it is used again."""
+    stats = get_residency_stats(loaded_model.model)
+    seconds_per_byte = stats.seconds_per_byte or 1 / residency_bandwidth
+
+    idle = 0 if stats.last_use is None else residency_clock - stats.last_use
+    interval = RESIDENCY_HORIZON if stats.reuse_interval is None else stats.reuse_interval
+    expected_wait = max(interval - idle, 0) + 1
+
+    return seconds_per_byte * resident_memory, seconds_per_byte / expected_wait, interval
+
+
 def free_memory(memory_required, device, keep_loaded=[], free_all=False):
     # this check fully unloads any 'abandoned' models
     for i in range(len(current_loaded_models) - 1, -1, -1):
@@ -572,21 +672,38 @@ def free_memory(memory_required, device, keep_loaded=[], free_all=False):
         print(f"[Unload] Trying to free {memory_required / (1024 * 1024):.2f} MB for {device} with {len(keep_loaded)} models keep loaded ... ", end="")
 
     offload_everything = ALWAYS_VRAM_OFFLOAD or vram_state == VRAMState.NO_VRAM
+
+    candidates = []
+    for m in current_loaded_models:
+        if m.device == device and m not in keep_loaded:
+            resident_memory = module_size(m.model.model, include_device=device)
+            reload_seconds, cost, interval = eviction_cost(m, resident_memory)
+            candidates.append((cost, m, resident_memory, reload_seconds, interval))
+
+    # the models that are cheapest to bring back, or least likely to be needed soon, go first
+    candidates.sort(key=lambda x: x[0])
+
     unloaded_model = False
-    for i in range(len(current_loaded_models) - 1, -1, -1):
+    for _, shift_model, resident_memory, reload_seconds, interval in candidates:
+        missing = memory_required - get_free_memory(device)
+
         if not offload_everything:
-            free_memory = get_free_memory(device)
-            print(f"Current free memory is {free_memory / (1024 * 1024):.2f} MB ... ", end="")
-            if free_memory > memory_required:
+            print(f"Current free memory is {(memory_required - missing) / (1024 * 1024):.2f} MB ... ", end="")
+            if missing <= 0:
                 break
-        shift_model = current_loaded_models[i]
-        if shift_model.device == device:
-            if shift_model not in keep_loaded:
-                m = current_loaded_models.pop(i)
-                print(f"Unload model {m.model.model.__class__.__name__} ", end="")
-                m.model_unload()
-                del m
+
+        # a model holding much more than what is missing only gives up some layers, unless the layers cannot be swapped
+        if not offload_everything and not free_all and resident_memory > missing * 1.5 and lowvram_available:
+            freed = shift_model.partial_unload(missing * 1.1)
+            if freed >= missing:
+                print(f"Partially unload {shift_model.model.model.__class__.__name__} ({freed / (1024 * 1024):.2f} of {resident_memory / (1024 * 1024):.2f} MB, reload {reload_seconds:.2f} s, reused every {interval:.1f} loads) ", end="")
                 unloaded_model = True
+                continue
+
+        current_loaded_models.remove(shift_model)
+        print(f"Unload model {shift_model.model.model.__class__.__name__} ({resident_memory / (1024 * 1024):.2f} MB, reload {reload_seconds:.2f} s, reused every {interval:.1f} loads) ", end="")
+        shift_model.model_unload()
+        unloaded_model = True
 
     if unloaded_model:
         soft_empty_cache()
@@ -612,20 +729,34 @@ def compute_model_gpu_memory_when_using_cpu_swap(current_free_mem, inference_mem
 
 
 def load_models_gpu(models, memory_required=0, hard_memory_preservation=0):
-    global vram_state
+    global vram_state, residency_clock
 
     execution_start_time = time.perf_counter()
     memory_to_free = max(minimum_inference_memory(), memory_required) + hard_memory_preservation
     memory_for_inference = minimum_inference_memory() + hard_memory_preservation
 
+    residency_clock += 1
+
     models_to_load = []
     models_already_loaded = []
     for x in models:
         loaded_model = LoadedModel(x)
+        record_model_use(x)
 
         if loaded_model in current_loaded_models:
             index = current_loaded_models.index(loaded_model)
-            current_loaded_models.insert(0, current_loaded_models.pop(index))
+            loaded_model = current_loaded_models.pop(index)
+
+            # a model that gave up layers to make room for another one is loaded fully again once there is room
+            if loaded_model.partially_unloaded and loaded_model.device != torch.device("cpu"):
+                offloaded_memory = module_size(x.model, exclude_device=loaded_model.device)
+                if get_free_memory(loaded_model.device) > offloaded_memory * 1.3 + memory_to_free:
+                    print(f"[Memory Management] Reloading the offloaded layers of {x.model.__class__.__name__} ({offloaded_memory / (1024 * 1024):.2f} MB)")
+                    loaded_model.model_unload(avoid_model_moving=True)
+                    models_to_load.append(LoadedModel(x))
+                    continue
+
+            current_loaded_models.insert(0, loaded_model)
             models_already_loaded.append(loaded_model)
         else:
             models_to_load.append(loaded_model)
@@ -681,7 +812,11 @@ def load_models_gpu(models, memory_required=0, hard_memory_preservation=0):
         if vram_set_state == VRAMState.NO_VRAM:
             model_gpu_memory_when_using_cpu_swap = 0
 
+        load_start_time = time.perf_counter()
         loaded_model.model_load(model_gpu_memory_when_using_cpu_swap)
+        if torch_dev.type == 'cuda':
+            torch.cuda.synchronize(torch_dev)
+        record_model_load(model, loaded_model.exclusive_memory, time.perf_counter() - load_start_time)
         current_loaded_models.insert(0, loaded_model)
 
     moving_time = time.perf_counter() - execution_start_time
@@ -1,4 +1,5 @@
 import torch
+import collections
 
 from backend import memory_management, attention
 from backend.modules.k_prediction import k_prediction_from_diffusers_scheduler
@@ -16,6 +17,7 @@ class KModel(torch.nn.Module):
         print(f'K-Model Created: {dict(storage_dtype=self.storage_dtype, computation_dtype=self.computation_dtype)}')
 
         self.diffusion_model = model
+        self.cast_cache = collections.OrderedDict()
 
         if k_predictor is None:
             self.predictor = k_prediction_from_diffusers_scheduler(diffusers_scheduler)
@@ -33,23 +35,38 @@ class KModel(torch.nn.Module):
 
         xc = xc.to(dtype)
         t = self.predictor.timestep(t).float()
-        context = context.to(dtype)
+        context = self.cast_condition(context, dtype)
         extra_conds = {}
         for o in kwargs:
             extra = kwargs[o]
             if hasattr(extra, "dtype"):
                 if extra.dtype != torch.int and extra.dtype != torch.long:
-                    extra = extra.to(dtype)
+                    extra = self.cast_condition(extra, dtype)
             extra_conds[o] = extra
 
         model_output = self.diffusion_model(xc, t, context=context, control=control, transformer_options=transformer_options, **extra_conds).float()
         return self.predictor.calculate_denoised(sigma, model_output, x)
 
+    def cast_condition(self, x, dtype):
+        # conditions are the same tensors on every step of a run; casting each once keeps them recognizable by identity
+        if not isinstance(x, torch.Tensor) or x.dtype == dtype:
+            return x
+
+        entry = self.cast_cache.get(id(x))
+        if entry is not None and entry[0] is x and entry[1].dtype == dtype:
+            return entry[1]
+
+        out = x.to(dtype)
+        self.cast_cache[id(x)] = (x, out)
+        while len(self.cast_cache) > 16:
+            self.cast_cache.popitem(last=False)
+        return out
+
     def memory_required(self, input_shape):
         area = input_shape[0] * input_shape[2] * input_shape[3]
         dtype_size = memory_management.dtype_size(self.computation_dtype)
 
-        if attention.attention_function in [attention.attention_pytorch, attention.attention_xformers]:
+        if attention.attention_default in [attention.attention_pytorch, attention.attention_xformers]:
             scaler = 1.28
         else:
             scaler = 1.65
@@ -0,0 +1,169 @@
+import os
+import json
+import torch
+import huggingface_guess
+import safetensors.torch as sf
+
+from backend import memory_management
+from backend.args import dynamic_args
+from backend.utils import load_torch_file
+
+
+# A native checkpoint is a directory next to the source checkpoint ("flux.safetensors" -> "flux.forge") holding one
+# safetensors file per model component, already in the key layout and storage dtype the Integrated* modules use,
+# plus a manifest. Loading it skips split_state_dict, the key conversions and the dtype casts entirely; the files are
+# memory-mapped and copied straight into the modules.
+
+MANIFEST_NAME = 'manifest.json'
+FORMAT_VERSION = 1
+
+
+def native_checkpoint_dir(filename):
+    return os.path.splitext(filename)[0] + '.forge'
+
+
+def file_stamp(filename):
+    stat = os.stat(filename)
+    return [os.path.basename(filename), stat.st_size, int(stat.st_mtime)]
+
+
+def source_stamps(filename, additional_state_dicts=None):
+    return [file_stamp(x) for x in [filename] + list(additional_state_dicts or [])]
+
+
+def storage_dtype_name():
+    dtype = dynamic_args.get('forge_unet_storage_dtype')
+    return None if dtype is None else str(dtype)
+
+
+def find_native_checkpoint(filename, additional_state_dicts=None):
+    """Returns the manifest of an up-to-date native export of this checkpoint, or None."""
+
+    if not isinstance(filename, str):
+        return None
+
+    directory = native_checkpoint_dir(filename)
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+
+    if not os.path.isfile(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, 'rt', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except Exception as e:
+        print(f'[Native Checkpoint] Ignoring unreadable {manifest_path}: {e}')
+        return None
+
+    if manifest.get('format_version') != FORMAT_VERSION:
+        return None
+
+    if manifest.get('sources') != source_stamps(filename, additional_state_dicts):
+        print(f'[Native Checkpoint] {directory} is outdated, loading {filename} instead')
+        return None
+
+    if manifest.get('unet_storage_dtype') != storage_dtype_name():
+        return None
+
+    manifest['directory'] = directory
+    return manifest
+
+
+def guess_from_signature(signature):
+    # huggingface_guess only looks at key names and shapes, so meta tensors stand in for the real weights
+    sd = {k: torch.empty(shape, dtype=getattr(torch, dtype.split('.')[-1]), device='meta') for k, (shape, dtype) in signature.items()}
+
+    guess = huggingface_guess.guess(sd)
+    guess.clip_target = guess.clip_target(sd)
+    guess.model_type = guess.model_type(sd)
+    guess.ztsnr = 'ztsnr' in sd
+    return guess
+
+
+def load_native_checkpoint(manifest):
+    guess = guess_from_signature(manifest['signature'])
+
+    state_dicts = {}
+    for component_name, component in manifest['components'].items():
+        state_dicts[component_name] = load_torch_file(os.path.join(manifest['directory'], component['file']), use_mmap=True)
+
+    print(f'[Native Checkpoint] Loaded {list(state_dicts.keys())} from {manifest["directory"]}')
+    return state_dicts, guess
+
+
+@torch.inference_mode()
+def export_native_checkpoint(filename, additional_state_dicts=None):
+    """
+    Converts a checkpoint (plus optional separate VAE/text encoder files) once and writes it as a native checkpoint,
+    using the current storage dtype settings. Returns the output directory.
+    """
+
+    from backend.loader import split_state_dict, load_huggingface_component, dir_path
+    from diffusers import DiffusionPipeline
+
+    state_dicts, guess = split_state_dict(filename, additional_state_dicts=additional_state_dicts)
+
+    for component_name, sd in state_dicts.items():
+        if memory_management.state_dict_dtype(sd) in ['gguf', 'nf4', 'fp4']:
+            raise ValueError(f'{component_name} is pre-quantized and is already loaded without conversion, nothing to export.')
+
+    local_path = os.path.join(dir_path, 'huggingface', guess.huggingface_repo)
+    config = DiffusionPipeline.load_config(local_path)
+
+    directory = native_checkpoint_dir(filename)
+    os.makedirs(directory, exist_ok=True)
+
+    if os.path.exists(os.path.join(directory, MANIFEST_NAME)):
+        os.remove(os.path.join(directory, MANIFEST_NAME))
+
+    manifest = dict(
+        format_version=FORMAT_VERSION,
+        sources=source_stamps(filename, additional_state_dicts),
+        unet_storage_dtype=storage_dtype_name(),
+        huggingface_repo=guess.huggingface_repo,
+        signature=guess.state_dict_signature,
+        components={},
+    )
+
+    for component_name, v in config.items():
+        if not (isinstance(v, list) and len(v) == 2) or component_name not in state_dicts:
+            continue
+
+        lib_name, cls_name = v
+        model = load_huggingface_component(guess, component_name, lib_name, cls_name, local_path, state_dicts.pop(component_name))
+
+        if not isinstance(model, torch.nn.Module):
+            continue
+
+        sd = {k: t.detach().to(device='cpu').contiguous() for k, t in model.state_dict().items()}
+        del model
+
+        component_file = f'{component_name}.safetensors'
+        sf.save_file(sd, os.path.join(directory, component_file + '.tmp'))
+        os.replace(os.path.join(directory, component_file + '.tmp'), os.path.join(directory, component_file))
+
+        manifest['components'][component_name] = dict(file=component_file, cls_name=cls_name, dtype=str(memory_management.state_dict_dtype(sd)))
+        print(f'[Native Checkpoint] Exported {component_name} ({manifest["components"][component_name]["dtype"]})')
+        del sd
+
+    # the manifest is written last, so an interrupted export is never picked up by the loader
+    with open(os.path.join(directory, MANIFEST_NAME), 'wt', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+
+    print(f'[Native Checkpoint] Exported {filename} to {directory}')
+    return directory
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export a checkpoint to the Forge native checkpoint format.')
+    parser.add_argument('checkpoint')
+    parser.add_argument('--additional-modules', nargs='*', default=[], help='separate VAE / text encoder files')
+    parser.add_argument('--unet-storage-dtype', default=None, choices=['float8_e4m3fn', 'float8_e5m2', 'bfloat16', 'float16'])
+    export_args = parser.parse_known_args()[0]
+
+    if export_args.unet_storage_dtype is not None:
+        dynamic_args['forge_unet_storage_dtype'] = getattr(torch, export_args.unet_storage_dtype)
+
+    export_native_checkpoint(export_args.checkpoint, additional_state_dicts=export_args.additional_modules)
@@ -5,9 +5,12 @@
 
 import math
 import torch
+import threading
+import collections
 
 from torch import nn
 from einops import rearrange, repeat
+from backend import compilation
 from backend.attention import attention_function
 from backend.utils import fp16_fix, tensor2parameter
 
@@ -89,6 +92,168 @@ class EmbedND(nn.Module):
         return emb.unsqueeze(1)
 
 
+def build_position_ids(bs, h_len, w_len, txt_len, device, dtype):
+    img_ids = torch.zeros((h_len, w_len, 3), device=device, dtype=dtype)
+    img_ids[..., 1] = img_ids[..., 1] + torch.linspace(0, h_len - 1, steps=h_len, device=device, dtype=dtype)[:, None]
+    img_ids[..., 2] = img_ids[..., 2] + torch.linspace(0, w_len - 1, steps=w_len, device=device, dtype=dtype)[None, :]
+    img_ids = repeat(img_ids, "h w c -> b (h w) c", b=bs)
+    txt_ids = torch.zeros((bs, txt_len, 3), device=device, dtype=dtype)
+    return img_ids, txt_ids
+
+
+class PositionEmbeddingCache:
+    """
+    Rotary embeddings only depend on the latent size and the text length, so they are computed once per shape and
+    shared by all steps, the hires pass and later requests. Entries are built for a batch of one (apply_rope broadcasts
+    over the batch) and evicted least recently used first beyond max_bytes.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, pe_embedder, h_len, w_len, txt_len, device, dtype):
+        key = (h_len, w_len, txt_len, device, dtype, pe_embedder.theta, tuple(pe_embedder.axes_dim))
+
+        with self.lock:
+            pe = self.entries.get(key)
+            if pe is not None:
+                self.entries.move_to_end(key)
+                return pe
+
+        img_ids, txt_ids = build_position_ids(1, h_len, w_len, txt_len, device, dtype)
+        pe = pe_embedder(torch.cat((txt_ids, img_ids), dim=1))
+        size = pe.numel() * pe.element_size()
+
+        with self.lock:
+            if key not in self.entries and size <= self.max_bytes:
+                self.entries[key] = pe
+                self.used += size
+                while self.used > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.used -= evicted.numel() * evicted.element_size()
+
+        return pe
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+
+position_embedding_cache = PositionEmbeddingCache()
+
+
+class ConditioningProjectionCache:
+    """
+    Within a sampling run the text context, the pooled vector and the distilled guidance are the same tensors on every
+    step (see CompiledConditions), so their projections are kept, keyed by tensor identity. Weights may change between
+    runs (LoRA), so begin() and end() bound the cache to one run; outside a run everything is computed as usual.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.active = False
+        self.entries = collections.OrderedDict()
+
+    def begin(self):
+        self.entries.clear()
+        self.active = True
+
+    def end(self):
+        self.entries.clear()
+        self.active = False
+
+    def project(self, name, x, fn):
+        if not self.active:
+            return fn(x)
+
+        key = (name, id(x))
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is x:
+            return entry[1]
+
+        out = fn(x)
+        self.entries[key] = (x, out)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return out
+
+
+class ResidualState:
+    def __init__(self, context):
+        self.context = context
+        self.previous = None
+        self.residual = None
+        self.accumulated = 0.0
+        self.skip = False
+
+
+class ResidualCache:
+    """
+    TeaCache-style step skipping. On every call the modulated input of the first double block is compared with the one
+    of the previous call for the same condition; the relative L1 changes, rescaled to estimated output changes, are
+    accumulated, and while they stay below the threshold the blocks are skipped and the residual they added on the last
+    computed call is reused. Calls for other conditions (e.g. the negative prompt) or shapes keep separate states, keyed
+    by the identity of their context tensor. A threshold of 0 disables it; begin() and end() bound it to one run.
+    """
+
+    # fitted by TeaCache for Flux, maps the relative change of the modulated input to that of the model output
+    rescale = [4.98651651e+02, -2.83781631e+02, 5.58554382e+01, -3.82021401e+00, 2.64230861e-01]
+
+    def __init__(self, max_states=8):
+        self.max_states = max_states
+        self.threshold = 0.0
+        self.states = collections.OrderedDict()
+        self.calls = 0
+        self.skipped = 0
+
+    @property
+    def active(self):
+        return self.threshold > 0
+
+    def begin(self, threshold):
+        self.states.clear()
+        self.threshold = float(threshold or 0.0)
+
+    def end(self):
+        self.states.clear()
+        self.threshold = 0.0
+
+    def reset_stats(self):
+        self.calls = 0
+        self.skipped = 0
+
+    def step(self, block, img, vec, context):
+        """Returns the state of this call, whose skip tells if its residual can be reused instead of running the blocks."""
+
+        shift, scale = block.img_mod(vec)[:2]
+        modulated = (1 + scale) * block.img_norm1(img) + shift
+        del shift, scale
+
+        key = (id(context), tuple(img.shape))
+        state = self.states.get(key)
+
+        if state is None or state.context is not context:
+            state = self.states[key] = ResidualState(context)
+            while len(self.states) > self.max_states:
+                self.states.popitem(last=False)
+        else:
+            self.states.move_to_end(key)
+            change = ((modulated - state.previous).abs().mean() / state.previous.abs().mean().clamp(min=1e-6)).item()
+            state.accumulated += sum(c * change ** (len(self.rescale) - 1 - i) for i, c in enumerate(self.rescale))
+            state.skip = state.residual is not None and state.accumulated < self.threshold
+            if not state.skip:
+                state.accumulated = 0.0
+
+        state.previous = modulated
+        self.calls += 1
+        self.skipped += int(state.skip)
+        return state
+
+
 class MLPEmbedder(nn.Module):
     def __init__(self, in_dim, hidden_dim):
         super().__init__()
@@ -369,7 +534,19 @@ class IntegratedFluxTransformer2DModel(nn.Module):
 
         self.final_layer = LastLayer(self.hidden_size, 1, self.out_channels)
 
-    def inner_forward(self, img, img_ids, txt, txt_ids, timesteps, y, guidance=None):
+        self.conditioning_cache = ConditioningProjectionCache()
+        self.residual_cache = ResidualCache()
+        self.compiled_blocks = compilation.CompiledStack(self.run_blocks, 'Flux blocks')
+
+    def run_blocks(self, img, txt, vec, pe):
+        for block in self.double_blocks:
+            img, txt = block(img=img, txt=txt, vec=vec, pe=pe)
+        img = torch.cat((txt, img), 1)
+        for block in self.single_blocks:
+            img = block(img, vec=vec, pe=pe)
+        return img[:, txt.shape[1]:, ...]
+
+    def inner_forward(self, img, img_ids, txt, txt_ids, timesteps, y, guidance=None, pe=None, size=None):
         if img.ndim != 3 or txt.ndim != 3:
             raise ValueError("Input img and txt tensors must have 3 dimensions.")
         img = self.img_in(img)
@@ -377,22 +554,28 @@ class IntegratedFluxTransformer2DModel(nn.Module):
         if self.guidance_embed:
             if guidance is None:
                 raise ValueError("Didn't get guidance strength for guidance distilled model.")
-            vec = vec + self.guidance_in(timestep_embedding(guidance, 256).to(img.dtype))
-        vec = vec + self.vector_in(y)
-        txt = self.txt_in(txt)
+            vec = vec + self.conditioning_cache.project('guidance', guidance, lambda g: self.guidance_in(timestep_embedding(g, 256).to(img.dtype)))
+        vec = vec + self.conditioning_cache.project('vector', y, self.vector_in)
         del y, guidance
-        ids = torch.cat((txt_ids, img_ids), dim=1)
+        residual_state = self.residual_cache.step(self.double_blocks[0], img, vec, txt) if self.residual_cache.active else None
+        if residual_state is not None and residual_state.skip:
+            img = img + residual_state.residual
+            del txt, txt_ids, img_ids, pe
+            img = self.final_layer(img, vec)
+            del vec
+            return img
+        txt = self.conditioning_cache.project('txt', txt, self.txt_in)
+        if pe is None:
+            ids = torch.cat((txt_ids, img_ids), dim=1)
+            pe = self.pe_embedder(ids)
+            del ids
         del txt_ids, img_ids
-        pe = self.pe_embedder(ids)
-        del ids
-        for block in self.double_blocks:
-            img, txt = block(img=img, txt=txt, vec=vec, pe=pe)
-        img = torch.cat((txt, img), 1)
-        for block in self.single_blocks:
-            img = block(img, vec=vec, pe=pe)
-        del pe
-        img = img[:, txt.shape[1]:, ...]
-        del txt
+        img_before_blocks = img if residual_state is not None else None
+        img = self.compiled_blocks(size, img, txt, vec, pe)
+        del pe, txt
+        if residual_state is not None:
+            residual_state.residual = img - img_before_blocks
+            del img_before_blocks
         img = self.final_layer(img, vec)
         del vec
         return img
@@ -409,14 +592,10 @@ class IntegratedFluxTransformer2DModel(nn.Module):
         del x, pad_h, pad_w
         h_len = ((h + (patch_size // 2)) // patch_size)
         w_len = ((w + (patch_size // 2)) // patch_size)
-        img_ids = torch.zeros((h_len, w_len, 3), device=input_device, dtype=input_dtype)
-        img_ids[..., 1] = img_ids[..., 1] + torch.linspace(0, h_len - 1, steps=h_len, device=input_device, dtype=input_dtype)[:, None]
-        img_ids[..., 2] = img_ids[..., 2] + torch.linspace(0, w_len - 1, steps=w_len, device=input_device, dtype=input_dtype)[None, :]
-        img_ids = repeat(img_ids, "h w c -> b (h w) c", b=bs)
-        txt_ids = torch.zeros((bs, context.shape[1], 3), device=input_device, dtype=input_dtype)
+        pe = position_embedding_cache.get(self.pe_embedder, h_len, w_len, context.shape[1], input_device, input_dtype)
         del input_device, input_dtype
-        out = self.inner_forward(img, img_ids, context, txt_ids, timestep, y, guidance)
-        del img, img_ids, txt_ids, timestep, context
+        out = self.inner_forward(img, None, context, None, timestep, y, guidance, pe=pe, size=(w_len * patch_size * 8, h_len * patch_size * 8))
+        del img, pe, timestep, context
         out = rearrange(out, "b (h w) (c ph pw) -> b c (h ph) (w pw)", h=h_len, w=w_len, ph=2, pw=2)[:, :, :h, :w]
         del h_len, w_len, bs
         return out
@@ -3,12 +3,13 @@
 import time
 import torch
 import contextlib
+import collections
 
-from backend import stream, memory_management, utils
+from backend import stream, memory_management, utils, dequant_cache
 from backend.patcher.lora import merge_lora_to_weight
 
 
-stash = {}
+stash = collections.deque()  # (weight, bias, finished_signal) in the order the signals were recorded
 
 
 def get_weight_and_bias(layer, weight_args=None, bias_args=None, weight_fn=None, bias_fn=None):
@@ -72,15 +73,89 @@ def weights_manual_cast(layer, x, skip_weight_dtype=False, skip_bias_dtype=False
         bias_args = dict(device=target_device, dtype=target_dtype, non_blocking=non_blocking)
 
     if stream.should_use_stream():
-        with stream.stream_context()(stream.mover_stream):
-            weight, bias = get_weight_and_bias(layer, weight_args, bias_args, weight_fn=weight_fn, bias_fn=bias_fn)
-            signal = stream.mover_stream.record_event()
+        cast_args = (weight_args, bias_args, weight_fn, bias_fn)
+        position = weight_prefetcher.observe(layer, x, cast_args)
+
+        prefetched = weight_prefetcher.take(layer, cast_args)
+        if prefetched is not None:
+            weight, bias, signal = prefetched
+        else:
+            with stream.stream_context()(stream.mover_stream):
+                weight, bias = get_weight_and_bias(layer, weight_args, bias_args, weight_fn=weight_fn, bias_fn=bias_fn)
+                signal = stream.mover_stream.record_event()
+
+        if position is not None:
+            weight_prefetcher.prefetch_after(position)
     else:
         weight, bias = get_weight_and_bias(layer, weight_args, bias_args, weight_fn=weight_fn, bias_fn=bias_fn)
 
     return weight, bias, signal
 
 
+class WeightPrefetcher:
+    """
+    Learns the order in which swapped (CPU-resident) layers run during one forward pass, then, whenever one of them
+    runs, starts the copies of the next stream.prefetch_layers layers on the mover stream, so transfers overlap with
+    compute instead of being waited for right away. The order is relearned for every sampling run.
+    """
+
+    def __init__(self):
+        self.order = []  # (layer, cast_args)
+        self.positions = {}
+        self.recording = True
+        self.prefetched = {}  # id(layer) -> (source weight, cast_args, weight, bias, signal)
+
+    def reset(self):
+        self.order = []
+        self.positions = {}
+        self.recording = True
+        self.prefetched = {}
+
+    def observe(self, layer, x, cast_args):
+        if stream.prefetch_layers <= 0 or layer.weight is None or layer.weight.device == x.device:
+            return None
+
+        position = self.positions.get(id(layer))
+
+        if self.recording:
+            if position is None:
+                self.positions[id(layer)] = len(self.order)
+                self.order.append((layer, cast_args))
+                return None
+            # the first layer came around again: one full pass is recorded
+            self.recording = False
+
+        return position
+
+    def take(self, layer, cast_args):
+        entry = self.prefetched.pop(id(layer), None)
+        if entry is None:
+            return None
+
+        source, prefetched_cast_args, weight, bias, signal = entry
+        if source is not layer.weight or prefetched_cast_args != cast_args:
+            return None
+
+        return weight, bias, signal
+
+    def prefetch_after(self, position):
+        for i in range(1, min(stream.prefetch_layers, len(self.order) - 1) + 1):
+            layer, cast_args = self.order[(position + i) % len(self.order)]
+
+            if id(layer) in self.prefetched or id(layer) in dequant_cache.cache.entries:
+                continue
+
+            weight_args, bias_args, weight_fn, bias_fn = cast_args
+            with stream.stream_context()(stream.mover_stream):
+                weight, bias = get_weight_and_bias(layer, weight_args, bias_args, weight_fn=weight_fn, bias_fn=bias_fn)
+                signal = stream.mover_stream.record_event()
+
+            self.prefetched[id(layer)] = (layer.weight, cast_args, weight, bias, signal)
+
+
+weight_prefetcher = WeightPrefetcher()
+
+
 @contextlib.contextmanager
 def main_stream_worker(weight, bias, signal):
     if signal is None or not stream.should_use_stream():
@@ -91,19 +166,17 @@ def main_stream_worker(weight, bias, signal):
         stream.current_stream.wait_event(signal)
         yield
         finished_signal = stream.current_stream.record_event()
-        stash[id(finished_signal)] = (weight, bias, finished_signal)
-
-    garbage = []
-    for k, (w, b, s) in stash.items():
-        if s.query():
-            garbage.append(k)
+        stash.append((weight, bias, finished_signal))
 
-    for k in garbage:
-        del stash[k]
+    # signals finish in the order they were recorded on the current stream
+    while len(stash) > 0 and stash[0][2].query():
+        stash.popleft()
     return
 
 
 def cleanup_cache():
+    weight_prefetcher.reset()
+
     if not stream.should_use_stream():
         return
 
@@ -358,9 +431,14 @@ try:
                     # And it only invokes one time, and most linear does not have bias
                     self.bias = utils.tensor2parameter(self.bias.to(x.dtype))
 
-                if hasattr(self, 'forge_online_loras'):
+                cached = dequant_cache.cache.get(self, x)
+                if cached is not None:
+                    return torch.nn.functional.linear(x, *cached)
+
+                if hasattr(self, 'forge_online_loras') or (dequant_cache.cache.active and self.weight.bnb_quantized and x.device.type == 'cuda'):
                     weight, bias, signal = weights_manual_cast(self, x, weight_fn=functional_dequantize_4bit, bias_fn=None, skip_bias_dtype=True)
                     with main_stream_worker(weight, bias, signal):
+                        dequant_cache.cache.put(self, x, weight, bias)
                         return torch.nn.functional.linear(x, weight, bias)
 
                 if not self.parameters_manual_cast:
@@ -427,8 +505,14 @@ class ForgeOperationsGGUF(ForgeOperations):
             if self.weight is not None and self.weight.dtype != x.dtype and getattr(self.weight, 'gguf_cls', None) is None:
                 self.weight = utils.tensor2parameter(self.weight.to(x.dtype))
 
+            cached = dequant_cache.cache.get(self, x)
+            if cached is not None:
+                return torch.nn.functional.linear(x, *cached)
+
             weight, bias, signal = weights_manual_cast(self, x, weight_fn=dequantize_tensor, bias_fn=None, skip_bias_dtype=True)
             with main_stream_worker(weight, bias, signal):
+                if getattr(self.weight, 'gguf_cls', None) is not None:
+                    dequant_cache.cache.put(self, x, weight, bias)
                 return torch.nn.functional.linear(x, weight, bias)
 
 
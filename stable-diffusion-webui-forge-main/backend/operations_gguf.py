@@ -33,7 +33,9 @@ class ParameterGGUF(torch.nn.Parameter):
         return self.real_shape
 
     def __new__(cls, tensor=None, requires_grad=False, no_init=False):
-        return super().__new__(cls, torch.tensor(tensor.data), requires_grad=requires_grad)
+        # no_init callers pass a torch tensor; otherwise wrap the reader's memmap without copying it
+        data = tensor if no_init else torch.from_numpy(tensor.data)
+        return super().__new__(cls, data, requires_grad=requires_grad)
 
     def dequantize_as_pytorch_parameter(self):
         if self.gguf_cls is not None:
@@ -67,4 +69,8 @@ def dequantize_tensor(tensor):
     if gguf_cls is None:
         return tensor
 
+    if not tensor.baked:
+        # weights left on the memmap are baked on the fly, after being moved to the compute device
+        gguf_cls.bake(tensor)
+
     return gguf_cls.dequantize_pytorch(tensor)
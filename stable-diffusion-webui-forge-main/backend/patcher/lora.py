@@ -1,3 +1,4 @@
+import math
 import torch
 
 import packages_3rdparty.webui_lora_collection.lora as lora_utils_webui
@@ -313,6 +314,178 @@ def merge_lora_to_weight(patches, weight, key="online_lora", computation_dtype=t
     return weight
 
 
+def batchable_lora_factors(patch, weight_shape):
+    # Returns (kind, factors, scale) if the patch is a plain LoRA/LoHa/LoKr whose dense diff can be computed
+    # together with same-shape patches of other layers, otherwise None (handled by merge_lora_to_weight alone).
+
+    strength, v, _, offset, function = patch
+
+    if offset is not None or function is not None or isinstance(v, list) or len(v) != 2:
+        return None
+
+    patch_type, v = v
+    numel = math.prod(weight_shape)
+
+    if patch_type == "lora":
+        up, down, alpha, mid, dora_scale = v[:5]
+        if mid is not None or dora_scale is not None:
+            return None
+        up = up.flatten(start_dim=1)
+        down = down.flatten(start_dim=1)
+        if up.shape[0] * down.shape[1] != numel:
+            return None
+        alpha = alpha / down.shape[0] if alpha is not None else 1.0
+        return "lora", (up, down), strength * alpha
+
+    if patch_type == "loha":
+        w1a, w1b, alpha, w2a, w2b, t1, t2, dora_scale = v[:8]
+        if t1 is not None or dora_scale is not None:
+            return None
+        if any(x.ndim != 2 for x in (w1a, w1b, w2a, w2b)) or w1a.shape[0] * w1b.shape[1] != numel:
+            return None
+        alpha = alpha / w1b.shape[0] if alpha is not None else 1.0
+        return "loha", (w1a, w1b, w2a, w2b), strength * alpha
+
+    if patch_type == "lokr":
+        w1, w2, alpha, w1_a, w1_b, w2_a, w2_b, t2, dora_scale = v[:9]
+        if t2 is not None or dora_scale is not None:
+            return None
+        if any(x is not None and x.ndim != 2 for x in (w1, w2, w1_a, w1_b, w2_a, w2_b)):
+            return None
+
+        dim = None
+        w1_shape = w1.shape if w1 is not None else (w1_a.shape[0], w1_b.shape[1])
+        w2_shape = w2.shape if w2 is not None else (w2_a.shape[0], w2_b.shape[1])
+        if w1 is None:
+            dim = w1_b.shape[0]
+        if w2 is None:
+            dim = w2_b.shape[0]
+
+        if w1_shape[0] * w2_shape[0] * w1_shape[1] * w2_shape[1] != numel:
+            return None
+        alpha = alpha / dim if alpha is not None and dim is not None else 1.0
+        return "lokr", (w1, w1_a, w1_b, w2, w2_a, w2_b), strength * alpha
+
+    return None
+
+
+def batched_lora_products(kind, stacked):
+    if kind == "lora":
+        return torch.bmm(stacked[0], stacked[1])
+
+    if kind == "loha":
+        return torch.bmm(stacked[0], stacked[1]) * torch.bmm(stacked[2], stacked[3])
+
+    w1 = stacked[0] if stacked[0] is not None else torch.bmm(stacked[1], stacked[2])
+    w2 = stacked[3] if stacked[3] is not None else torch.bmm(stacked[4], stacked[5])
+    b, i, j = w1.shape
+    _, k, l = w2.shape
+    # batched torch.kron
+    return torch.einsum('bij,bkl->bikjl', w1, w2).reshape(b, i * k, j * l)
+
+
+@torch.inference_mode()
+def compute_batched_lora_diffs(items, computation_dtype=torch.float32):
+    # items is a list of (kind, factors, scale, weight_shape, device).
+    # Factors of the same kind and shapes on the same device are stacked and multiplied with one bmm per group,
+    # e.g. the qkv LoRAs of all Flux double blocks at once. Returns the scaled dense diffs in the order of items.
+
+    groups = {}
+    for index, (kind, factors, _, _, device) in enumerate(items):
+        signature = (kind, device, tuple(None if x is None else tuple(x.shape) for x in factors))
+        groups.setdefault(signature, []).append(index)
+
+    diffs = [None] * len(items)
+
+    for (kind, device, shapes), indices in groups.items():
+        stacked = []
+        for position, shape in enumerate(shapes):
+            if shape is None:
+                stacked.append(None)
+                continue
+            stacked.append(torch.stack([memory_management.cast_to_device(items[i][1][position], device, computation_dtype) for i in indices]))
+
+        products = batched_lora_products(kind, stacked)
+        scales = torch.tensor([items[i][2] for i in indices], device=products.device, dtype=computation_dtype)
+        products *= scales.view(-1, 1, 1)
+
+        for i, product in zip(indices, products):
+            diffs[i] = product.reshape(items[i][3])
+
+    return diffs
+
+
+class BatchedLoraMerger:
+    """
+    Precomputes the dense diffs of LoRA/LoHa/LoKr patches for a window of keys at a time, so same-shape
+    factors of many layers go through a single bmm instead of one torch.mm per layer. The diffs of one window
+    are bounded by max_chunk_bytes, by default a share of the free memory of the device the window is computed on;
+    the rewritten patches are plain "diff" patches for merge_lora_to_weight.
+    """
+
+    def __init__(self, model, all_patches, computation_dtype=torch.float32, max_chunk_bytes=None):
+        self.computation_dtype = computation_dtype
+        self.max_chunk_bytes = max_chunk_bytes
+        self.queue = []
+        self.positions = {}
+        self.prepared = {}
+
+        for (key, online_mode), current_patches in all_patches.items():
+            if online_mode:
+                continue
+            try:
+                weight = utils.get_attr(model, key)
+            except AttributeError:
+                continue  # reported as a wrong key when it is merged
+            self.positions[key] = len(self.queue)
+            self.queue.append((key, current_patches, tuple(weight.shape), weight.device))
+
+    def prepare(self, key, patches):
+        if key not in self.prepared and key in self.positions:
+            self.fill(self.positions[key])
+        return self.prepared.pop(key, patches)
+
+    @staticmethod
+    def free_memory_budget(device):
+        # the diffs of a window are held at once, next to the stacked factors and the weight being merged
+        return max(memory_management.get_free_memory(device) // 4, 64 * 1024 * 1024)
+
+    def fill(self, start):
+        items = []
+        owners = []
+        chunk_bytes = 0
+        element_size = torch.tensor([], dtype=self.computation_dtype).element_size()
+        max_chunk_bytes = self.max_chunk_bytes or self.free_memory_budget(self.queue[start][3])
+
+        for position in range(start, len(self.queue)):
+            key, current_patches, weight_shape, device = self.queue[position]
+
+            if position > start and chunk_bytes >= max_chunk_bytes:
+                break
+
+            self.prepared[key] = current_patches
+
+            for patch_index, patch in enumerate(current_patches):
+                factors = batchable_lora_factors(patch, weight_shape)
+                if factors is None:
+                    continue
+                kind, tensors, scale = factors
+                items.append((kind, tensors, scale, weight_shape, device))
+                owners.append((key, patch_index))
+                chunk_bytes += math.prod(weight_shape) * element_size
+
+        if len(items) == 0:
+            return
+
+        diffs = compute_batched_lora_diffs(items, computation_dtype=self.computation_dtype)
+
+        for (key, patch_index), diff in zip(owners, diffs):
+            patches = list(self.prepared[key])
+            _, _, strength_model, _, _ = patches[patch_index]
+            patches[patch_index] = [1.0, (diff,), strength_model, None, None]
+            self.prepared[key] = patches
+
+
 def get_parameter_devices(model):
     parameter_devices = {}
     for key, p in model.named_parameters():
@@ -330,6 +503,7 @@ def set_parameter_devices(model, parameter_devices):
 
 
 from backend import operations
+from backend.patcher.lora_cache import merged_weight_cache
 
 
 class LoraLoader:
@@ -338,6 +512,23 @@ class LoraLoader:
         self.backup = {}
         self.online_backup = []
         self.loaded_hash = str([])
+        self.cache_namespace = None  # identifies the loaded weights for the merge cache; None disables it
+
+    def get_cached_merge(self, hashes, all_patches):
+        if self.cache_namespace is None or not merged_weight_cache.enabled:
+            return None
+
+        cached = merged_weight_cache.get(self.cache_namespace, hashes)
+
+        if cached is None:
+            return None
+
+        for (key, online_mode) in all_patches:
+            if not online_mode and key not in cached:
+                print(f'[LoRA Merge Cache] Entry is missing {key}, merging again.')
+                return None
+
+        return cached
 
     @torch.inference_mode()
     def refresh(self, lora_patches, offload_device=torch.device('cpu'), force_refresh=False):
@@ -380,6 +571,16 @@ class LoraLoader:
 
         # Patch
 
+        cached = self.get_cached_merge(hashes, all_patches)
+        merged = {}
+        collect_merged = False
+
+        if cached is not None:
+            print(f'[LoRA Merge Cache] Reusing merged weights for {len(cached)} keys.')
+        else:
+            batched_merger = BatchedLoraMerger(self.model, all_patches, computation_dtype=torch.float32)
+            collect_merged = self.cache_namespace is not None and merged_weight_cache.enabled and merged_weight_cache.accepts(self.merged_size(all_patches))
+
         for (key, online_mode), current_patches in all_patches.items():
             try:
                 parent_layer, child_key, weight = utils.get_attr_with_parent(self.model, key)
@@ -398,6 +599,10 @@ class LoraLoader:
             if key not in self.backup:
                 self.backup[key] = weight.to(device=offload_device)
 
+            if cached is not None:
+                self.apply_merged(key, parent_layer, weight, cached[key])
+                continue
+
             bnb_layer = None
 
             if hasattr(weight, 'bnb_quantized') and operations.bnb_avaliable:
@@ -414,25 +619,50 @@ class LoraLoader:
                 weight = dequantize_tensor(weight)
 
             try:
-                weight = merge_lora_to_weight(current_patches, weight, key, computation_dtype=torch.float32)
+                weight = merge_lora_to_weight(batched_merger.prepare(key, current_patches), weight, key, computation_dtype=torch.float32)
             except:
+                # the retry merges this key unbatched; later windows are sized from the memory freed by offloading
                 print('Patching LoRA weights out of memory. Retrying by offloading models.')
+                batched_merger.prepared.pop(key, None)
                 set_parameter_devices(self.model, parameter_devices={k: offload_device for k in parameter_devices.keys()})
                 memory_management.soft_empty_cache()
                 weight = merge_lora_to_weight(current_patches, weight, key, computation_dtype=torch.float32)
 
             if bnb_layer is not None:
                 bnb_layer.reload_weight(weight)
-                continue
-
-            if gguf_cls is not None:
+            elif gguf_cls is not None:
                 gguf_cls.quantize_pytorch(weight, gguf_parameter)
-                continue
+            else:
+                utils.set_attr_raw(self.model, key, torch.nn.Parameter(weight, requires_grad=False))
 
-            utils.set_attr_raw(self.model, key, torch.nn.Parameter(weight, requires_grad=False))
+            if collect_merged:
+                merged_value = gguf_parameter.data if gguf_parameter is not None else weight
+                merged[key] = merged_value.detach().to(device='cpu', copy=True)
+
+        if merged:
+            merged_weight_cache.put(self.cache_namespace, hashes, merged)
 
         # End
 
         set_parameter_devices(self.model, parameter_devices=parameter_devices)
         self.loaded_hash = hashes
         return
+
+    def merged_size(self, all_patches):
+        # the merged values keep the size of the parameters they replace
+        parameters = dict(self.model.named_parameters())
+        return sum(parameters[key].numel() * parameters[key].element_size() for key, online_mode in all_patches if not online_mode and key in parameters)
+
+    def apply_merged(self, key, parent_layer, weight, value):
+        # bnb layers cache the merged float weight, so only the requantization is repeated
+        if hasattr(weight, 'bnb_quantized') and operations.bnb_avaliable:
+            parent_layer.reload_weight(value.to(device=weight.device, non_blocking=True))
+            return
+
+        if getattr(weight, 'gguf_cls', None) is not None:
+            merged_weight = weight.copy_with_data(value.to(device=weight.device, non_blocking=True))
+            merged_weight.baked = True  # cached values come from quantize_pytorch, while weight may still be unbaked on the memmap
+            utils.set_attr_raw(self.model, key, merged_weight)
+            return
+
+        utils.set_attr_raw(self.model, key, torch.nn.Parameter(value.to(device=weight.device, dtype=weight.dtype, non_blocking=True), requires_grad=False))
@@ -0,0 +1,153 @@
+import os
+import hashlib
+import threading
+import torch
+import safetensors.torch as sf
+
+from collections import OrderedDict
+
+
+class MergedWeightCache:
+    """
+    LRU of LoRA merge results: for every (model namespace, LoRA combination) it keeps the final value of each
+    merged parameter, so switching back to a recently used LoRA stack is a bulk copy instead of a full re-merge.
+
+    Entries are held in CPU memory (optionally pinned) under max_bytes. If disk_dir is set, every new entry is
+    also written there as a safetensors file; files are evicted least recently used first under max_disk_bytes.
+    """
+
+    def __init__(self, max_bytes=0, pin_memory=False, disk_dir=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.pin_memory = pin_memory
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or (self.disk_dir is not None and self.max_disk_bytes > 0)
+
+    def accepts(self, size):
+        """Whether an entry of this many bytes would be kept in memory or on disk; checked before collecting one."""
+        return size <= self.max_bytes or (self.disk_dir is not None and 0 < size <= self.max_disk_bytes)
+
+    @staticmethod
+    def entry_size(tensors):
+        return sum(v.numel() * v.element_size() for v in tensors.values())
+
+    @staticmethod
+    def entry_name(namespace, combination):
+        return hashlib.sha256(f'{namespace}|{combination}'.encode('utf-8')).hexdigest()
+
+    def disk_path(self, name):
+        return os.path.join(self.disk_dir, f'{name}.safetensors')
+
+    def get(self, namespace, combination):
+        name = self.entry_name(namespace, combination)
+
+        with self.lock:
+            tensors = self.entries.get(name)
+            if tensors is not None:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return tensors
+
+        if self.disk_dir is not None and self.max_disk_bytes > 0:
+            path = self.disk_path(name)
+            if os.path.isfile(path):
+                try:
+                    tensors = sf.load_file(path)
+                    os.utime(path)
+                except Exception as e:
+                    print(f'[LoRA Merge Cache] Failed to read {path}: {e}')
+                    tensors = None
+
+                if tensors is not None:
+                    self.hits += 1
+                    self.put_memory(name, tensors)
+                    return tensors
+
+        self.misses += 1
+        return None
+
+    def put(self, namespace, combination, tensors):
+        name = self.entry_name(namespace, combination)
+        tensors = {k: v.detach().to(device='cpu') for k, v in tensors.items()}
+
+        if self.pin_memory and torch.cuda.is_available():
+            tensors = {k: v.pin_memory() for k, v in tensors.items()}
+
+        self.put_memory(name, tensors)
+
+        if self.disk_dir is not None and self.max_disk_bytes > 0:
+            self.put_disk(name, tensors)
+
+    def put_memory(self, name, tensors):
+        size = self.entry_size(tensors)
+
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old is not None:
+                self.current_bytes -= self.entry_size(old)
+
+            if size <= self.max_bytes:
+                self.entries[name] = tensors
+                self.current_bytes += size
+
+            self.evict()
+
+    def evict(self):
+        while self.current_bytes > self.max_bytes and len(self.entries) > 0:
+            _, evicted = self.entries.popitem(last=False)
+            self.current_bytes -= self.entry_size(evicted)
+
+    def put_disk(self, name, tensors):
+        if self.entry_size(tensors) > self.max_disk_bytes:
+            return
+
+        os.makedirs(self.disk_dir, exist_ok=True)
+        path = self.disk_path(name)
+        temp_path = path + '.tmp'
+
+        try:
+            sf.save_file({k: v.contiguous() for k, v in tensors.items()}, temp_path)
+            os.replace(temp_path, path)
+        except Exception as e:
+            print(f'[LoRA Merge Cache] Failed to write {path}: {e}')
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        files = [os.path.join(self.disk_dir, x) for x in os.listdir(self.disk_dir) if x.endswith('.safetensors')]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(x) for x in files)
+
+        while total > self.max_disk_bytes and len(files) > 1:
+            oldest = files.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def cache_info(self):
+        return f'CacheInfo(hits={self.hits}, misses={self.misses}, currsize={len(self.entries)}, bytes={self.current_bytes})'
+
+
+merged_weight_cache = MergedWeightCache()
+
+
+def configure(max_bytes=0, pin_memory=False, disk_dir=None, max_disk_bytes=0):
+    merged_weight_cache.max_bytes = max_bytes
+    merged_weight_cache.pin_memory = pin_memory
+    merged_weight_cache.disk_dir = disk_dir
+    merged_weight_cache.max_disk_bytes = max_disk_bytes
+
+    with merged_weight_cache.lock:
+        merged_weight_cache.evict()
@@ -65,6 +65,12 @@ class UnetPatcher(ModelPatcher):
         self.add_extra_model_patcher_during_sampling(patcher)
         return patcher
 
+    def set_residual_cache_threshold(self, threshold: float):
+        # Use this to let models that support it (Flux) skip their blocks on steps whose input barely changed,
+        # reusing the residual of the last computed step. 0 disables it; higher values skip more steps.
+        self.model_options['residual_cache_threshold'] = threshold
+        return
+
     def add_patched_controlnet(self, cnet):
         cnet.set_previous_controlnet(self.controlnet_linked_list)
         self.controlnet_linked_list = cnet
@@ -1,51 +1,75 @@
 import torch
 import math
 import itertools
+import functools
 
-from tqdm import trange
+from tqdm import tqdm
 from backend import memory_management
 from backend.patcher.base import ModelPatcher
 
 
+@functools.lru_cache(maxsize=16)
+def feather_mask(shape, feather, device):
+    # weights ramping up over `feather` pixels from every edge, as an outer product of one ramp per dimension
+    mask = torch.ones((1, 1) + shape, device=device)
+    for d, size in enumerate(shape):
+        index = torch.arange(size, device=device, dtype=torch.float32)
+        ramp = torch.where(index < feather, (index + 1) / feather, 1.0) * torch.where(size - 1 - index < feather, (size - index) / feather, 1.0)
+        mask = mask * ramp.view([size if i == d else 1 for i in range(len(shape))])
+    return mask
+
+
 @torch.inference_mode()
-def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_amount=4, out_channels=3, output_device="cpu"):
+def tiled_scale_multidim(samples, function, tile=(64, 64), overlap=8, upscale_amount=4, out_channels=3, output_device="cpu", batch_size=1):
+    """
+    Runs function over overlapping tiles of samples and blends the results with feathered weights. Tiles of the same
+    size, from all batch items, go through function in batches of up to batch_size (halved on out of memory), and
+    are accumulated straight into the output.
+    """
+
     dims = len(tile)
-    output = torch.empty([samples.shape[0], out_channels] + list(map(lambda a: round(a * upscale_amount), samples.shape[2:])), device=output_device)
-
-    for b in trange(samples.shape[0]):
-        s = samples[b:b + 1]
-        out = torch.zeros([s.shape[0], out_channels] + list(map(lambda a: round(a * upscale_amount), s.shape[2:])), device=output_device)
-        out_div = torch.zeros([s.shape[0], out_channels] + list(map(lambda a: round(a * upscale_amount), s.shape[2:])), device=output_device)
-
-        for it in itertools.product(*map(lambda a: range(0, a[0], a[1] - overlap), zip(s.shape[2:], tile))):
-            s_in = s
-            upscaled = []
-
-            for d in range(dims):
-                pos = max(0, min(s.shape[d + 2] - overlap, it[d]))
-                l = min(tile[d], s.shape[d + 2] - pos)
-                s_in = s_in.narrow(d + 2, pos, l)
-                upscaled.append(round(pos * upscale_amount))
-            ps = function(s_in).to(output_device)
-            mask = torch.ones_like(ps)
-            feather = round(overlap * upscale_amount)
-            for t in range(feather):
-                for d in range(2, dims + 2):
-                    m = mask.narrow(d, t, 1)
-                    m *= ((1.0 / feather) * (t + 1))
-                    m = mask.narrow(d, mask.shape[d] - 1 - t, 1)
-                    m *= ((1.0 / feather) * (t + 1))
-
-            o = out
-            o_d = out_div
-            for d in range(dims):
-                o = o.narrow(d + 2, upscaled[d], mask.shape[d + 2])
-                o_d = o_d.narrow(d + 2, upscaled[d], mask.shape[d + 2])
-
-            o += ps * mask
-            o_d += mask
-
-        output[b:b + 1] = out / out_div
+    out_shape = [round(a * upscale_amount) for a in samples.shape[2:]]
+    output = torch.zeros([samples.shape[0], out_channels] + out_shape, device=output_device)
+    weights = torch.zeros([samples.shape[0], 1] + out_shape, device=output_device)
+    feather = round(overlap * upscale_amount)
+
+    groups = {}
+    for b in range(samples.shape[0]):
+        for it in itertools.product(*map(lambda a: range(0, a[0], a[1] - overlap), zip(samples.shape[2:], tile))):
+            pos = tuple(max(0, min(samples.shape[d + 2] - overlap, it[d])) for d in range(dims))
+            size = tuple(min(tile[d], samples.shape[d + 2] - pos[d]) for d in range(dims))
+            groups.setdefault(size, []).append((b, pos))
+
+    progress = tqdm(total=sum(len(x) for x in groups.values()))
+
+    for size, tiles in groups.items():
+        i = 0
+        while i < len(tiles):
+            chunk = tiles[i:i + batch_size]
+            s_in = torch.cat([samples[(slice(b, b + 1), slice(None)) + tuple(slice(p, p + l) for p, l in zip(pos, size))] for b, pos in chunk])
+
+            try:
+                ps = function(s_in).to(output_device)
+            except memory_management.OOM_EXCEPTION:
+                if batch_size == 1:
+                    raise
+                del s_in
+                memory_management.soft_empty_cache(True)
+                batch_size = max(1, batch_size // 2)
+                continue
+
+            mask = feather_mask(tuple(ps.shape[2:]), feather, ps.device)
+            for j, (b, pos) in enumerate(chunk):
+                region = (slice(b, b + 1), slice(None)) + tuple(slice(round(p * upscale_amount), round(p * upscale_amount) + l) for p, l in zip(pos, ps.shape[2:]))
+                output[region] += ps[j:j + 1] * mask
+                weights[region] += mask
+
+            del s_in, ps
+            progress.update(len(chunk))
+            i += len(chunk)
+
+    progress.close()
+    output /= weights
     return output
 
 
@@ -53,8 +77,8 @@ def get_tiled_scale_steps(width, height, tile_x, tile_y, overlap):
     return math.ceil((height / (tile_y - overlap))) * math.ceil((width / (tile_x - overlap)))
 
 
-def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap=8, upscale_amount=4, out_channels=3, output_device="cpu"):
-    return tiled_scale_multidim(samples, function, (tile_y, tile_x), overlap, upscale_amount, out_channels, output_device)
+def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap=8, upscale_amount=4, out_channels=3, output_device="cpu", batch_size=1):
+    return tiled_scale_multidim(samples, function, (tile_y, tile_x), overlap, upscale_amount, out_channels, output_device, batch_size)
 
 
 class VAE:
@@ -101,17 +125,23 @@ class VAE:
         n.output_device = self.output_device
         return n
 
+    def tile_batch_size(self, memory_used, tile_shape):
+        # how many tiles fit in the free memory at once; all three tilings have the same tile area
+        free_memory = memory_management.get_free_memory(self.device)
+        return max(1, int(free_memory / memory_used(tile_shape, self.vae_dtype)))
+
     def decode_tiled_(self, samples, tile_x=64, tile_y=64, overlap=16):
         steps = samples.shape[0] * get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x, tile_y, overlap)
         steps += samples.shape[0] * get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x // 2, tile_y * 2, overlap)
         steps += samples.shape[0] * get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x * 2, tile_y // 2, overlap)
 
         decode_fn = lambda a: (self.first_stage_model.decode(a.to(self.vae_dtype).to(self.device)) + 1.0).float()
-        output = torch.clamp(((tiled_scale(samples, decode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount=self.downscale_ratio, output_device=self.output_device) +
-                               tiled_scale(samples, decode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount=self.downscale_ratio, output_device=self.output_device) +
-                               tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount=self.downscale_ratio, output_device=self.output_device))
-                              / 3.0) / 2.0, min=0.0, max=1.0)
-        return output
+        batch_size = self.tile_batch_size(self.memory_used_decode, samples.shape[:2] + (tile_y, tile_x))
+        output = tiled_scale(samples, decode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount=self.downscale_ratio, output_device=self.output_device, batch_size=batch_size)
+        output += tiled_scale(samples, decode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount=self.downscale_ratio, output_device=self.output_device, batch_size=batch_size)
+        output += tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount=self.downscale_ratio, output_device=self.output_device, batch_size=batch_size)
+        output /= 6.0
+        return output.clamp_(min=0.0, max=1.0)
 
     def encode_tiled_(self, pixel_samples, tile_x=512, tile_y=512, overlap=64):
         steps = pixel_samples.shape[0] * get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x, tile_y, overlap)
@@ -119,9 +149,10 @@ class VAE:
         steps += pixel_samples.shape[0] * get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x * 2, tile_y // 2, overlap)
 
         encode_fn = lambda a: self.first_stage_model.encode((2. * a - 1.).to(self.vae_dtype).to(self.device)).float()
-        samples = tiled_scale(pixel_samples, encode_fn, tile_x, tile_y, overlap, upscale_amount=(1 / self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device)
-        samples += tiled_scale(pixel_samples, encode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount=(1 / self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device)
-        samples += tiled_scale(pixel_samples, encode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount=(1 / self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device)
+        batch_size = self.tile_batch_size(self.memory_used_encode, pixel_samples.shape[:2] + (tile_y, tile_x))
+        samples = tiled_scale(pixel_samples, encode_fn, tile_x, tile_y, overlap, upscale_amount=(1 / self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, batch_size=batch_size)
+        samples += tiled_scale(pixel_samples, encode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount=(1 / self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, batch_size=batch_size)
+        samples += tiled_scale(pixel_samples, encode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount=(1 / self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, batch_size=batch_size)
         samples /= 3.0
         return samples
 
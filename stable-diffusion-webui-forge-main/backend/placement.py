@@ -0,0 +1,342 @@
+# Profile-guided placement of swappable modules for CPU swap.
+#
+# A profile is a plain JSON-able dict measured during the first sampling step of a model at a given latent shape:
+#     {'modules': {name: {'weight_mem': bytes, 'forward_time': seconds}}, 'sequence': [name, ...], 'bandwidth': bytes/s}
+# where sequence lists the swappable modules in the order they ran during one step (repeats included).
+# simulate() and plan_placement() only need such a dict, so plans can be computed, tested and compared on a CPU with
+# any memory budget; see the __main__ block.
+
+import time
+import torch
+
+
+def simulate(profile, resident, prefetch_layers=2, bandwidth=None):
+    """
+    Replays one step with the weights of `resident` modules on the GPU and the others copied in before each call, the
+    copies being issued prefetch_layers swapped calls ahead (see operations.WeightPrefetcher) and served in order.
+    Returns (stall, waits): the predicted seconds per step compute waits for copies, and the wait before every call.
+    """
+
+    modules = profile['modules']
+    sequence = profile['sequence']
+    bandwidth = bandwidth or profile['bandwidth']
+
+    swapped_calls = [i for i, name in enumerate(sequence) if name not in resident]
+    swapped_index = {i: k for k, i in enumerate(swapped_calls)}
+
+    starts = [0.0] * len(sequence)
+    waits = [0.0] * len(sequence)
+    compute_time = 0.0
+    copy_time = 0.0
+
+    for i, name in enumerate(sequence):
+        ready = compute_time
+
+        if name not in resident:
+            k = swapped_index[i]
+            if prefetch_layers <= 0:
+                issue = compute_time
+            elif k < prefetch_layers:
+                issue = 0.0  # prefetched during the tail of the previous step
+            else:
+                issue = starts[swapped_calls[k - prefetch_layers]]
+
+            copy_time = max(copy_time, issue) + modules[name]['weight_mem'] / bandwidth
+            if copy_time > ready:
+                waits[i] = copy_time - ready
+                ready = copy_time
+
+        starts[i] = ready
+        compute_time = ready + modules[name]['forward_time']
+
+    return sum(waits), waits
+
+
+def plan_placement(profile, budget, prefetch_layers=2, bandwidth=None):
+    """
+    Chooses the modules whose weights stay on the GPU within `budget` bytes, minimizing the simulated per-step stall.
+
+    After each simulation, every swapped module is scored by the stall it would remove per byte. Removing a
+    module shortens the copy queue by its transfer time for the calls after it, so its gain is bounded by the waits
+    left from there on. Leftover budget goes to the modules that run earliest in the step.
+    """
+
+    modules = profile['modules']
+    sequence = profile['sequence']
+    bandwidth = bandwidth or profile['bandwidth']
+
+    resident = set()
+    used = 0
+
+    while True:
+        stall, waits = simulate(profile, resident, prefetch_layers=prefetch_layers, bandwidth=bandwidth)
+        if stall <= 0:
+            break
+
+        # waits still ahead of each call, up to the end of the step
+        remaining = [0.0] * (len(sequence) + 1)
+        for i in range(len(sequence) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + waits[i]
+
+        gains = {}
+        for i, name in enumerate(sequence):
+            if name in resident or used + modules[name]['weight_mem'] > budget:
+                continue
+            transfer = modules[name]['weight_mem'] / bandwidth
+            gains[name] = gains.get(name, 0.0) + min(transfer, remaining[i])
+
+        best = max(gains, key=lambda x: gains[x] / max(modules[x]['weight_mem'], 1), default=None)
+        if best is None or gains[best] <= 0:
+            break
+
+        resident.add(best)
+        used += modules[best]['weight_mem']
+
+    for name in dict.fromkeys(sequence):
+        if name not in resident and used + modules[name]['weight_mem'] <= budget:
+            resident.add(name)
+            used += modules[name]['weight_mem']
+
+    # the gain estimate is a heuristic, never do worse than the plan without a profile
+    greedy = plan_greedy(profile, budget)
+    if simulate(profile, greedy, prefetch_layers=prefetch_layers, bandwidth=bandwidth)[0] < simulate(profile, resident, prefetch_layers=prefetch_layers, bandwidth=bandwidth)[0]:
+        return greedy
+
+    return resident
+
+
+def plan_greedy(profile, budget):
+    # what build_module_profile did without a profile: smallest weights first
+    resident = set()
+    used = 0
+    for name in sorted(profile['modules'], key=lambda x: profile['modules'][x]['weight_mem']):
+        if used + profile['modules'][name]['weight_mem'] < budget:
+            resident.add(name)
+            used += profile['modules'][name]['weight_mem']
+    return resident
+
+
+BUDGET_STEP = 64 * 1024 * 1024
+MAX_PLANS = 16
+
+store = None  # mapping of context key -> {'profile': ..., 'plans': {budget_mb: [names]}}, e.g. a diskcache.Cache
+context_model = None
+context_key = None
+bandwidth = None
+
+
+def configure(profile_store):
+    global store
+    store = profile_store
+
+
+def set_context(model, key):
+    """Called before a model is loaded for sampling; key identifies the weights and the latent shape, None disables."""
+    global context_model, context_key
+    context_model, context_key = model, key
+
+
+def measure_bandwidth(device, size=64 * 1024 * 1024):
+    global bandwidth
+
+    if bandwidth is None:
+        source = torch.empty(size, dtype=torch.uint8).pin_memory()
+        target = torch.empty(size, dtype=torch.uint8, device=device)
+        target.copy_(source, non_blocking=True)
+        torch.cuda.synchronize(device)
+
+        start = time.perf_counter()
+        for _ in range(4):
+            target.copy_(source, non_blocking=True)
+        torch.cuda.synchronize(device)
+        bandwidth = 4 * size / (time.perf_counter() - start)
+
+    return bandwidth
+
+
+def swappable_modules(model):
+    return {name: m for name, m in model.named_modules() if hasattr(m, 'parameters_manual_cast')}
+
+
+def stored_plan(model, budget, prefetch_layers):
+    """Names of the modules to keep on the GPU, or None if this model has not been profiled at this shape yet."""
+
+    if store is None or context_key is None or model is not context_model:
+        return None
+
+    try:
+        entry = store.get(context_key)
+    except Exception as e:
+        print(f'[Placement] Failed to read profile: {e}')
+        return None
+
+    if entry is None:
+        return None
+
+    # the budget depends on free memory at load time, rounding it keeps the number of stored plans small
+    budget = int(budget // BUDGET_STEP * BUDGET_STEP)
+    plan_key = f'{budget // (1024 * 1024)}:{prefetch_layers}'
+    plan = entry['plans'].get(plan_key)
+
+    if plan is None:
+        plan = sorted(plan_placement(entry['profile'], budget, prefetch_layers=prefetch_layers))
+        while len(entry['plans']) >= MAX_PLANS:
+            entry['plans'].pop(next(iter(entry['plans'])))
+        entry['plans'][plan_key] = plan
+        store[context_key] = entry
+
+        greedy_stall, _ = simulate(entry['profile'], plan_greedy(entry['profile'], budget), prefetch_layers=prefetch_layers)
+        planned_stall, _ = simulate(entry['profile'], set(plan), prefetch_layers=prefetch_layers)
+        print(f'[Placement] Planned {len(plan)} resident modules, predicted stall per step {planned_stall * 1000:.1f} ms (greedy: {greedy_stall * 1000:.1f} ms)')
+
+    return set(plan)
+
+
+class PlacementProfiler:
+    """
+    Times every swappable module with CUDA events during the next apply_model() call of the model, then stores the
+    profile under the current context key and removes itself. Sampling calls apply_model() directly rather than the
+    model's forward, so the call is wrapped by an instance attribute shadowing the method until then.
+    """
+
+    def __init__(self, model, device, key):
+        self.model = model
+        self.key = key
+        self.device = device
+        self.records = []
+        self.handles = []
+        self.modules = swappable_modules(model)
+
+        for name, m in self.modules.items():
+            self.handles.append(m.register_forward_pre_hook(self.make_pre_hook(name)))
+            self.handles.append(m.register_forward_hook(self.make_post_hook()))
+
+        apply_model = model.apply_model
+
+        def profiled_apply_model(*args, **kwargs):
+            try:
+                result = apply_model(*args, **kwargs)
+            except BaseException:
+                self.remove()
+                raise
+            self.finish()
+            return result
+
+        model.apply_model = profiled_apply_model
+        model.placement_profiler = self
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.model.__dict__.pop('apply_model', None)
+        self.model.placement_profiler = None
+
+    def make_pre_hook(self, name):
+        def hook(module, args):
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self.records.append([name, module, event, None])
+        return hook
+
+    def make_post_hook(self):
+        def hook(module, args, output):
+            for record in reversed(self.records):
+                if record[1] is module and record[3] is None:
+                    record[3] = torch.cuda.Event(enable_timing=True)
+                    record[3].record()
+                    break
+        return hook
+
+    def finish(self):
+        self.remove()
+
+        torch.cuda.synchronize(self.device)
+        measured_bandwidth = measure_bandwidth(self.device)
+
+        modules = {}
+        sequence = []
+
+        for name, module, start, end in self.records:
+            if end is None:
+                continue
+
+            weight_mem = getattr(module, 'weight_mem', 0)
+            elapsed = start.elapsed_time(end) / 1000
+
+            if getattr(module, 'weight', None) is not None and module.weight.device.type == 'cpu':
+                # a swapped module's time includes waiting for its own copy
+                elapsed = max(elapsed - weight_mem / measured_bandwidth, elapsed * 0.1)
+
+            entry = modules.setdefault(name, dict(weight_mem=weight_mem, forward_time=0.0, calls=0))
+            entry['forward_time'] += elapsed
+            entry['calls'] += 1
+            sequence.append(name)
+
+        for entry in modules.values():
+            entry['forward_time'] /= entry['calls']
+
+        profile = dict(modules=modules, sequence=sequence, bandwidth=measured_bandwidth)
+
+        try:
+            store[self.key] = dict(profile=profile, plans={})
+        except Exception as e:
+            print(f'[Placement] Failed to store profile: {e}')
+            return
+
+        self.model.placement_profiler_key = self.key
+        print(f'[Placement] Profiled {len(modules)} modules ({len(sequence)} calls); the placement is planned from the next model load')
+
+
+def maybe_profile(model, device):
+    """Profiles the next forward pass if the current context has no profile yet."""
+
+    if store is None or context_key is None or model is not context_model or device.type != 'cuda':
+        return
+
+    if getattr(model, 'placement_profiler', None) is not None or getattr(model, 'placement_profiler_key', None) == context_key:
+        return
+
+    try:
+        if context_key in store:
+            return
+    except Exception:
+        return
+
+    modules = swappable_modules(model)
+    if not any(getattr(m, 'weight', None) is not None and m.weight.device.type == 'cpu' for m in modules.values()):
+        return  # nothing is swapped, there is nothing to plan
+
+    PlacementProfiler(model, device, context_key)
+
+
+def cancel_profile(model):
+    """Removes a profiler whose apply_model() call did not happen, e.g. when sampling was interrupted before it."""
+
+    profiler = getattr(model, 'placement_profiler', None)
+    if profiler is not None:
+        profiler.remove()
+
+
+if __name__ == '__main__':
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare greedy and planned placements of a stored profile.')
+    parser.add_argument('profile', help='JSON file holding a profile dict')
+    parser.add_argument('--budget-mb', type=float, required=True)
+    parser.add_argument('--prefetch-layers', type=int, default=2)
+    parser.add_argument('--bandwidth-gbps', type=float, default=None, help='override the measured host to device bandwidth')
+    cli_args = parser.parse_args()
+
+    with open(cli_args.profile, 'rt', encoding='utf-8') as f:
+        cli_profile = json.load(f)
+    cli_profile = cli_profile.get('profile', cli_profile)
+
+    cli_budget = cli_args.budget_mb * 1024 * 1024
+    cli_bandwidth = cli_args.bandwidth_gbps * 1e9 if cli_args.bandwidth_gbps else None
+
+    for label, plan in [('greedy', plan_greedy(cli_profile, cli_budget)), ('planned', plan_placement(cli_profile, cli_budget, cli_args.prefetch_layers, cli_bandwidth))]:
+        stall, _ = simulate(cli_profile, plan, prefetch_layers=cli_args.prefetch_layers, bandwidth=cli_bandwidth)
+        resident_mb = sum(cli_profile['modules'][x]['weight_mem'] for x in plan) / (1024 * 1024)
+        print(f'{label}: {len(plan)} resident modules, {resident_mb:.0f} MB, predicted stall per step {stall * 1000:.1f} ms')
@@ -7,16 +7,127 @@ import torch
 import math
 import collections
 
-from backend import memory_management
+from backend import memory_management, dequant_cache, placement, compilation
 from backend.sampling.condition import Condition, compile_conditions, compile_weighted_conditions
-from backend.operations import cleanup_cache
+from backend.operations import cleanup_cache, weight_prefetcher
 from backend.args import dynamic_args, args
 from backend import utils
 
 
+cond_obj = collections.namedtuple('cond_obj', ['input_x', 'mult', 'conditioning', 'area', 'control', 'patches'])
+
+
+def compute_area_mult(conds, x_in, area, input_x):
+    strength = conds.get('strength', 1.0)
+
+    if 'mask' in conds:
+        mask_strength = 1.0
+        if "mask_strength" in conds:
+            mask_strength = conds["mask_strength"]
+        mask = conds['mask']
+        assert (mask.shape[1] == x_in.shape[2])
+        assert (mask.shape[2] == x_in.shape[3])
+        mask = mask[:, area[2]:area[0] + area[2], area[3]:area[1] + area[3]] * mask_strength
+        mask = mask.unsqueeze(1).repeat(input_x.shape[0] // mask.shape[0], input_x.shape[1], 1, 1)
+        return mask * strength
+
+    # feather the borders that lie inside the latent over rr pixels, as the outer product of a row and a column ramp
+    rr = 8
+    rows = torch.ones(input_x.shape[2], dtype=input_x.dtype, device=input_x.device)
+    cols = torch.ones(input_x.shape[3], dtype=input_x.dtype, device=input_x.device)
+    if area[2] != 0:
+        rows *= (torch.arange(rows.shape[0], device=rows.device) + 1).clamp(max=rr).to(rows) / rr
+    if (area[0] + area[2]) < x_in.shape[2]:
+        rows *= (area[0] - torch.arange(rows.shape[0], device=rows.device)).clamp(max=rr).to(rows) / rr
+    if area[3] != 0:
+        cols *= (torch.arange(cols.shape[0], device=cols.device) + 1).clamp(max=rr).to(cols) / rr
+    if (area[1] + area[3]) < x_in.shape[3]:
+        cols *= (area[1] - torch.arange(cols.shape[0], device=cols.device)).clamp(max=rr).to(cols) / rr
+
+    return (rows[:, None] * cols[None, :] * strength).expand_as(input_x)
+
+
+def cond_signature(p, cond_or_uncond):
+    # everything can_concat_cond and the batch sizing look at
+    conditioning = tuple((k, type(v), tuple(v.cond.shape) if isinstance(v.cond, torch.Tensor) else v.cond if isinstance(v.cond, (int, float, str)) else id(v.cond)) for k, v in p.conditioning.items())
+    return cond_or_uncond, tuple(p.input_x.shape), id(p.control), id(p.patches), conditioning
+
+
+class CompiledConditions:
+    """
+    What calc_cond_uncond_batch derives from the conditions rather than from the latent: area multipliers, processed
+    model conditions, and the grouping of conds into model calls. Computed on the first step of a sampling run and
+    reused by the following ones; begin() and end() bound the run.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.mults = {}
+        self.conditionings = {}
+        self.batches = {}
+        self.concats = {}
+
+    def begin(self):
+        self.end()
+        self.active = True
+
+    def end(self):
+        self.active = False
+        self.mults.clear()
+        self.conditionings.clear()
+        self.batches.clear()
+        self.concats.clear()
+
+    def mult(self, conds, x_in, area, input_x):
+        if not self.active:
+            return compute_area_mult(conds, x_in, area, input_x)
+
+        mask = conds.get('mask', None)
+        key = (tuple(x_in.shape), x_in.dtype, x_in.device, tuple(area), conds.get('strength', 1.0), id(mask), conds.get('mask_strength', 1.0))
+        entry = self.mults.get(key)
+        if entry is None or entry[0] is not mask:
+            entry = self.mults[key] = (mask, compute_area_mult(conds, x_in, area, input_x))
+        return entry[1]
+
+    def conditioning(self, name, model_cond, x_in, area):
+        if not self.active:
+            return model_cond.process_cond(batch_size=x_in.shape[0], device=x_in.device, area=area)
+
+        # the condition objects are rebuilt every step, but usually around the same tensors
+        key = (name, type(model_cond), id(model_cond.cond), x_in.shape[0], x_in.device, tuple(area))
+        entry = self.conditionings.get(key)
+        if entry is None or entry[0] is not model_cond.cond:
+            entry = self.conditionings[key] = (model_cond.cond, model_cond.process_cond(batch_size=x_in.shape[0], device=x_in.device, area=area))
+        return entry[1]
+
+    def concat(self, c_list):
+        if not self.active:
+            return cond_cat(c_list)
+
+        # the processed conditions are the same objects on every step, so is their concatenation; models can then
+        # recognize a step-invariant input by identity
+        key = tuple(tuple((k, id(v)) for k, v in x.items()) for x in c_list)
+        entry = self.concats.get(key)
+        if entry is None or any(a[k] is not b[k] for a, b in zip(entry[0], c_list) for k in a):
+            entry = self.concats[key] = ([dict(x) for x in c_list], cond_cat(c_list))
+        return dict(entry[1])
+
+    def batch_plan(self, model, to_run, x_in):
+        if not self.active:
+            return plan_batches(model, to_run, x_in)
+
+        key = tuple(cond_signature(p, cond_or_uncond) for p, cond_or_uncond in to_run)
+        plan = self.batches.get(key)
+        if plan is None:
+            plan = self.batches[key] = plan_batches(model, to_run, x_in)
+        return plan
+
+
+compiled_conditions = CompiledConditions()
+
+
 def get_area_and_mult(conds, x_in, timestep_in):
     area = (x_in.shape[2], x_in.shape[3], 0, 0)
-    strength = 1.0
 
     if 'timestep_start' in conds:
         timestep_start = conds['timestep_start']
@@ -28,48 +139,18 @@ def get_area_and_mult(conds, x_in, timestep_in):
             return None
     if 'area' in conds:
         area = conds['area']
-    if 'strength' in conds:
-        strength = conds['strength']
 
     input_x = x_in[:, :, area[2]:area[0] + area[2], area[3]:area[1] + area[3]]
-
-    if 'mask' in conds:
-        mask_strength = 1.0
-        if "mask_strength" in conds:
-            mask_strength = conds["mask_strength"]
-        mask = conds['mask']
-        assert (mask.shape[1] == x_in.shape[2])
-        assert (mask.shape[2] == x_in.shape[3])
-        mask = mask[:, area[2]:area[0] + area[2], area[3]:area[1] + area[3]] * mask_strength
-        mask = mask.unsqueeze(1).repeat(input_x.shape[0] // mask.shape[0], input_x.shape[1], 1, 1)
-    else:
-        mask = torch.ones_like(input_x)
-    mult = mask * strength
-
-    if 'mask' not in conds:
-        rr = 8
-        if area[2] != 0:
-            for t in range(rr):
-                mult[:, :, t:1 + t, :] *= ((1.0 / rr) * (t + 1))
-        if (area[0] + area[2]) < x_in.shape[2]:
-            for t in range(rr):
-                mult[:, :, area[0] - 1 - t:area[0] - t, :] *= ((1.0 / rr) * (t + 1))
-        if area[3] != 0:
-            for t in range(rr):
-                mult[:, :, :, t:1 + t] *= ((1.0 / rr) * (t + 1))
-        if (area[1] + area[3]) < x_in.shape[3]:
-            for t in range(rr):
-                mult[:, :, :, area[1] - 1 - t:area[1] - t] *= ((1.0 / rr) * (t + 1))
+    mult = compiled_conditions.mult(conds, x_in, area, input_x)
 
     conditioning = {}
     model_conds = conds["model_conds"]
     for c in model_conds:
-        conditioning[c] = model_conds[c].process_cond(batch_size=x_in.shape[0], device=x_in.device, area=area)
+        conditioning[c] = compiled_conditions.conditioning(c, model_conds[c], x_in, area)
 
     control = conds.get('control', None)
 
     patches = None
-    cond_obj = collections.namedtuple('cond_obj', ['input_x', 'mult', 'conditioning', 'area', 'control', 'patches'])
     return cond_obj(input_x, mult, conditioning, area, control, patches)
 
 
@@ -151,6 +232,50 @@ def compute_cond_indices(cond_or_uncond, sigmas):
     return cond_indices, uncond_indices
 
 
+def plan_batches(model, to_run, x_in):
+    """Groups to_run into model calls, as lists of indices, batching as many concatenable conds as memory allows."""
+
+    free_memory = memory_management.get_free_memory(x_in.device)
+
+    if (not args.disable_gpu_warning) and x_in.device.type == 'cuda':
+        free_memory_mb = free_memory / (1024.0 * 1024.0)
+        safe_memory_mb = 1536.0
+        if free_memory_mb < safe_memory_mb:
+            print(f"\n\n----------------------")
+            print(f"[Low GPU VRAM Warning] Your current GPU free memory is {free_memory_mb:.2f} MB for this diffusion iteration.")
+            print(f"[Low GPU VRAM Warning] This number is lower than the safe value of {safe_memory_mb:.2f} MB.")
+            print(f"[Low GPU VRAM Warning] If you continue, you may cause NVIDIA GPU performance degradation for this diffusion process, and the speed may be extremely slow (about 10x slower).")
+            print(f"[Low GPU VRAM Warning] To solve the problem, you can set the 'GPU Weights' (on the top of page) to a lower value.")
+            print(f"[Low GPU VRAM Warning] If you cannot find 'GPU Weights', you can click the 'all' option in the 'UI' area on the left-top corner of the webpage.")
+            print(f"[Low GPU VRAM Warning] If you want to take the risk of NVIDIA GPU fallback and test the 10x slower speed, you can (but are highly not recommended to) add '--disable-gpu-warning' to CMD flags to remove this warning.")
+            print(f"----------------------\n\n")
+
+    remaining = list(range(len(to_run)))
+    batches = []
+
+    while len(remaining) > 0:
+        first = to_run[remaining[0]][0]
+        first_shape = first.input_x.shape
+        to_batch_temp = []
+        for x in range(len(remaining)):
+            if can_concat_cond(to_run[remaining[x]][0], first):
+                to_batch_temp += [x]
+
+        to_batch_temp.reverse()
+        to_batch = to_batch_temp[:1]
+
+        for i in range(1, len(to_batch_temp) + 1):
+            batch_amount = to_batch_temp[:len(to_batch_temp) // i]
+            input_shape = [len(batch_amount) * first_shape[0]] + list(first_shape)[1:]
+            if model.memory_required(input_shape) < free_memory:
+                to_batch = batch_amount
+                break
+
+        batches.append([remaining.pop(x) for x in to_batch])
+
+    return batches
+
+
 def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
     out_cond = torch.zeros_like(x_in)
     out_count = torch.ones_like(x_in) * 1e-37
@@ -176,42 +301,10 @@ def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
 
             to_run += [(p, UNCOND)]
 
-    while len(to_run) > 0:
-        first = to_run[0]
-        first_shape = first[0][0].shape
-        to_batch_temp = []
-        for x in range(len(to_run)):
-            if can_concat_cond(to_run[x][0], first[0]):
-                to_batch_temp += [x]
-
-        to_batch_temp.reverse()
-        to_batch = to_batch_temp[:1]
-
-        if memory_management.signal_empty_cache:
-            memory_management.soft_empty_cache()
-
-        free_memory = memory_management.get_free_memory(x_in.device)
-
-        if (not args.disable_gpu_warning) and x_in.device.type == 'cuda':
-            free_memory_mb = free_memory / (1024.0 * 1024.0)
-            safe_memory_mb = 1536.0
-            if free_memory_mb < safe_memory_mb:
-                print(f"\n\n----------------------")
-                print(f"[Low GPU VRAM Warning] Your current GPU free memory is {free_memory_mb:.2f} MB for this diffusion iteration.")
-                print(f"[Low GPU VRAM Warning] This number is lower than the safe value of {safe_memory_mb:.2f} MB.")
-                print(f"[Low GPU VRAM Warning] If you continue, you may cause NVIDIA GPU performance degradation for this diffusion process, and the speed may be extremely slow (about 10x slower).")
-                print(f"[Low GPU VRAM Warning] To solve the problem, you can set the 'GPU Weights' (on the top of page) to a lower value.")
-                print(f"[Low GPU VRAM Warning] If you cannot find 'GPU Weights', you can click the 'all' option in the 'UI' area on the left-top corner of the webpage.")
-                print(f"[Low GPU VRAM Warning] If you want to take the risk of NVIDIA GPU fallback and test the 10x slower speed, you can (but are highly not recommended to) add '--disable-gpu-warning' to CMD flags to remove this warning.")
-                print(f"----------------------\n\n")
-
-        for i in range(1, len(to_batch_temp) + 1):
-            batch_amount = to_batch_temp[:len(to_batch_temp) // i]
-            input_shape = [len(batch_amount) * first_shape[0]] + list(first_shape)[1:]
-            if model.memory_required(input_shape) < free_memory:
-                to_batch = batch_amount
-                break
+    if memory_management.signal_empty_cache:
+        memory_management.soft_empty_cache()
 
+    for to_batch in compiled_conditions.batch_plan(model, to_run, x_in):
         input_x = []
         mult = []
         c = []
@@ -220,7 +313,7 @@ def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
         control = None
         patches = None
         for x in to_batch:
-            o = to_run.pop(x)
+            o = to_run[x]
             p = o[0]
             input_x.append(p.input_x)
             mult.append(p.mult)
@@ -232,7 +325,7 @@ def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
 
         batch_chunks = len(cond_or_uncond)
         input_x = torch.cat(input_x)
-        c = cond_cat(c)
+        c = compiled_conditions.concat(c)
         timestep_ = torch.cat([timestep] * batch_chunks)
 
         transformer_options = {}
@@ -380,6 +473,12 @@ def sampling_prepare(unet, x):
         lora_memory = utils.nested_compute_size(unet.lora_patches, element_size=utils.dtype_to_element_size(unet.model.computation_dtype))
         additional_inference_memory += lora_memory
 
+    # layers that ran before sampling (e.g. swapped text encoders) must not end up in the prefetch order
+    weight_prefetcher.reset()
+
+    namespace = unet.lora_loader.cache_namespace
+    placement.set_context(unet.model, None if namespace is None else f'{namespace}:{B}x{C}x{H}x{W}:{unet.has_online_lora()}')
+
     memory_management.load_models_gpu(
         models=[unet] + additional_model_patchers,
         memory_required=unet_inference_memory,
@@ -389,7 +488,35 @@ def sampling_prepare(unet, x):
     if unet.has_online_lora():
         utils.nested_move_to_device(unet.lora_patches, device=unet.current_device, dtype=unet.model.computation_dtype)
 
+    if dequant_cache.cache.enabled:
+        free_memory = memory_management.get_free_memory(unet.current_device)
+        dequant_cache.cache.begin(free_memory - unet_inference_memory - additional_inference_memory)
+
+    compiled_conditions.begin()
+
+    conditioning_cache = getattr(unet.model.diffusion_model, 'conditioning_cache', None)
+    if conditioning_cache is not None:
+        conditioning_cache.begin()
+
+    residual_cache = getattr(unet.model.diffusion_model, 'residual_cache', None)
+    if residual_cache is not None:
+        residual_cache.begin(unet.model_options.get('residual_cache_threshold', 0))
+
+    compiled_blocks = getattr(unet.model.diffusion_model, 'compiled_blocks', None)
+    if compiled_blocks is not None and compilation.enabled:
+        # patches applied inside the layers or between the blocks are not part of the compiled graphs
+        reasons = [name for name, present in [
+            ('online LoRA', unet.has_online_lora()),
+            ('ControlNet', unet.controlnet_linked_list is not None),
+            ('object patches', len(unet.object_patches) > 0),
+            ('CPU swap', any(m.model.model is unet.model and m.model_accelerated for m in memory_management.current_loaded_models)),
+        ] if present]
+        if reasons:
+            print(f'[Compile] Running eagerly because of {", ".join(reasons)}')
+        compiled_blocks.begin(allowed=len(reasons) == 0)
+
     real_model = unet.model
+    placement.maybe_profile(real_model, unet.current_device)
 
     percent_to_timestep_function = lambda p: real_model.predictor.percent_to_sigma(p)
 
@@ -400,6 +527,23 @@ def sampling_prepare(unet, x):
 
 
 def sampling_cleanup(unet):
+    placement.cancel_profile(unet.model)
+    dequant_cache.cache.end()
+    compiled_conditions.end()
+    unet.model.cast_cache.clear()
+
+    conditioning_cache = getattr(unet.model.diffusion_model, 'conditioning_cache', None)
+    if conditioning_cache is not None:
+        conditioning_cache.end()
+
+    residual_cache = getattr(unet.model.diffusion_model, 'residual_cache', None)
+    if residual_cache is not None:
+        residual_cache.end()
+
+    compiled_blocks = getattr(unet.model.diffusion_model, 'compiled_blocks', None)
+    if compiled_blocks is not None:
+        compiled_blocks.end()
+
     if unet.has_online_lora():
         utils.nested_move_to_device(unet.lora_patches, device=unet.offload_device)
     for cnet in unet.list_controlnets():
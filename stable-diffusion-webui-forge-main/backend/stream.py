@@ -59,3 +59,4 @@ def should_use_stream():
 current_stream = get_current_stream()
 mover_stream = get_new_stream()
 stream_activated = args.cuda_stream
+prefetch_layers = 2  # how many swapped layers ahead to start copying while a layer computes
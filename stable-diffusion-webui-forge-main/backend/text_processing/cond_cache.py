@@ -0,0 +1,147 @@
+import hashlib
+import threading
+import torch
+
+from collections import OrderedDict
+from backend.text_processing import classic_engine
+
+from modules.shared import opts
+
+
+class ConditioningCache:
+    """
+    Bounded LRU of per-prompt text encoder outputs, kept in CPU memory.
+    If disk_cache is set (any mapping, e.g. a diskcache.Cache), entries are also written through to it,
+    so they survive eviction and process restarts.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, disk_cache=None):
+        self.max_bytes = max_bytes
+        self.disk_cache = disk_cache
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(entry):
+        return sum(v.numel() * v.element_size() for v in entry.values() if isinstance(v, torch.Tensor))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        if self.disk_cache is not None:
+            try:
+                entry = self.disk_cache.get(key)
+            except Exception as e:
+                print(f'[Conditioning Cache] Failed to read from disk: {e}')
+                entry = None
+
+            if entry is not None:
+                self.put(key, entry, write_through=False)
+                self.hits += 1
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key, entry, write_through=True):
+        entry = {k: v.detach().to('cpu') if isinstance(v, torch.Tensor) else v for k, v in entry.items()}
+        size = self.entry_size(entry)
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= self.entry_size(old)
+
+            if size <= self.max_bytes:
+                self.entries[key] = entry
+                self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes and len(self.entries) > 0:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= self.entry_size(evicted)
+
+        if write_through and self.disk_cache is not None:
+            try:
+                self.disk_cache[key] = entry
+            except Exception as e:
+                print(f'[Conditioning Cache] Failed to write to disk: {e}')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def cache_info(self):
+        return f'CacheInfo(hits={self.hits}, misses={self.misses}, currsize={len(self.entries)}, bytes={self.current_bytes})'
+
+
+cache = ConditioningCache()
+
+
+def configure(max_bytes, disk_cache=None):
+    cache.max_bytes = max_bytes
+    cache.disk_cache = disk_cache
+
+    with cache.lock:
+        while cache.current_bytes > cache.max_bytes and len(cache.entries) > 0:
+            _, evicted = cache.entries.popitem(last=False)
+            cache.current_bytes -= cache.entry_size(evicted)
+
+
+def make_key(key_prefix, text):
+    return hashlib.sha256(repr((key_prefix, opts.emphasis, text)).encode('utf-8')).hexdigest()
+
+
+def cached_encode(encode_fn, texts, key_prefix):
+    """
+    encode_fn(texts) must return a dict of tensors with one row per text, like dict(crossattn=..., vector=...).
+    Only the prompts that are not cached are passed to encode_fn, so if every prompt is a hit the text encoders
+    are not loaded at all. key_prefix must identify everything else that affects the result (checkpoint, LoRAs, clip skip).
+    """
+
+    texts = list(texts)
+
+    if cache.max_bytes <= 0 or len(texts) == 0:
+        return encode_fn(texts)
+
+    keys = {text: make_key(key_prefix, text) for text in texts}
+    entries = {}
+
+    for text, key in keys.items():
+        entry = cache.get(key)
+        if entry is not None:
+            entries[text] = entry
+
+    missing = [text for text in keys if text not in entries]
+
+    if missing:
+        extra_before = dict(classic_engine.last_extra_generation_params)
+        encoded = encode_fn(missing)
+        extra = {k: v for k, v in classic_engine.last_extra_generation_params.items() if extra_before.get(k) != v}
+
+        if any(v.shape[0] != len(missing) for v in encoded.values()):
+            # prompts spanning several T5 chunks do not map to one row per prompt, so they are left uncached
+            if len(missing) == len(texts):
+                return encoded
+            return encode_fn(texts)
+
+        for i, text in enumerate(missing):
+            entry = {k: v[i] for k, v in encoded.items()}
+            entry['extra_generation_params'] = extra
+            cache.put(keys[text], entry)
+            entries[text] = entry
+
+    for text in texts:
+        if text not in missing:
+            classic_engine.last_extra_generation_params.update(entries[text].get('extra_generation_params', {}))
+
+    tensor_names = [k for k, v in entries[texts[0]].items() if isinstance(v, torch.Tensor)]
+    return {k: torch.stack([entries[text][k] for text in texts]) for k in tensor_names}
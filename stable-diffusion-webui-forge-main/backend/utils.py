@@ -1,7 +1,9 @@
 import gguf
+import mmap
 import torch
 import os
 import json
+import struct
 import safetensors.torch
 import backend.misc.checkpoint_pickle
 from backend.operations_gguf import ParameterGGUF
@@ -19,13 +21,66 @@ def read_arbitrary_config(directory):
     return config_data
 
 
-def load_torch_file(ckpt, safe_load=False, device=None):
+safetensors_dtypes = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U64': torch.uint64,
+    'U32': torch.uint32,
+    'U16': torch.uint16,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+    'F8_E4M3': torch.float8_e4m3fn,
+    'F8_E5M2': torch.float8_e5m2,
+}
+
+
+def load_safetensors_mmap(ckpt):
+    # Tensors are views into a private (copy-on-write) mapping of the file, so nothing is read until a tensor is
+    # actually used, e.g. copied/cast into a parameter by load_state_dict, and unused keys never cost any RAM.
+
+    with open(ckpt, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_size
+    header.pop('__metadata__', None)
+
+    unknown = {v['dtype'] for v in header.values()} - safetensors_dtypes.keys()
+    if unknown:
+        print(f'Loading {ckpt} without mmap, unsupported dtypes: {sorted(unknown)}')
+        buffer.close()
+        return safetensors.torch.load_file(ckpt)
+
+    sd = {}
+    for k, v in header.items():
+        dtype = safetensors_dtypes[v['dtype']]
+        begin, end = v['data_offsets']
+        if end == begin:
+            sd[k] = torch.empty(v['shape'], dtype=dtype)
+            continue
+        count = (end - begin) // torch.tensor([], dtype=dtype).element_size()
+        sd[k] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + begin).reshape(v['shape'])
+    return sd
+
+
+def load_torch_file(ckpt, safe_load=False, device=None, use_mmap=False):
     if device is None:
         device = torch.device("cpu")
     if ckpt.lower().endswith(".safetensors"):
-        sd = safetensors.torch.load_file(ckpt, device=device.type)
+        if use_mmap and device.type == 'cpu':
+            sd = load_safetensors_mmap(ckpt)
+        else:
+            sd = safetensors.torch.load_file(ckpt, device=device.type)
     elif ckpt.lower().endswith(".gguf"):
-        reader = gguf.GGUFReader(ckpt)
+        # copy-on-write mapping: tensors share the page cache (also across processes) until something writes to them
+        reader = gguf.GGUFReader(ckpt, 'c')
         sd = {}
         for tensor in reader.tensors:
             sd[str(tensor.name)] = ParameterGGUF(tensor)
@@ -0,0 +1,80 @@
+# CPU benchmark of the host overhead of calc_cond_uncond_batch for regional prompts: area multipliers, condition
+# processing and batch planning recomputed on every step versus compiled once per sampling run. The model is a stub
+# that returns its input, so the timings are the per-step Python and allocation overhead only.
+#
+#   python -m benchmarks.cond_batching --regions 8 --steps 30
+
+import argparse
+import time
+import torch
+
+from backend.sampling.condition import ConditionCrossAttn, Condition
+from backend.sampling.sampling_function import calc_cond_uncond_batch, compiled_conditions
+
+
+class StubModel:
+    def memory_required(self, input_shape):
+        return 0
+
+    def apply_model(self, x, t, **kwargs):
+        return x
+
+
+def regional_conds(regions, height, width, tokens, dim):
+    conds = []
+    region_width = width // regions
+    for i in range(regions):
+        cross_attn = torch.randn(1, tokens, dim)
+        conds.append(dict(
+            cross_attn=cross_attn,
+            area=(height, region_width, 0, i * region_width),
+            strength=1.0,
+            model_conds=dict(c_crossattn=ConditionCrossAttn(cross_attn), y=Condition(torch.randn(1, 768))),
+        ))
+    uncond_attn = torch.randn(1, tokens, dim)
+    uncond = [dict(cross_attn=uncond_attn, model_conds=dict(c_crossattn=ConditionCrossAttn(uncond_attn), y=Condition(torch.randn(1, 768))))]
+    return conds, uncond
+
+
+def run(model, conds, uncond, x, steps):
+    outputs = None
+    for step in range(steps):
+        # the samplers compile new condition dicts around the same tensors on every step
+        step_conds = [dict(c, model_conds=dict(c['model_conds'])) for c in conds]
+        step_uncond = [dict(c, model_conds=dict(c['model_conds'])) for c in uncond]
+        outputs = calc_cond_uncond_batch(model, step_conds, step_uncond, x, torch.tensor([1.0 - step / steps]), {})
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--regions', type=int, default=8)
+    parser.add_argument('--steps', type=int, default=30)
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--width', type=int, default=128)
+    parser.add_argument('--tokens', type=int, default=77)
+    parser.add_argument('--dim', type=int, default=2048)
+    args = parser.parse_args()
+
+    model = StubModel()
+    x = torch.randn(1, 4, args.height, args.width)
+    conds, uncond = regional_conds(args.regions, args.height, args.width, args.tokens, args.dim)
+    print(f'{args.regions} regions, latent {args.height}x{args.width}, {args.steps} steps, threads={torch.get_num_threads()}')
+
+    results = {}
+    timings = {}
+    for name, active in [('per-step', False), ('compiled', True)]:
+        if active:
+            compiled_conditions.begin()
+        start = time.perf_counter()
+        results[name] = run(model, conds, uncond, x, args.steps)
+        timings[name] = (time.perf_counter() - start) / args.steps
+        compiled_conditions.end()
+        print(f'{name}: {timings[name] * 1000:.3f} ms per step')
+
+    max_error = max((a - b).abs().max().item() for a, b in zip(results['per-step'], results['compiled']))
+    print(f'speedup: {timings["per-step"] / timings["compiled"]:.2f}x, max abs difference: {max_error:.3e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Checks and times the compiled Flux block stacks on a randomly initialized, reduced Flux. Runs on CPU by default,
+# where inductor generates C++ kernels: the first compiled call per bucket compiles (or loads the kernels from
+# --cache-dir, so run it twice to see the on-disk cache at work), the compiled output is compared with the eager one,
+# and the per-step time of both is reported. A size outside the buckets and a run begun with allowed=False must run
+# eagerly.
+#
+#   python -m benchmarks.flux_compile --buckets 256x256 512x384 --steps 5 --cache-dir /tmp/forge-compile
+
+import argparse
+import os
+import tempfile
+import time
+import torch
+
+from backend import compilation
+from backend.nn.flux import IntegratedFluxTransformer2DModel
+
+
+def timed(model, inputs, steps):
+    start = time.perf_counter()
+    for _ in range(steps):
+        out = model(*inputs[:2], context=inputs[2], y=inputs[3], guidance=inputs[4])
+    return out, (time.perf_counter() - start) / steps
+
+
+def make_inputs(batch, width, height, txt_len, context_dim, dtype):
+    return (
+        torch.randn(batch, 16, height // 8, width // 8, dtype=dtype),
+        torch.full((batch,), 0.5, dtype=dtype),
+        torch.randn(batch, txt_len, context_dim, dtype=dtype),
+        torch.randn(batch, 768, dtype=dtype),
+        torch.full((batch,), 3.5, dtype=dtype),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--buckets', nargs='+', default=['256x256', '512x384'], help='WxH sizes in pixels')
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--hidden', type=int, default=256)
+    parser.add_argument('--heads', type=int, default=2)
+    parser.add_argument('--double', type=int, default=2)
+    parser.add_argument('--single', type=int, default=4)
+    parser.add_argument('--context-dim', type=int, default=256)
+    parser.add_argument('--txt-len', type=int, default=64)
+    parser.add_argument('--cache-dir', default=os.path.join(tempfile.gettempdir(), 'forge-torch-compile'))
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'bfloat16'])
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    dtype = getattr(torch, args.dtype)
+
+    compilation.configure(True, ', '.join(args.buckets), args.cache_dir)
+    print(f'buckets {compilation.buckets}, kernels cached in {compilation.cache_dir}, threads={torch.get_num_threads()}')
+
+    head_dim = args.hidden // args.heads
+    axes_dim = [head_dim - 2 * (head_dim * 7 // 16), head_dim * 7 // 16, head_dim * 7 // 16]
+    model = IntegratedFluxTransformer2DModel(
+        in_channels=16, vec_in_dim=768, context_in_dim=args.context_dim, hidden_size=args.hidden, mlp_ratio=4.0,
+        num_heads=args.heads, depth=args.double, depth_single_blocks=args.single, axes_dim=axes_dim, theta=10000,
+        qkv_bias=True, guidance_embed=True,
+    ).to(dtype=dtype).eval()
+
+    tolerance = 1e-3 if dtype == torch.float32 else 5e-2
+
+    with torch.no_grad():
+        for width, height in compilation.buckets:
+            inputs = make_inputs(args.batch, width, height, args.txt_len, args.context_dim, dtype)
+
+            reference, eager_time = timed(model, inputs, args.steps)
+
+            model.compiled_blocks.begin()
+            start = time.perf_counter()
+            timed(model, inputs, 1)
+            first_call = time.perf_counter() - start
+            out, compiled_time = timed(model, inputs, args.steps)
+            model.compiled_blocks.end()
+
+            error = (out.float() - reference.float()).abs().max().item()
+            status = 'ok' if error <= tolerance else 'MISMATCH'
+            print(f'{width}x{height}: first compiled call {first_call:.1f} s, {eager_time * 1000:.1f} ms eager vs '
+                  f'{compiled_time * 1000:.1f} ms compiled per step, max abs difference {error:.1e} {status}')
+
+        compiled = len(model.compiled_blocks.compiled_keys)
+
+        width, height = compilation.buckets[0]
+        model.compiled_blocks.begin()
+        timed(model, make_inputs(args.batch, width + 64, height, args.txt_len, args.context_dim, dtype), 1)
+        model.compiled_blocks.end()
+        model.compiled_blocks.begin(allowed=False)
+        timed(model, make_inputs(args.batch, width, height, args.txt_len, args.context_dim, dtype), 1)
+        model.compiled_blocks.end()
+
+        unexpected = len(model.compiled_blocks.compiled_keys) - compiled
+        print(f'outside the buckets and with allowed=False: {"eager, ok" if unexpected == 0 else "compiled, MISMATCH"}')
+
+
+if __name__ == '__main__':
+    main()
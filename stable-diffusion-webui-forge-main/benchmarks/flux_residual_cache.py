@@ -0,0 +1,99 @@
+# Quality/speed benchmark of the Flux residual cache: an Euler flow-matching run with every block computed, versus
+# runs where ResidualCache skips steps at the given thresholds. Reports time, skipped calls and the difference of the
+# final latent to the full run. Runs a randomly initialized, reduced Flux on CPU by default, so the numbers show the
+# mechanism and its overhead; pass --device cuda and the full dimensions (--hidden 3072 --heads 24 --double 19
+# --single 38 --context-dim 4096) for realistic timings.
+#
+#   python -m benchmarks.flux_residual_cache --size 512 --steps 20 --thresholds 0.1 0.25 0.4
+
+import argparse
+import time
+import torch
+
+from backend.nn.flux import IntegratedFluxTransformer2DModel
+
+
+def sample(model, noise, context, y, guidance, sigmas, threshold):
+    model.residual_cache.begin(threshold)
+    model.residual_cache.reset_stats()
+    model.conditioning_cache.begin()
+
+    x = noise
+    try:
+        for sigma, sigma_next in zip(sigmas[:-1], sigmas[1:]):
+            t = sigma.expand(x.shape[0])
+            v = model(x, t, context=context, y=y, guidance=guidance)
+            x = x + (sigma_next - sigma) * v
+    finally:
+        model.residual_cache.end()
+        model.conditioning_cache.end()
+
+    return x
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512, help='image size in pixels')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.1, 0.25, 0.4, 0.6])
+    parser.add_argument('--hidden', type=int, default=512)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--double', type=int, default=4)
+    parser.add_argument('--single', type=int, default=8)
+    parser.add_argument('--context-dim', type=int, default=512)
+    parser.add_argument('--txt-len', type=int, default=256)
+    parser.add_argument('--shift', type=float, default=3.0, help='timestep shift of the schedule')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'bfloat16'])
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+
+    head_dim = args.hidden // args.heads
+    axes_dim = [head_dim - 2 * (head_dim * 7 // 16), head_dim * 7 // 16, head_dim * 7 // 16]  # 16/56/56 for 128
+    model = IntegratedFluxTransformer2DModel(
+        in_channels=16, vec_in_dim=768, context_in_dim=args.context_dim, hidden_size=args.hidden, mlp_ratio=4.0,
+        num_heads=args.heads, depth=args.double, depth_single_blocks=args.single, axes_dim=axes_dim, theta=10000,
+        qkv_bias=True, guidance_embed=True,
+    ).to(device=device, dtype=dtype).eval()
+
+    latent = args.size // 8
+    noise = torch.randn(args.batch, 16, latent, latent, device=device, dtype=dtype)
+    context = torch.randn(args.batch, args.txt_len, args.context_dim, device=device, dtype=dtype)
+    y = torch.randn(args.batch, 768, device=device, dtype=dtype)
+    guidance = torch.full((args.batch,), 3.5, device=device, dtype=dtype)
+
+    sigmas = torch.linspace(1, 0, args.steps + 1, device=device)
+    sigmas = (args.shift * sigmas / (1 + (args.shift - 1) * sigmas)).to(dtype)
+
+    print(f'{args.size}x{args.size}, {args.steps} steps, batch {args.batch}, hidden {args.hidden}, '
+          f'{args.double}+{args.single} blocks, {args.dtype} on {args.device}')
+
+    with torch.no_grad():
+        sample(model, noise, context, y, guidance, sigmas[:3], 0)  # warm up
+
+        results = []
+        for threshold in [0] + args.thresholds:
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            out = sample(model, noise, context, y, guidance, sigmas, threshold)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            results.append((threshold, time.perf_counter() - start, out.float(), model.residual_cache.skipped, model.residual_cache.calls))
+
+    _, reference_time, reference, _, _ = results[0]
+    print(f'full: {reference_time:.2f} s')
+
+    for threshold, elapsed, out, skipped, calls in results[1:]:
+        mse = (out - reference).pow(2).mean().item()
+        psnr = 10 * torch.log10(reference.pow(2).max() / max(mse, 1e-20)).item()
+        print(f'threshold {threshold}: {elapsed:.2f} s ({reference_time / elapsed:.2f}x), skipped {skipped}/{calls}, '
+              f'mse {mse:.2e}, psnr {psnr:.1f} dB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# CPU micro-benchmark of the Flux rotary embeddings: position ids and EmbedND rebuilt on every step, as forward did,
+# versus PositionEmbeddingCache. Uses the Flux dev settings (theta 10000, axes 16/56/56, 512 text tokens).
+#
+#   python -m benchmarks.flux_rope --sizes 1024 1280 --steps 20
+
+import argparse
+import time
+import torch
+
+from backend.nn.flux import EmbedND, PositionEmbeddingCache, build_position_ids
+
+
+def per_step(pe_embedder, bs, h_len, w_len, txt_len, dtype):
+    img_ids, txt_ids = build_position_ids(bs, h_len, w_len, txt_len, torch.device('cpu'), dtype)
+    return pe_embedder(torch.cat((txt_ids, img_ids), dim=1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 1280], help='image sizes in pixels')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--txt-len', type=int, default=512)
+    parser.add_argument('--dtype', default='bfloat16', choices=['float32', 'float16', 'bfloat16'])
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    pe_embedder = EmbedND(dim=128, theta=10000, axes_dim=[16, 56, 56])
+    print(f'{args.steps} steps, batch {args.batch}, {args.txt_len} text tokens, ids in {args.dtype}, threads={torch.get_num_threads()}')
+
+    for size in args.sizes:
+        h_len = w_len = size // 16  # VAE downscale 8, patch size 2
+        cache = PositionEmbeddingCache()
+
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            reference = per_step(pe_embedder, args.batch, h_len, w_len, args.txt_len, dtype)
+        uncached = (time.perf_counter() - start) / args.steps
+
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            cached = cache.get(pe_embedder, h_len, w_len, args.txt_len, torch.device('cpu'), dtype)
+        cached_time = (time.perf_counter() - start) / args.steps
+
+        max_error = (reference - cached).abs().max().item()
+        print(f'{size}x{size}: {uncached * 1000:.2f} ms per step uncached, {cached_time * 1000:.3f} ms cached '
+              f'({cache.used / (1024 * 1024):.1f} MB held), max abs difference {max_error:.1e}')
+
+
+if __name__ == '__main__':
+    main()
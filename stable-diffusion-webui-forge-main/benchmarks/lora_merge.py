@@ -0,0 +1,93 @@
+# CPU benchmark of LoRA merging: one merge_lora_to_weight per key versus BatchedLoraMerger, which computes the diffs of
+# same-shape factors with grouped bmm. Shapes follow the Flux transformer (19 double blocks, 38 single blocks); use
+# --width to shrink them. --chunk-mb 0 sizes the windows from free memory, as LoraLoader does.
+#
+#   python -m benchmarks.lora_merge --rank 16 --width 3072
+
+import argparse
+import time
+import torch
+
+from backend.patcher.lora import merge_lora_to_weight, BatchedLoraMerger
+
+
+def flux_like_shapes(width, mlp_ratio=4):
+    shapes = {}
+    for i in range(19):
+        for stream in ['img', 'txt']:
+            shapes[f'double_blocks.{i}.{stream}_attn.qkv.weight'] = (width * 3, width)
+            shapes[f'double_blocks.{i}.{stream}_attn.proj.weight'] = (width, width)
+            shapes[f'double_blocks.{i}.{stream}_mlp.0.weight'] = (width * mlp_ratio, width)
+            shapes[f'double_blocks.{i}.{stream}_mlp.2.weight'] = (width, width * mlp_ratio)
+    for i in range(38):
+        shapes[f'single_blocks.{i}.linear1.weight'] = (width * (3 + mlp_ratio), width)
+        shapes[f'single_blocks.{i}.linear2.weight'] = (width, width * (1 + mlp_ratio))
+    return shapes
+
+
+def make_model(weights):
+    model = torch.nn.Module()
+    for key, weight in weights.items():
+        *path, name = key.split('.')
+        module = model
+        for part in path:
+            if not hasattr(module, part):
+                module.add_module(part, torch.nn.Module())
+            module = getattr(module, part)
+        module.register_parameter(name, torch.nn.Parameter(weight, requires_grad=False))
+    return model
+
+
+def make_patches(shapes, rank, dtype):
+    weights = {}
+    patches = {}
+    for key, (out_features, in_features) in shapes.items():
+        weights[key] = torch.randn(out_features, in_features, dtype=dtype) * 0.02
+        up = torch.randn(out_features, rank, dtype=dtype) * 0.02
+        down = torch.randn(rank, in_features, dtype=dtype) * 0.02
+        patches[key] = [[0.8, ("lora", (up, down, float(rank), None, None)), 1.0, None, None]]
+    return weights, patches
+
+
+def run_per_key(weights, patches):
+    return {key: merge_lora_to_weight(patches[key], weights[key], key) for key in weights}
+
+
+def run_batched(model, weights, patches, max_chunk_bytes):
+    merger = BatchedLoraMerger(model, {(key, False): patches[key] for key in weights}, max_chunk_bytes=max_chunk_bytes)
+    return {key: merge_lora_to_weight(merger.prepare(key, patches[key]), weights[key], key) for key in weights}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=768, help='hidden size; Flux uses 3072')
+    parser.add_argument('--rank', type=int, default=16)
+    parser.add_argument('--dtype', default='bfloat16', choices=['float32', 'float16', 'bfloat16'])
+    parser.add_argument('--chunk-mb', type=int, default=0, help='window size; 0 sizes it from free memory')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    shapes = flux_like_shapes(args.width)
+    weights, patches = make_patches(shapes, args.rank, dtype)
+    model = make_model(weights)
+    max_chunk_bytes = args.chunk_mb * 1024 * 1024 or None
+    print(f'{len(shapes)} keys, width={args.width}, rank={args.rank}, dtype={args.dtype}, threads={torch.get_num_threads()}')
+
+    timings = {}
+    results = {}
+    for name, fn in [('per-key', lambda: run_per_key(weights, patches)), ('batched', lambda: run_batched(model, weights, patches, max_chunk_bytes))]:
+        fn()
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            result = fn()
+        timings[name] = (time.perf_counter() - start) / args.repeats
+        results[name] = result
+        print(f'{name}: {timings[name]:.3f} s')
+
+    max_error = max((results['per-key'][k].float() - results['batched'][k].float()).abs().max().item() for k in shapes)
+    print(f'speedup: {timings["per-key"] / timings["batched"]:.2f}x, max abs difference: {max_error:.3e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,10 @@ import traceback
 
 import torch
 import network
-import functools
+import threading
+import safetensors
 
+from collections import OrderedDict
 from backend.args import dynamic_args
 from modules import shared, sd_models, errors, scripts
 from backend.utils import load_torch_file
@@ -15,21 +17,28 @@ from backend.patcher.lora import model_lora_keys_clip, model_lora_keys_unet, loa
 
 
 def load_lora_for_models(model, clip, lora, strength_model, strength_clip, filename='default', online_mode=False):
+    """lora is either a state dict or a filename; a filename is loaded through the cache, reading only the keys this model uses."""
+
     model_flag = type(model.model).__name__ if model is not None else 'default'
 
     unet_keys = model_lora_keys_unet(model.model) if model is not None else {}
     clip_keys = model_lora_keys_clip(clip.cond_stage_model) if clip is not None else {}
 
+    if isinstance(lora, str):
+        lora = load_lora_state_dict(lora, to_load={**unet_keys, **clip_keys})
+
     lora_unmatch = lora
     lora_unet, lora_unmatch = load_lora(lora_unmatch, unet_keys)
     lora_clip, lora_unmatch = load_lora(lora_unmatch, clip_keys)
 
-    if len(lora_unmatch) > 12:
+    unmatched_keys = list(lora_unmatch.keys()) + getattr(lora, 'skipped_keys', [])
+
+    if len(unmatched_keys) > 12:
         print(f'[LORA] LoRA version mismatch for {model_flag}: {filename}')
         return model, clip
 
-    if len(lora_unmatch) > 0:
-        print(f'[LORA] Loading {filename} for {model_flag} with unmatched keys {list(lora_unmatch.keys())}')
+    if len(unmatched_keys) > 0:
+        print(f'[LORA] Loading {filename} for {model_flag} with unmatched keys {unmatched_keys}')
 
     new_model = model.clone() if model is not None else None
     new_clip = clip.clone() if clip is not None else None
@@ -55,9 +64,106 @@ def load_lora_for_models(model, clip, lora, strength_model, strength_clip, filen
     return model, clip
 
 
-@functools.lru_cache(maxsize=5)
-def load_lora_state_dict(filename):
-    return load_torch_file(filename, safe_load=True)
+class LoraStateDict(dict):
+    """Tensors of a LoRA file; skipped_keys lists the keys that were not read because no model layer uses them."""
+
+    skipped_keys = []
+
+
+def lora_key_is_used(key, to_load):
+    # load_lora looks up "{x}.<suffix>" and "{x}_lora.<suffix>" for every x in to_load
+    if '_lora.' in key and key[:key.index('_lora.')] in to_load:
+        return True
+
+    position = key.find('.')
+    while position != -1:
+        if key[:position] in to_load:
+            return True
+        position = key.find('.', position + 1)
+
+    return False
+
+
+class LoraStateDictCache:
+    """
+    Byte-budgeted cache of LoRA tensors per file, invalidated when the file's mtime or size changes.
+    Safetensors files are memory-mapped and only the requested keys are read and kept.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # filename -> (stamp, tensors, complete)
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tensors_size(tensors):
+        return sum(x.numel() * x.element_size() for x in tensors.values() if isinstance(x, torch.Tensor))
+
+    def drop(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.current_bytes -= self.tensors_size(entry[1])
+
+    def get(self, filename, to_load=None):
+        stat = os.stat(filename)
+        stamp = (stat.st_mtime, stat.st_size)
+
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and entry[0] != stamp:
+                self.drop(filename)
+                entry = None
+
+            tensors = dict(entry[1]) if entry is not None else {}
+            complete = entry[2] if entry is not None else False
+
+        lazy = filename.lower().endswith('.safetensors') and to_load is not None and getattr(shared.opts, 'lora_lazy_load', True)
+
+        if not lazy:
+            if not complete:
+                tensors = load_torch_file(filename, safe_load=True)
+                complete = True
+            result = LoraStateDict(tensors)
+        else:
+            with safetensors.safe_open(filename, framework='pt', device='cpu') as f:
+                keys = list(f.keys())
+
+                # BFL control LoRAs are renamed inside load_lora, so they cannot be filtered by name
+                if 'img_in.lora_A.weight' in keys:
+                    used_keys = keys
+                else:
+                    used_keys = [k for k in keys if lora_key_is_used(k, to_load)]
+
+                for k in used_keys:
+                    if k not in tensors:
+                        tensors[k] = f.get_tensor(k)
+
+            result = LoraStateDict({k: tensors[k] for k in used_keys})
+            result.skipped_keys = [k for k in keys if k not in result]
+            complete = complete or len(tensors) == len(keys)
+
+        with self.lock:
+            self.drop(filename)
+            size = self.tensors_size(tensors)
+            if size <= self.max_bytes:
+                self.entries[filename] = (stamp, tensors, complete)
+                self.current_bytes += size
+            while self.current_bytes > self.max_bytes and len(self.entries) > 0:
+                oldest = next(iter(self.entries))
+                self.drop(oldest)
+
+        return result
+
+
+lora_state_dict_cache = LoraStateDictCache(max_bytes=2048 * 1024 * 1024)
+
+
+def load_lora_state_dict(filename, to_load=None):
+    """Loads a LoRA file through the cache; with to_load (a lora key map), only the keys used by those layers are read."""
+
+    lora_state_dict_cache.max_bytes = int(getattr(shared.opts, 'lora_state_dict_cache_mb', 2048)) * 1024 * 1024
+    return lora_state_dict_cache.get(filename, to_load=to_load)
 
 
 def load_network(name, network_on_disk):
@@ -124,11 +230,10 @@ def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=No
     current_sd.forge_objects.clip = current_sd.forge_objects_original.clip
 
     for filename, strength_model, strength_clip, online_mode in compiled_lora_targets:
-        lora_sd = load_lora_state_dict(filename)
         current_sd.forge_objects.unet, current_sd.forge_objects.clip = load_lora_for_models(
             current_sd.forge_objects.unet,
             current_sd.forge_objects.clip,
-            lora_sd,
+            filename,
             strength_model,
             strength_clip,
             filename=filename,
@@ -29,6 +29,8 @@ shared.options_templates.update(shared.options_section(('extra_networks', "Extra
     "lora_bundled_ti_to_infotext": shared.OptionInfo(True, "Add Lora name as TI hashes for bundled Textual Inversion").info('"Add Textual Inversion hashes to infotext" needs to be enabled'),
     "lora_filter_disabled": shared.OptionInfo(True, "Always show all networks on the Lora page").info("otherwise, those detected as for incompatible version of Stable Diffusion will be hidden"),
     "lora_in_memory_limit": shared.OptionInfo(0, "Number of Lora networks to keep cached in memory", gr.Number, {"precision": 0}),
+    "lora_state_dict_cache_mb": shared.OptionInfo(2048, "Size of Lora tensor cache in memory (MB)", gr.Number, {"precision": 0}).info("files are reloaded if they change on disk"),
+    "lora_lazy_load": shared.OptionInfo(True, "Read only the Lora tensors used by the current model").info("safetensors only; e.g. skips CLIP keys if the model has no matching text encoder layers"),
     "lora_not_found_warning_console": shared.OptionInfo(False, "Lora not found warning in console"),
     "lora_not_found_gradio_warning": shared.OptionInfo(False, "Lora not found warning popup in webui"),
 }))
@@ -15,6 +15,8 @@ import requests
 import gradio as gr
 from threading import Lock
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from fastapi import APIRouter, Depends, FastAPI, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
@@ -25,6 +27,8 @@ from secrets import compare_digest
 import modules.shared as shared
 from modules import sd_samplers, deepbooru, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models, sd_schedulers
 from modules.api import models
+from modules.api.batching import RequestBatcher, BatchItem, merge_items, split_processed
+from modules_forge import main_thread
 from modules.shared import opts
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images, process_extra_images
 import modules.textual_inversion.textual_inversion
@@ -166,6 +170,34 @@ def encode_pil_to_base64(image):
     return base64.b64encode(bytes_data)
 
 
+def encode_images_to_base64(images, max_workers=None):
+    """Encodes a batch of images; with max_workers > 1 the PNG/JPEG/WebP encoders run on a thread pool (they release the GIL)."""
+    if not max_workers or max_workers <= 1 or len(images) <= 1:
+        return list(map(encode_pil_to_base64, images))
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(images))) as executor:
+        return list(executor.map(encode_pil_to_base64, images))
+
+
+def pack_result_images(images, result_type="base64", encode_workers=None):
+    """
+    Converts processed images into what the caller asked for:
+    - "base64": encoded files, as returned over HTTP
+    - "pil": the PIL images themselves, for in-process callers that encode the output once on their own
+    - "numpy": HxWxC uint8 arrays
+    """
+    if result_type == "base64":
+        return encode_images_to_base64(images, max_workers=encode_workers)
+
+    if result_type == "pil":
+        return list(images)
+
+    if result_type == "numpy":
+        return [np.asarray(image, dtype=np.uint8) for image in images]
+
+    raise HTTPException(status_code=500, detail=f"Invalid result type: {result_type}")
+
+
 def api_middleware(app: FastAPI):
     rich_available = False
     try:
@@ -244,6 +276,7 @@ class Api:
         self.router = APIRouter()
         self.app = app
         self.queue_lock = queue_lock
+        self.batcher = RequestBatcher(queue_lock)
         #api_middleware(self.app)  # FIXME: (legacy) this will have to be fixed
         self.add_api_route("/sdapi/v1/txt2img", self.text2imgapi, methods=["POST"], response_model=models.TextToImageResponse)
         self.add_api_route("/sdapi/v1/img2img", self.img2imgapi, methods=["POST"], response_model=models.ImageToImageResponse)
@@ -274,6 +307,7 @@ class Api:
         self.add_api_route("/sdapi/v1/create/embedding", self.create_embedding, methods=["POST"], response_model=models.CreateResponse)
         self.add_api_route("/sdapi/v1/create/hypernetwork", self.create_hypernetwork, methods=["POST"], response_model=models.CreateResponse)
         self.add_api_route("/sdapi/v1/memory", self.get_memory, methods=["GET"], response_model=models.MemoryResponse)
+        self.add_api_route("/sdapi/v1/main-thread", self.get_main_thread_metrics, methods=["GET"])
         self.add_api_route("/sdapi/v1/unload-checkpoint", self.unloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/reload-checkpoint", self.reloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
@@ -551,15 +585,54 @@ class Api:
             else:
                 print(f"Warning: Could not find Flux checkpoint {flux_checkpoint_name}")
 
+    @staticmethod
+    def txt2img_batch_key(txt2imgreq, args, extra_network_data, additional_modules, extra_network_key=None):
+        """Requests with the same key only differ in prompts and seeds and can share a batch; None if it cannot be shared."""
+
+        if opts.api_batch_window_ms <= 0 or opts.api_batch_max_images <= 1:
+            return None
+
+        if txt2imgreq.script_name or txt2imgreq.alwayson_scripts or txt2imgreq.script_args:
+            return None
+
+        if args.get('n_iter', 1) != 1 or args.get('subseed_strength', 0) != 0 or args.get('batch_size', 1) >= opts.api_batch_max_images:
+            return None
+
+        if not all(isinstance(args.get(k), str) for k in ['prompt', 'negative_prompt']):
+            return None
+
+        if callable(extra_network_data):
+            if extra_network_key is None:
+                return None
+            loras = extra_network_key
+        elif extra_network_data is None or set(extra_network_data.keys()) - {'lora'}:
+            return None
+        else:
+            loras = tuple(tuple(x.items) for x in extra_network_data.get('lora', []))
+
+        shared_args = {k: v for k, v in args.items() if k not in ['prompt', 'negative_prompt', 'seed', 'subseed', 'batch_size', 'force_task_id']}
+
+        return repr(sorted(shared_args.items(), key=lambda x: x[0])), loras, repr(additional_modules)
+
     def text2imgapi(
         self,
         txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI,
         extra_network_data=None,
         additional_modules=None,
+        result_type="base64",
+        encode_workers=None,
+        extra_network_key=None,
     ):
-        with catchtime(tag="load_flux first time"):
+        """
+        result_type other than "base64" is only meant for in-process callers (e.g. the Cog predictor): the response
+        then carries PIL images or uint8 arrays as-is, skipping the encode/decode round-trip.
+
+        extra_network_data may also be a callable returning it; it is called once the model is loaded, so callers can
+        keep downloading LoRAs while the checkpoint loads. Such requests are only batched together when they pass the
+        same extra_network_key, which must identify the extra networks the callable will return.
+        """
+        with catchtime(tag="load_clip_etc"):
             additional_modules = self.load_clip_etc(additional_modules=additional_modules)
-            self.load_flux(additional_modules=additional_modules)
 
         print(f"v2 TEST TEST TEST\n\n\n\n\n\n\n{txt2imgreq.dict()=}\n\n\n\n\n\n\n")
         task_id = txt2imgreq.force_task_id or create_task_id("txt2img")
@@ -607,7 +680,15 @@ class Api:
         add_task_to_queue(task_id)
         print(f"new {args=}")
 
-        with self.queue_lock:
+        # the model is (re)loaded in the same locked section as the run, so a concurrent request with other
+        # additional_modules cannot reload it in between; a batch shares the additional_modules and extra networks of
+        # its key. A callable extra_network_data is resolved only after the load, so LoRA downloads overlap it.
+        def run(args, task_ids):
+            with catchtime(tag="load_flux"):
+                self.load_flux(additional_modules=additional_modules)
+
+            networks = extra_network_data() if callable(extra_network_data) else extra_network_data
+
             with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
                 p.is_api = True
                 p.scripts = script_runner
@@ -616,9 +697,10 @@ class Api:
 
                 try:
                     shared.state.begin(job="scripts_txt2img")
-                    start_task(task_id)
+                    for x in task_ids:
+                        start_task(x)
 
-                    extra_networks_lora.ExtraNetworkLora().activate(p, extra_network_data['lora'])
+                    extra_networks_lora.ExtraNetworkLora().activate(p, networks['lora'])
                     p.script_args = tuple(script_args)  # Need to pass args as tuple here
 
                     with catchtime(tag="processed = process_images(p)"):
@@ -627,7 +709,8 @@ class Api:
                     with catchtime(tag="process_extra_images(processed)"):
                         process_extra_images(processed)
 
-                    finish_task(task_id)
+                    for x in task_ids:
+                        finish_task(x)
                 except Exception as e:
                     print(f"Failed to process images: {e}")
                     traceback.print_tb(e.__traceback__)
@@ -637,7 +720,31 @@ class Api:
                     shared.state.end()
                     shared.total_tqdm.clear()
 
-        b64images = list(map(encode_pil_to_base64, processed.images + processed.extra_images)) if send_images else []
+            return processed
+
+        batch_key = self.txt2img_batch_key(txt2imgreq, args, extra_network_data, additional_modules, extra_network_key)
+
+        if batch_key is None:
+            with self.queue_lock:
+                processed = main_thread.run_in_main_thread(run, args, [task_id])
+        else:
+            def run_batch(items):
+                if len(items) == 1:
+                    return [main_thread.run_in_main_thread(run, items[0].payload[0], [items[0].payload[1]])]
+
+                merged = dict(items[0].payload[0], **merge_items(items))
+                return split_processed(main_thread.run_in_main_thread(run, merged, [x.payload[1] for x in items]), items)
+
+            self.batcher.window = max(float(opts.api_batch_window_ms), 0) / 1000
+            self.batcher.max_images = max(int(opts.api_batch_max_images), 1)
+            item = BatchItem(batch_key, args['prompt'], args['negative_prompt'], args['seed'], args['subseed'], args['batch_size'], payload=(args, task_id))
+            processed = self.batcher.run(item, run_batch)
+
+        if result_type != "base64":
+            images = pack_result_images(processed.images + processed.extra_images, result_type) if send_images else []
+            return models.TextToImageResponse.model_construct(images=images, parameters=vars(txt2imgreq), info=processed.js())
+
+        b64images = encode_images_to_base64(processed.images + processed.extra_images, max_workers=encode_workers) if send_images else []
         return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
 
     def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
@@ -701,7 +808,7 @@ class Api:
                         processed = scripts.scripts_img2img.run(p, *p.script_args) # Need to pass args as list here
                     else:
                         p.script_args = tuple(script_args)
-                        processed = process_images(p)
+                        processed = main_thread.run_in_main_thread(process_images, p)
                     process_extra_images(processed)
                     finish_task(task_id)
                 finally:
@@ -937,6 +1044,9 @@ class Api:
         finally:
             shared.state.end()
 
+    def get_main_thread_metrics(self):
+        return main_thread.metrics.js()
+
     def get_memory(self):
         try:
             import os
@@ -0,0 +1,138 @@
+import copy
+import threading
+import time
+
+from modules.processing import get_fixed_seed
+
+
+class BatchItem:
+    def __init__(self, key, prompt, negative_prompt, seed, subseed, batch_size, payload):
+        self.key = key
+        self.batch_size = batch_size
+        self.prompts = [prompt] * batch_size
+        self.negative_prompts = [negative_prompt] * batch_size
+
+        # resolved here so every request keeps the seeds it would have gotten when run alone
+        seed = get_fixed_seed(seed)
+        subseed = get_fixed_seed(subseed)
+        self.seeds = [int(seed) + i for i in range(batch_size)]
+        self.subseeds = [int(subseed) + i for i in range(batch_size)]
+
+        self.payload = payload
+        self.leader = False
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class RequestBatcher:
+    """
+    Coalesces compatible requests into one batched run. The first request of a key becomes the leader: it waits
+    `window` seconds, then for the processing lock, and takes every request of the same key that arrived meanwhile, up
+    to `max_images` images. The others wait for the leader to hand them their share of the result. Requests that do
+    not fit are led by the next one in line.
+    """
+
+    def __init__(self, lock, window=0.05, max_images=4):
+        self.lock = lock
+        self.window = window
+        self.max_images = max_images
+        self.condition = threading.Condition()
+        self.pending = {}
+
+    def run(self, item, execute):
+        """execute(items) runs a batch and returns one result per item; it is called with the processing lock held."""
+
+        with self.condition:
+            group = self.pending.setdefault(item.key, [])
+            group.append(item)
+            item.leader = len(group) == 1
+
+            while not item.leader and not item.done:
+                self.condition.wait()
+
+        if not item.done:
+            self.lead(item, execute)
+
+        if item.error is not None:
+            raise item.error
+
+        return item.result
+
+    def lead(self, item, execute):
+        if self.window > 0:
+            time.sleep(self.window)
+
+        with self.lock:
+            with self.condition:
+                group = self.pending.pop(item.key)
+                batch = [group.pop(0)]
+                while group and sum(x.batch_size for x in batch) + group[0].batch_size <= self.max_images:
+                    batch.append(group.pop(0))
+
+                if group:
+                    self.pending[item.key] = group
+                    group[0].leader = True
+                    self.condition.notify_all()
+
+            if len(batch) > 1:
+                print(f'[Batching] Running {len(batch)} requests ({sum(x.batch_size for x in batch)} images) as one batch')
+
+            try:
+                results = execute(batch)
+                for x, result in zip(batch, results):
+                    x.result = result
+            except Exception as e:
+                for x in batch:
+                    x.error = e
+
+        with self.condition:
+            for x in batch:
+                x.done = True
+            self.condition.notify_all()
+
+
+def merge_items(items):
+    """Per-image prompt and seed lists for one run covering all items, which setup_prompts and process_images take as-is."""
+
+    return dict(
+        prompt=[p for x in items for p in x.prompts],
+        negative_prompt=[p for x in items for p in x.negative_prompts],
+        seed=[s for x in items for s in x.seeds],
+        subseed=[s for x in items for s in x.subseeds],
+        batch_size=sum(x.batch_size for x in items),
+    )
+
+
+def split_processed(processed, items):
+    """Cuts a Processed of a merged run back into one Processed per item, in the same order."""
+
+    if len(items) == 1:
+        return [processed]
+
+    # a grid of the merged run would mix requests, it is dropped
+    offset = processed.index_of_first_image
+    results = []
+    start = 0
+
+    for x in items:
+        end = start + x.batch_size
+        part = copy.copy(processed)
+        part.images = processed.images[offset + start:offset + end]
+        part.extra_images = []
+        part.all_prompts = processed.all_prompts[start:end]
+        part.all_negative_prompts = processed.all_negative_prompts[start:end]
+        part.all_seeds = processed.all_seeds[start:end]
+        part.all_subseeds = processed.all_subseeds[start:end]
+        part.infotexts = processed.infotexts[offset + start:offset + end]
+        part.prompt = part.all_prompts[0]
+        part.negative_prompt = part.all_negative_prompts[0]
+        part.seed = part.all_seeds[0]
+        part.subseed = part.all_subseeds[0]
+        part.info = part.infotexts[0] if part.infotexts else processed.info
+        part.batch_size = x.batch_size
+        part.index_of_first_image = 0
+        results.append(part)
+        start = end
+
+    return results
@@ -1,20 +1,52 @@
 import hashlib
+import mmap
 import os.path
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from modules import shared
 import modules.cache
 
 dump_cache = modules.cache.dump_cache
 cache = modules.cache.cache
 
+sha256_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sha256")
+sha256_futures = {}
+sha256_futures_lock = threading.Lock()
+
 
 def calculate_sha256_real(filename):
+    hash_sha256 = hashlib.sha256()
+    blksize = 64 * 1024 * 1024
+
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hash_sha256.hexdigest()
+
+        # large slices of a mapping are hashed without copying them and with the GIL released
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+            for start in range(0, len(view), blksize):
+                hash_sha256.update(view[start:start + blksize])
+
+    return hash_sha256.hexdigest()
+
+
+def calculate_fingerprint_real(filename, samples=16):
+    """Cheap content hash: file size, safetensors header and evenly spaced 1MB blocks; not compatible with sha256."""
+
     hash_sha256 = hashlib.sha256()
     blksize = 1024 * 1024
+    size = os.path.getsize(filename)
+    hash_sha256.update(str(size).encode('utf-8'))
 
     with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+        if filename.lower().endswith(".safetensors"):
+            n = int.from_bytes(f.read(8), "little")
+            hash_sha256.update(f.read(n))
+
+        for i in range(samples):
+            f.seek(max(size - blksize, 0) * i // max(samples - 1, 1))
+            hash_sha256.update(f.read(blksize))
 
     return hash_sha256.hexdigest()
 
@@ -74,6 +106,41 @@ def sha256(filename, title, use_addnet_hash=False):
     return sha256_value
 
 
+def fingerprint(filename, title):
+    hashes = cache("hashes-fingerprint")
+
+    try:
+        ondisk_mtime = os.path.getmtime(filename)
+    except FileNotFoundError:
+        return None
+
+    if title in hashes and hashes[title].get("mtime", 0) >= ondisk_mtime:
+        return hashes[title]["fingerprint"]
+
+    fingerprint_value = calculate_fingerprint_real(filename)
+
+    hashes[title] = {
+        "mtime": ondisk_mtime,
+        "fingerprint": fingerprint_value,
+    }
+
+    return fingerprint_value
+
+
+def sha256_async(filename, title):
+    """Computes sha256() in a background thread; concurrent calls for the same title share one future."""
+
+    with sha256_futures_lock:
+        future = sha256_futures.get(title)
+        if future is not None and not future.done():
+            return future
+
+        future = sha256_executor.submit(sha256, filename, title)
+        sha256_futures[title] = future
+
+    return future
+
+
 def addnet_hash_safetensors(b):
     """kohya-ss hash for safetensors from https://github.com/kohya-ss/sd-scripts/blob/main/library/train_util.py"""
     hash_sha256 = hashlib.sha256()
@@ -31,10 +31,10 @@ import modules.sd_vae as sd_vae
 
 from einops import repeat, rearrange
 from blendmodes.blend import blendLayers, BlendType
-from modules.sd_models import apply_token_merging, forge_model_reload
+from modules.sd_models import apply_token_merging, apply_residual_cache, forge_model_reload
 from modules_forge.utils import apply_circular_forge
 from modules_forge import main_entry
-from backend import memory_management
+from backend import memory_management, compilation
 from backend.modules.k_prediction import rescale_zero_terminal_snr_sigmas
 
 
@@ -141,6 +141,7 @@ class StableDiffusionProcessing:
     steps: int = 50
     cfg_scale: float = 7.0
     distilled_cfg_scale: float = 3.5
+    residual_cache_threshold: float = 0.0
     width: int = 512
     height: int = 512
     restore_faces: bool = None
@@ -844,6 +845,13 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
         sd_samplers.fix_p_invalid_sampler_and_scheduler(p)
         print(f"fix_p_invalid_sampler_and_scheduler after Processing images. {p.extra_network_data=}")
 
+        # sizes near a compiled resolution bucket use its graphs instead of running eagerly
+        if compilation.enabled and hasattr(shared.sd_model.forge_objects.unet.model.diffusion_model, 'compiled_blocks'):
+            width, height = compilation.snap(p.width, p.height)
+            if (width, height) != (p.width, p.height):
+                print(f'[Compile] Snapped {p.width}x{p.height} to the {width}x{height} bucket')
+                p.width, p.height = width, height
+
         with profiling.Profiler():
             print("Running process_images_inner")
             res = process_images_inner(p)
@@ -998,8 +1006,16 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 sigmas_backup = p.sd_model.forge_objects.unet.model.predictor.sigmas
                 p.sd_model.forge_objects.unet.model.predictor.set_sigmas(rescale_zero_terminal_snr_sigmas(p.sd_model.forge_objects.unet.model.predictor.sigmas))
 
+            # the threshold is applied by sample() and sample_hr_pass() after they reset forge_objects
+            residual_cache = getattr(p.sd_model.forge_objects.unet.model.diffusion_model, 'residual_cache', None)
+            if p.residual_cache_threshold and residual_cache is not None and n == 0:
+                residual_cache.reset_stats()
+
             samples_ddim = p.sample(conditioning=p.c, unconditional_conditioning=p.uc, seeds=p.seeds, subseeds=p.subseeds, subseed_strength=p.subseed_strength, prompts=p.prompts)
 
+            if p.residual_cache_threshold and residual_cache is not None and residual_cache.calls > 0:
+                p.extra_generation_params['Residual cache'] = f'{p.residual_cache_threshold}, skipped {residual_cache.skipped}/{residual_cache.calls}'
+
             for x_sample in samples_ddim:
                 p.latents_after_sampling.append(x_sample)
 
@@ -1383,6 +1399,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
 
             self.sd_model.forge_objects = self.sd_model.forge_objects_after_applying_lora.shallow_copy()
             apply_token_merging(self.sd_model, self.get_token_merging_ratio())
+            apply_residual_cache(self.sd_model, self.residual_cache_threshold)
 
             if self.scripts is not None:
                 self.scripts.process_before_every_sampling(self,
@@ -1528,6 +1545,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
 
         self.sd_model.forge_objects = self.sd_model.forge_objects_after_applying_lora.shallow_copy()
         apply_token_merging(self.sd_model, self.get_token_merging_ratio(for_hr=True))
+        apply_residual_cache(self.sd_model, self.residual_cache_threshold)
 
         if self.scripts is not None:
             self.scripts.process_before_every_sampling(self,
@@ -1861,6 +1879,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
 
         self.sd_model.forge_objects = self.sd_model.forge_objects_after_applying_lora.shallow_copy()
         apply_token_merging(self.sd_model, self.get_token_merging_ratio())
+        apply_residual_cache(self.sd_model, self.residual_cache_threshold)
 
         if self.scripts is not None:
             self.scripts.process_before_every_sampling(self,
@@ -22,6 +22,9 @@ from backend.loader import forge_loader
 from backend import memory_management
 from backend.args import dynamic_args
 from backend.utils import load_torch_file
+from backend.text_processing import cond_cache
+from backend.patcher import lora_cache
+from backend import dequant_cache, placement, compilation, attention
 
 
 model_dir = "Stable-diffusion"
@@ -133,6 +136,28 @@ class CheckpointInfo:
 
         return self.shorthash
 
+    def calculate_shorthash_nonblocking(self, background_sha256=True):
+        """
+        Returns the sha256 shorthash if it is already known, otherwise a shorthash of hashes.fingerprint without
+        reading the whole file. With background_sha256, the real hash is computed in a background thread; the returned
+        future calls calculate_shorthash() when done.
+        """
+
+        if shared.cmd_opts.no_hashing:
+            return None, None
+
+        title = f"checkpoint/{self.name}"
+
+        if hashes.sha256_from_cache(self.filename, title) is not None:
+            return self.calculate_shorthash(), None
+
+        future = None
+        if background_sha256:
+            future = hashes.sha256_async(self.filename, title)
+
+        fingerprint = hashes.fingerprint(self.filename, title)
+        return (fingerprint[0:10] if fingerprint else None), future
+
     def __str__(self):
         return str(dict(filename=self.filename, hash=self.hash))
 
@@ -469,6 +494,27 @@ def apply_token_merging(sd_model, token_merging_ratio):
     return
 
 
+def apply_residual_cache(sd_model, threshold):
+    if not threshold or getattr(sd_model.forge_objects.unet.model.diffusion_model, 'residual_cache', None) is None:
+        return
+
+    unet = sd_model.forge_objects.unet.clone()
+    unet.set_residual_cache_threshold(threshold)
+    sd_model.forge_objects.unet = unet
+
+    return
+
+
+def use_full_checkpoint_hash(sd_model, checkpoint_info):
+    shorthash = checkpoint_info.calculate_shorthash()
+
+    if shorthash is None or model_data.sd_model is not sd_model:
+        return
+
+    sd_model.sd_model_hash = shorthash
+    shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
+
+
 @torch.inference_mode()
 def forge_model_reload(force: bool = False):
     current_hash = str(model_data.forge_loading_parameters)
@@ -509,9 +555,35 @@ def forge_model_reload(force: bool = False):
     sd_model.comments = []
     sd_model.sd_checkpoint_info = checkpoint_info
     sd_model.filename = checkpoint_info.filename
-    sd_model.sd_model_hash = checkpoint_info.calculate_shorthash()
+    if opts.checkpoint_hash_mode == 'sha256':
+        sd_model.sd_model_hash = checkpoint_info.calculate_shorthash()
+    else:
+        sd_model.sd_model_hash, sha256_future = checkpoint_info.calculate_shorthash_nonblocking(background_sha256=opts.checkpoint_hash_mode == 'fingerprint, sha256 in background')
+        if sha256_future is not None:
+            sha256_future.add_done_callback(lambda f: use_full_checkpoint_hash(sd_model, checkpoint_info))
     timer.record("calculate hash")
 
+    cond_cache.configure(
+        max_bytes=int(opts.flux_cond_cache_size_mb) * 1024 * 1024,
+        disk_cache=cache.cache('flux-conditioning') if opts.flux_cond_cache_disk else None,
+    )
+    lora_cache.configure(
+        max_bytes=int(opts.lora_merge_cache_size_mb) * 1024 * 1024,
+        pin_memory=opts.lora_merge_cache_pin_memory,
+        disk_dir=os.path.join(cache.cache_dir, 'lora-merges'),
+        max_disk_bytes=int(opts.lora_merge_cache_disk_mb) * 1024 * 1024,
+    )
+    dequant_cache.configure(fraction=float(opts.quant_dequant_cache_fraction))
+    placement.configure(cache.cache('placement-profiles') if opts.swap_placement_profiling else None)
+    compilation.configure(opts.flux_compile, opts.flux_compile_buckets, os.path.join(cache.cache_dir, 'torch-compile'))
+    attention.configure(opts.attention_autotune, cache.cache('attention-autotune') if opts.attention_autotune else None)
+    if sd_model.sd_model_hash:
+        modules_names = sorted(os.path.basename(x) for x in additional_state_dicts)
+        sd_model.cond_cache_namespace = f'{sd_model.sd_model_hash}:{",".join(modules_names)}'
+        weights_namespace = f'{sd_model.cond_cache_namespace}:{dynamic_args["forge_unet_storage_dtype"]}'
+        sd_model.forge_objects.unet.lora_loader.cache_namespace = f'{weights_namespace}:unet'
+        sd_model.forge_objects.clip.patcher.lora_loader.cache_namespace = f'{weights_namespace}:clip'
+
     shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
 
     model_data.set_sd_model(sd_model)
@@ -152,6 +152,8 @@ options_templates.update(options_section(('API', "API", "system"), {
     "api_enable_requests": OptionInfo(True, "Allow http:// and https:// URLs for input images in API", restrict_api=True),
     "api_forbid_local_requests": OptionInfo(True, "Forbid URLs to local resources", restrict_api=True),
     "api_useragent": OptionInfo("", "User agent for requests", restrict_api=True),
+    "api_batch_window_ms": OptionInfo(50, "txt2img request batching window (ms)", gr.Number, {"precision": 0}).info("concurrent txt2img requests that differ only in prompts and seeds and arrive within this window, or while the GPU is busy, run as one batch; 0=disable"),
+    "api_batch_max_images": OptionInfo(4, "Maximum images in a batched txt2img run", gr.Number, {"precision": 0}),
 }))
 
 options_templates.update(options_section(('training', "Training", "training"), {
@@ -173,6 +175,7 @@ options_templates.update(options_section(('sd', "Stable Diffusion", "sd"), {
     "sd_model_checkpoint": OptionInfo(None, "(Managed by Forge)", gr.State, infotext="Model"),
     "sd_checkpoints_limit": OptionInfo(1, "Maximum number of checkpoints loaded at the same time", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}),
     "sd_checkpoints_keep_in_cpu": OptionInfo(True, "Only keep one model on device").info("will keep models other than the currently used one in RAM rather than VRAM"),
+    "checkpoint_hash_mode": OptionInfo("fingerprint, sha256 in background", "Checkpoint hash on load", gr.Radio, {"choices": ["sha256", "fingerprint, sha256 in background", "fingerprint"]}).info("sha256 = read the whole file before the model is used; fingerprint = hash the header and a few sampled blocks, the sha256 is only computed when something asks for it"),
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}).info("obsolete; set to 0 and use the two settings above instead"),
     "sd_unet": OptionInfo("Automatic", "SD Unet", gr.Dropdown, lambda: {"choices": shared_items.sd_unet_items()}, refresh=shared_items.refresh_unet_list).info("choose Unet model: Automatic = use one with same filename as checkpoint; None = use Unet from checkpoint"),
     "enable_quantization": OptionInfo(False, "Enable quantization in K samplers for sharper and cleaner results. This may change existing seeds").needs_reload_ui(),
@@ -244,6 +247,16 @@ options_templates.update(options_section(('optimizations', "Optimizations", "sd"
     "pad_cond_uncond": OptionInfo(False, "Pad prompt/negative prompt", infotext='Pad conds').info("improves performance when prompt and negative prompt have different lengths; changes seeds"),
     "pad_cond_uncond_v0": OptionInfo(False, "Pad prompt/negative prompt (v0)", infotext='Pad conds v0').info("alternative implementation for the above; used prior to 1.6.0 for DDIM sampler; overrides the above if set; WARNING: truncates negative prompt if it's too long; changes seeds"),
     "persistent_cond_cache": OptionInfo(True, "Persistent cond cache").info("do not recalculate conds from prompts if prompts have not changed since previous calculation"),
+    "flux_cond_cache_size_mb": OptionInfo(256, "Flux text encoder cache size (MB)", gr.Number, {"precision": 0}).info("keep CLIP-L/T5 outputs of recent prompts in RAM, so repeated prompts do not load the text encoders; 0=disable; applied on model load"),
+    "flux_cond_cache_disk": OptionInfo(False, "Write Flux text encoder cache to disk").info("entries survive restarts; applied on model load"),
+    "lora_merge_cache_size_mb": OptionInfo(0, "LoRA merge cache size (MB)", gr.Number, {"precision": 0}).info("keep merged weights of recent LoRA combinations in RAM, so switching back to them skips merging; 0=disable; applied on model load"),
+    "lora_merge_cache_pin_memory": OptionInfo(False, "Pin LoRA merge cache memory").info("faster copies back to GPU, but pinned RAM cannot be swapped"),
+    "lora_merge_cache_disk_mb": OptionInfo(0, "LoRA merge cache disk size (MB)", gr.Number, {"precision": 0}).info("also store merged weights as safetensors in the cache directory; 0=disable; applied on model load"),
+    "quant_dequant_cache_fraction": OptionInfo(0.0, "Dequantized weight cache for GGUF/NF4", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.05}).info("share of the VRAM left free after loading the model used to keep dequantized weights during a sampling run; saves dequantizing every layer on every step; 0=disable; applied on model load"),
+    "swap_placement_profiling": OptionInfo(True, "Profile-guided placement for CPU swap").info("time every layer on the first step of a new model/resolution, then choose which layers stay in VRAM from a simulation of the copy schedule instead of keeping the smallest ones; used from the next model load; applied on model load"),
+    "attention_autotune": OptionInfo(False, "Autotune attention").info("on the first use of each attention shape, time PyTorch, xformers, split and sub-quadratic attention (with several chunk sizes) and keep using the fastest; results are kept in the cache directory; applied on model load"),
+    "flux_compile": OptionInfo(False, "Compile the Flux transformer with torch.compile").info("one graph per resolution bucket and batch size; the first run of each takes minutes to compile, compiled kernels are kept in the cache directory for later restarts; runs eagerly with online LoRA, ControlNet or CPU swap; applied on model load"),
+    "flux_compile_buckets": OptionInfo("768x1280, 1280x768, 1024x1024", "Flux compile resolution buckets").info("comma separated WxH; requested sizes within 12.5% of a bucket are snapped to it, other sizes are not compiled"),
     "batch_cond_uncond": OptionInfo(True, "Batch cond/uncond").info("do both conditional and unconditional denoising in one batch; uses a bit more VRAM during sampling, but improves speed; previously this was controlled by --always-batch-cond-uncond commandline argument"),
     "fp8_storage": OptionInfo("Disable", "FP8 weight", gr.Radio, {"choices": ["Disable", "Enable for SDXL", "Enable"]}).info("Use FP8 to store Linear/Conv layers' weight. Require pytorch>=2.1.0."),
     "cache_fp16_weight": OptionInfo(False, "Cache FP16 weight for LoRA").info("Cache fp16 weight when enabling FP8, will increase the quality of LoRA. Use more system ram."),
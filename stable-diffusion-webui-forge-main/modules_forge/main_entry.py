@@ -189,11 +189,13 @@ def refresh_memory_management_settings(async_loading=None, inference_memory=None
     shared.opts.set('forge_pin_shared_memory', pin_shared_memory)
 
     stream.stream_activated = async_loading == 'Async'
+    stream.prefetch_layers = int(shared.opts.forge_prefetch_layers)
     memory_management.current_inference_memory = inference_memory * 1024 * 1024  # Convert MB to bytes
     memory_management.PIN_SHARED_MEMORY = pin_shared_memory == 'Shared'
 
     log_dict = dict(
         stream=stream.should_use_stream(),
+        prefetch_layers=stream.prefetch_layers,
         inference_memory=memory_management.minimum_inference_memory() / (1024 * 1024),
         pin_shared_memory=memory_management.PIN_SHARED_MEMORY
     )
@@ -4,74 +4,169 @@
 
 
 import time
+import heapq
 import traceback
 import threading
 
+from concurrent.futures import Future
 
-lock = threading.Lock()
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+condition = threading.Condition()
 last_id = 0
-waiting_list = []
-finished_list = []
+waiting_list = []  # heap of (priority, task_id, task)
+tasks_by_id = {}
 last_exception = None
+worker_thread = None
+
+
+class Metrics:
+    def __init__(self):
+        self.submitted = 0
+        self.finished = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+        self.total_run = 0.0
+
+    def js(self):
+        # read from request threads while the worker updates the queue and the counters
+        with condition:
+            started = max(self.finished + self.failed, 1)
+            return dict(
+                queue_depth=len(waiting_list),
+                running=any(t.future.running() for t in tasks_by_id.values()),
+                submitted=self.submitted,
+                finished=self.finished,
+                failed=self.failed,
+                cancelled=self.cancelled,
+                average_wait=self.total_wait / started,
+                max_wait=self.max_wait,
+                last_wait=self.last_wait,
+                average_run=self.total_run / started,
+            )
+
+
+metrics = Metrics()
 
 
 class Task:
-    def __init__(self, task_id, func, args, kwargs):
+    def __init__(self, task_id, func, args, kwargs, priority=PRIORITY_NORMAL):
         self.task_id = task_id
         self.func = func
         self.args = args
         self.kwargs = kwargs
-        self.result = None
-        self.exception = None
+        self.priority = priority
+        self.future = Future()
+        self.submitted_at = time.perf_counter()
 
     def work(self):
         global last_exception
+
+        if not self.future.set_running_or_notify_cancel():
+            return
+
+        started_at = time.perf_counter()
+        wait = started_at - self.submitted_at
+
+        with condition:
+            metrics.total_wait += wait
+            metrics.max_wait = max(metrics.max_wait, wait)
+            metrics.last_wait = wait
+
         try:
-            self.result = self.func(*self.args, **self.kwargs)
-            self.exception = None
-            last_exception = None
+            result = self.func(*self.args, **self.kwargs)
         except Exception as e:
             traceback.print_exc()
             print(e)
-            self.exception = e
             last_exception = e
+            with condition:
+                metrics.failed += 1
+                metrics.total_run += time.perf_counter() - started_at
+            self.future.set_exception(e)
+            return
+
+        last_exception = None
+        with condition:
+            metrics.finished += 1
+            metrics.total_run += time.perf_counter() - started_at
+        self.future.set_result(result)
 
 
 def loop():
-    global lock, last_id, waiting_list, finished_list
+    global worker_thread
+    worker_thread = threading.current_thread()
+
     while True:
-        time.sleep(0.01)
-        if len(waiting_list) > 0:
-            with lock:
-                task = waiting_list.pop(0)
+        with condition:
+            while len(waiting_list) == 0:
+                condition.wait()
+            _, _, task = heapq.heappop(waiting_list)
 
-            task.work()
+        task.work()
 
-            with lock:
-                finished_list.append(task)
+        with condition:
+            tasks_by_id.pop(task.task_id, None)
 
 
-def async_run(func, *args, **kwargs):
-    global lock, last_id, waiting_list, finished_list
-    with lock:
+def is_running():
+    return worker_thread is not None and worker_thread.is_alive()
+
+
+def start_worker():
+    """Runs loop() on a daemon thread, for hosts that do not give it their main thread (e.g. the Cog predictor)."""
+    if not is_running():
+        threading.Thread(target=loop, name='forge-main-thread', daemon=True).start()
+        while worker_thread is None:
+            time.sleep(0.001)
+
+
+def submit(func, *args, priority=PRIORITY_NORMAL, **kwargs):
+    global last_id
+    with condition:
         last_id += 1
-        new_task = Task(task_id=last_id, func=func, args=args, kwargs=kwargs)
-        waiting_list.append(new_task)
-    return new_task.task_id
+        task = Task(task_id=last_id, func=func, args=args, kwargs=kwargs, priority=priority)
+        heapq.heappush(waiting_list, (priority, task.task_id, task))
+        tasks_by_id[task.task_id] = task
+        metrics.submitted += 1
+        condition.notify()
+    return task
 
 
-def run_and_wait_result(func, *args, **kwargs):
-    global lock, last_id, waiting_list, finished_list
-    current_id = async_run(func, *args, **kwargs)
-    while True:
-        time.sleep(0.01)
-        finished_task = None
-        for t in finished_list.copy():  # thread safe shallow copy without needing a lock
-            if t.task_id == current_id:
-                finished_task = t
-                break
-        if finished_task is not None:
-            with lock:
-                finished_list.remove(finished_task)
-            return finished_task.result
+def async_run(func, *args, **kwargs):
+    return submit(func, *args, **kwargs).task_id
 
+
+def cancel(task_id):
+    """Cancels a task that has not started yet; returns False if it is running, finished or unknown."""
+    with condition:
+        task = tasks_by_id.get(task_id)
+        if task is None or not task.future.cancel():
+            return False
+
+        waiting_list[:] = [x for x in waiting_list if x[2] is not task]
+        heapq.heapify(waiting_list)
+        tasks_by_id.pop(task_id, None)
+        metrics.cancelled += 1
+        return True
+
+
+def run_and_wait_result(func, *args, **kwargs):
+    # errors are reported through last_exception, as callers expect
+    task = submit(func, *args, **kwargs)
+    try:
+        return task.future.result()
+    except Exception:
+        return None
+
+
+def run_in_main_thread(func, *args, priority=PRIORITY_NORMAL, **kwargs):
+    """Like run_and_wait_result, but raises the task's exception; runs inline when no loop() serves the queue."""
+    if not is_running() or threading.current_thread() is worker_thread:
+        return func(*args, **kwargs)
+    return submit(func, *args, priority=priority, **kwargs).future.result()
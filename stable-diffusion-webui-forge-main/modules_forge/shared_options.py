@@ -4,6 +4,7 @@ def register(options_templates, options_section, OptionInfo):
         "forge_inference_memory": OptionInfo(1024),
         "forge_async_loading": OptionInfo('Async'),
         "forge_pin_shared_memory": OptionInfo('CPU'),
+        "forge_prefetch_layers": OptionInfo(2),
         "forge_preset": OptionInfo('flux'),
         "forge_additional_modules": OptionInfo([]),
     }))
@@ -43,6 +43,12 @@ def _apply_over_grouped_rows(func: Callable[[np.ndarray], np.ndarray], arr: np.n
     return out.reshape(oshape)
 
 
+# nearest float16 at or below x >= 0
+def torch_float16_floor(x: torch.Tensor) -> torch.Tensor:
+    y = x.to(torch.float16)
+    return torch.where(y.float() > x, (y.view(torch.int16) - 1).view(torch.float16), y)
+
+
 # round away from zero
 # ref: https://stackoverflow.com/a/59143326/22827863
 def np_roundf(n: np.ndarray) -> np.ndarray:
@@ -764,6 +770,41 @@ class Q4_K(__Quant, qtype=GGMLQuantizationType.Q4_K):
         min = torch.cat([m & 0x3F, (m_d >> 4) | ((m >> 2) & 0x30)], dim=-1)
         return (sc.reshape((n_blocks, 8)), min.reshape((n_blocks, 8)))
 
+    @staticmethod
+    def quantize_scale_min_pytorch(blocks, n_levels):
+        # Copyright Forge 2024
+        # x ~= d * sc * q - dmin * m for each of the 8 sub-blocks of 32, with 6-bit sc/m and q in [0, n_levels].
+        # Offsets and scales are rounded down, so the minimum of a sub-block still maps to q = 0 and its maximum to
+        # q = n_levels: a dequantized tensor has the same statistics and quantizes back to the same bytes.
+
+        n_blocks = blocks.shape[0]
+        x = blocks.float().reshape((n_blocks, 8, 32))
+
+        mins = -x.min(dim=-1).values.clamp(max=0)
+        dmin = torch_float16_floor(mins.max(dim=-1, keepdim=True).values / 63)
+        m = torch.where(dmin == 0, torch.zeros_like(mins), torch.floor(mins / dmin.float())).clamp(0, 63)
+        offset = dmin.float() * m
+
+        # scales are taken against the stored offsets; the tolerances absorb the float error of max + offset on
+        # dequantized data, where the offsets themselves come back exactly
+        scales = (x.max(dim=-1).values + offset) / n_levels
+        d = torch_float16_floor(scales.max(dim=-1, keepdim=True).values / 63 * (1 + 2 ** -14))
+        sc = torch.where(d == 0, torch.zeros_like(scales), torch.floor(scales / d.float() + 1 / 256)).clamp(0, 63)
+
+        scale = (d.float() * sc).unsqueeze(-1)
+        iscale = torch.where(scale == 0, torch.zeros_like(scale), 1 / scale)
+        q = torch.round((x + offset.unsqueeze(-1)) * iscale).clamp(0, n_levels).to(torch.uint8)
+
+        return d, dmin, sc.to(torch.uint8), m.to(torch.uint8), q
+
+    @staticmethod
+    def pack_scale_min_pytorch(sc, m):
+        # inverse of get_scale_min_pytorch
+        d = (sc[:, :4] & 0x3F) | ((sc[:, 4:] & 0x30) << 2)
+        mins = (m[:, :4] & 0x3F) | ((m[:, 4:] & 0x30) << 2)
+        m_d = (sc[:, 4:] & 0x0F) | ((m[:, 4:] & 0x0F) << 4)
+        return torch.cat([d, mins, m_d], dim=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
@@ -821,6 +862,26 @@ class Q4_K(__Quant, qtype=GGMLQuantizationType.Q4_K):
 
         return (d * qs - dm).reshape((n_blocks, QK_K))
 
+    @classmethod
+    def quantize_blocks_pytorch(cls, blocks, block_size, type_size, parent) -> torch.Tensor:
+        # Copyright Forge 2024
+        # Produces the baked layout (see bake_inner): per sub-block scales and offsets in computation dtype, then
+        # pairs of consecutive 4-bit values.
+
+        n_blocks = blocks.shape[0]
+        d, dmin, sc, m, q = Q4_K.quantize_scale_min_pytorch(blocks, 15)
+
+        d = d.to(parent.computation_dtype) * sc.to(parent.computation_dtype)
+        dm = dmin.to(parent.computation_dtype) * m.to(parent.computation_dtype)
+
+        q = q.reshape((n_blocks, QK_K))
+        qs = q[:, ::2] | (q[:, 1::2] << 4)
+
+        d = d.view(torch.uint8).reshape((n_blocks, -1))
+        dm = dm.view(torch.uint8).reshape((n_blocks, -1))
+
+        return torch.cat([d, dm, qs], dim=-1)
+
 
 class Q5_K(__Quant, qtype=GGMLQuantizationType.Q5_K):
     @classmethod
@@ -867,6 +928,25 @@ class Q5_K(__Quant, qtype=GGMLQuantizationType.Q5_K):
         q = (ql | (qh << 4))
         return (d * q - dm).reshape((n_blocks, QK_K))
 
+    @classmethod
+    def quantize_blocks_pytorch(cls, blocks, block_size, type_size, parent) -> torch.Tensor:
+        # Copyright Forge 2024
+
+        n_blocks = blocks.shape[0]
+        d, dmin, sc, m, q = Q4_K.quantize_scale_min_pytorch(blocks, 31)
+
+        scales = Q4_K.pack_scale_min_pytorch(sc, m)
+
+        # bit j of qh[l] is the 5th bit of value l in sub-block j
+        shifts = torch.arange(8, device=q.device, dtype=torch.uint8).reshape((1, 8, 1))
+        qh = ((q >> 4) << shifts).sum(dim=1).to(torch.uint8)
+
+        # sub-blocks 2i and 2i + 1 share the low and high nibbles of qs[32 * i:32 * (i + 1)]
+        ql = (q & 0x0F).reshape((n_blocks, 4, 2, 32))
+        qs = (ql[:, :, 0] | (ql[:, :, 1] << 4)).reshape((n_blocks, -1))
+
+        return torch.cat([d.view(torch.uint8), dmin.view(torch.uint8), scales, qh, qs], dim=-1)
+
 
 class Q6_K(__Quant, qtype=GGMLQuantizationType.Q6_K):
     @classmethod
@@ -906,6 +986,38 @@ class Q6_K(__Quant, qtype=GGMLQuantizationType.Q6_K):
         q = q.reshape((n_blocks, QK_K // 16, -1))
         return (d * q).reshape((n_blocks, QK_K))
 
+    @classmethod
+    def quantize_blocks_pytorch(cls, blocks, block_size, type_size, parent) -> torch.Tensor:
+        # Copyright Forge 2024
+        # x ~= d * sc * q for each of the 16 sub-blocks of 16, with 8-bit sc and q in [-32, 31]. d and sc are rounded
+        # towards zero, so the largest value of a sub-block still maps to q = -32 and a dequantized tensor quantizes
+        # back to the same bytes.
+
+        n_blocks = blocks.shape[0]
+        x = blocks.float().reshape((n_blocks, QK_K // 16, 16))
+
+        imax = torch.abs(x).argmax(dim=-1, keepdim=True)
+        scales = torch.gather(x, -1, imax).squeeze(-1) / -32
+
+        imax = torch.abs(scales).argmax(dim=-1, keepdim=True)
+        scales_max = torch.gather(scales, -1, imax)
+        d = torch_float16_floor(torch.abs(scales_max) / 128)
+        d = torch.where(scales_max > 0, -d, d)
+
+        sc = torch.where(d == 0, torch.zeros_like(scales), torch.trunc(scales / d.float())).clamp(-128, 127)
+
+        scale = (d.float() * sc).unsqueeze(-1)
+        iscale = torch.where(scale == 0, torch.zeros_like(scale), 1 / scale)
+        q = (torch.round(x * iscale).clamp(-32, 31) + 32).to(torch.uint8).reshape((n_blocks, QK_K))
+
+        ql = (q & 0x0F).reshape((n_blocks, 2, 2, 64))
+        ql = (ql[:, :, 0] | (ql[:, :, 1] << 4)).reshape((n_blocks, -1))
+
+        qh = (q >> 4).reshape((n_blocks, 2, 4, 32))
+        qh = (qh[:, :, 0] | (qh[:, :, 1] << 2) | (qh[:, :, 2] << 4) | (qh[:, :, 3] << 6)).reshape((n_blocks, -1))
+
+        return torch.cat([ql, qh, sc.to(torch.int8).view(torch.uint8), d.view(torch.uint8)], dim=-1)
+
 
 class IQ2_XXS(__Quant, qtype=GGMLQuantizationType.IQ2_XXS):
     ksigns: bytes = (
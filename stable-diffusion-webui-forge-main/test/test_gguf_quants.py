@@ -0,0 +1,97 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'packages_3rdparty'))
+quants = pytest.importorskip("gguf.quants")
+
+from types import SimpleNamespace
+
+
+QK_K = 256
+
+# largest error of a value relative to the range of its block of 256
+MAX_ERROR = {'Q4_K': 0.04, 'Q5_K': 0.02, 'Q6_K': 0.02}
+
+
+def make_blocks(kind, n_blocks=128):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(n_blocks, QK_K, generator=generator)
+    if kind == 'shifted':
+        x = x * 0.02 + 0.01
+    elif kind == 'positive':
+        x = x.abs()
+    elif kind == 'heavy-tailed':
+        x = x ** 3
+    return x
+
+
+def q4_k_raw(blocks):
+    # quantize_blocks_pytorch of Q4_K returns the baked layout; this is the gguf layout of the same values
+    n_blocks = blocks.shape[0]
+    d, dmin, sc, m, q = quants.Q4_K.quantize_scale_min_pytorch(blocks, 15)
+    ql = q.reshape((n_blocks, 4, 2, 32))
+    qs = (ql[:, :, 0] | (ql[:, :, 1] << 4)).reshape((n_blocks, -1))
+    return torch.cat([d.view(torch.uint8), dmin.view(torch.uint8), quants.Q4_K.pack_scale_min_pytorch(sc, m), qs], dim=-1)
+
+
+def quantize(cls, blocks):
+    if cls is quants.Q4_K:
+        return q4_k_raw(blocks)
+    return cls.quantize_blocks_pytorch(blocks, cls.block_size, cls.type_size, None)
+
+
+KINDS = ['normal', 'shifted', 'positive', 'heavy-tailed']
+TYPES = ['Q4_K', 'Q5_K', 'Q6_K']
+
+
+@pytest.mark.parametrize('kind', KINDS)
+@pytest.mark.parametrize('name', TYPES)
+def test_round_trip_error(name, kind):
+    cls = getattr(quants, name)
+    x = make_blocks(kind)
+
+    data = quantize(cls, x)
+    assert data.dtype == torch.uint8
+    assert data.shape == (x.shape[0], cls.type_size)
+
+    y = cls.dequantize_blocks(data.numpy())
+    error = np.abs(y - x.numpy()).max(axis=-1)
+    value_range = (x.max(dim=-1).values - x.min(dim=-1).values).numpy()
+    assert (error <= MAX_ERROR[name] * value_range).all()
+
+
+@pytest.mark.parametrize('kind', KINDS)
+@pytest.mark.parametrize('name', TYPES)
+def test_requantize_gives_same_bytes(name, kind):
+    cls = getattr(quants, name)
+    data = quantize(cls, make_blocks(kind))
+    y = torch.from_numpy(cls.dequantize_blocks(data.numpy()))
+    assert torch.equal(quantize(cls, y), data)
+
+
+@pytest.mark.parametrize('name', TYPES)
+def test_zero_blocks(name):
+    cls = getattr(quants, name)
+    data = quantize(cls, torch.zeros(2, QK_K))
+    assert (cls.dequantize_blocks(data.numpy()) == 0).all()
+
+
+@pytest.mark.parametrize('computation_dtype', [torch.float16, torch.bfloat16])
+def test_q4_k_matches_baked_layout(computation_dtype):
+    x = make_blocks('normal')
+    parent = SimpleNamespace(computation_dtype=computation_dtype)
+    baked = quants.Q4_K.quantize_blocks_pytorch(x, quants.Q4_K.block_size, quants.Q4_K.type_size, parent)
+
+    parameter = SimpleNamespace(data=q4_k_raw(x), computation_dtype=computation_dtype)
+    quants.Q4_K.bake_inner(parameter)
+    assert torch.equal(baked, parameter.data)
+
+    y = quants.Q4_K.dequantize_blocks(q4_k_raw(x).numpy())
+    z = quants.Q4_K.dequantize_blocks_pytorch(baked, quants.Q4_K.block_size, quants.Q4_K.type_size, parent)
+    tolerance = 2 ** -8 if computation_dtype == torch.float16 else 2 ** -5
+    assert np.abs(z.float().numpy() - y).max() <= tolerance * np.abs(y).max()
@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from backend import placement
+
+
+MB = 1024 * 1024
+
+
+def make_profile(sizes, forward_time=0.01, bandwidth=1000 * MB):
+    # one call per module, in order; with these defaults copying 10 MB takes as long as one forward
+    return dict(
+        modules={name: dict(weight_mem=size, forward_time=forward_time) for name, size in sizes.items()},
+        sequence=list(sizes),
+        bandwidth=bandwidth,
+    )
+
+
+def test_simulate_no_stall_when_all_resident():
+    profile = make_profile({'a': 10 * MB, 'b': 20 * MB, 'c': 30 * MB})
+    stall, waits = placement.simulate(profile, resident={'a', 'b', 'c'})
+    assert stall == 0
+    assert waits == [0.0, 0.0, 0.0]
+
+
+def test_simulate_without_prefetch_waits_for_every_copy():
+    profile = make_profile({'a': 10 * MB, 'b': 20 * MB})
+    stall, waits = placement.simulate(profile, resident=set(), prefetch_layers=0)
+    assert waits == pytest.approx([0.01, 0.02])
+    assert stall == pytest.approx(0.03)
+
+
+def test_simulate_prefetch_hides_copies_behind_compute():
+    profile = make_profile(dict.fromkeys('abcdef', 5 * MB))
+    stall_without, _ = placement.simulate(profile, resident=set(), prefetch_layers=0)
+    stall_with, waits = placement.simulate(profile, resident=set(), prefetch_layers=2)
+    assert stall_with < stall_without
+    # only the first copy is not behind any compute
+    assert waits[0] == pytest.approx(0.005)
+    assert waits[1:] == pytest.approx([0.0] * 5)
+
+
+def test_simulate_bandwidth_override():
+    profile = make_profile({'a': 10 * MB})
+    slow, _ = placement.simulate(profile, resident=set(), prefetch_layers=0, bandwidth=100 * MB)
+    assert slow == pytest.approx(0.1)
+
+
+def test_plan_greedy_takes_smallest_within_budget():
+    profile = make_profile({'a': 30 * MB, 'b': 10 * MB, 'c': 20 * MB})
+    assert placement.plan_greedy(profile, 35 * MB) == {'b', 'c'}
+    assert placement.plan_greedy(profile, 5 * MB) == set()
+
+
+def test_plan_placement_respects_budget():
+    sizes = {f'm{i}': (i % 4 + 1) * 10 * MB for i in range(12)}
+    profile = make_profile(sizes)
+    for budget in [0, 25 * MB, 60 * MB, 200 * MB]:
+        plan = placement.plan_placement(profile, budget)
+        assert sum(sizes[x] for x in plan) <= budget
+
+
+def test_plan_placement_everything_fits():
+    sizes = {'a': 10 * MB, 'b': 20 * MB}
+    plan = placement.plan_placement(make_profile(sizes), 100 * MB)
+    assert plan == {'a', 'b'}
+
+
+def test_plan_placement_never_worse_than_greedy():
+    # large early layers stall the step; keeping them beats keeping the many small late ones
+    sizes = {'big0': 80 * MB, 'big1': 80 * MB}
+    sizes.update({f'small{i}': 4 * MB for i in range(20)})
+    profile = make_profile(sizes, forward_time=0.002)
+
+    for budget in [40 * MB, 80 * MB, 120 * MB, 170 * MB]:
+        planned = placement.plan_placement(profile, budget)
+        greedy = placement.plan_greedy(profile, budget)
+        planned_stall, _ = placement.simulate(profile, planned)
+        greedy_stall, _ = placement.simulate(profile, greedy)
+        assert planned_stall <= greedy_stall + 1e-12
@@ -0,0 +1,164 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from weights import WeightsDownloadCache
+
+
+SIZES = {"https://example.com/a": 100, "https://example.com/b": 100, "https://example.com/c": 100, "https://example.com/big": 400}
+SIZES.update(dict.fromkeys([f"https://example.com/lora{i}" for i in range(8)], 100))
+
+
+def make_cache(base_dir, max_bytes=None, max_workers=1, delay=0):
+    cache = WeightsDownloadCache(min_disk_free=0, base_dir=str(base_dir), max_workers=max_workers, max_bytes=max_bytes)
+    cache.downloads = []
+
+    def download_weights(url, dest, file=False):
+        cache.downloads.append(url)
+        time.sleep(delay)
+        with open(f"{dest}.safetensors" if file else dest, "wb") as f:
+            f.write(b"\0" * SIZES[url])
+
+    cache.download_weights = download_weights
+    return cache
+
+
+def cached_urls(cache):
+    names = {cache.weights_path(url) + ".safetensors": url for url in SIZES}
+    return [names[path] for path in cache.lru_entries]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=250)
+    a = cache.ensure("https://example.com/a", file=True)
+    b = cache.ensure("https://example.com/b", file=True)
+    cache.ensure("https://example.com/a", file=True)  # a is now more recent than b
+    c = cache.ensure("https://example.com/c", file=True)
+
+    assert cached_urls(cache) == ["https://example.com/a", "https://example.com/c"]
+    assert os.path.exists(a) and os.path.exists(c)
+    assert not os.path.exists(b)
+    assert cache.total_bytes() == 200
+    assert cache.downloads == ["https://example.com/a", "https://example.com/b", "https://example.com/c"]
+
+
+def test_keeps_the_weights_just_requested(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=250)
+    cache.ensure("https://example.com/a", file=True)
+    big = cache.ensure("https://example.com/big", file=True)
+
+    assert cached_urls(cache) == ["https://example.com/big"]
+    assert os.path.exists(big)
+
+
+def test_no_budget_keeps_everything(tmp_path):
+    cache = make_cache(tmp_path)
+    for url in SIZES:
+        cache.ensure(url, file=True)
+    assert cache.total_bytes() == sum(SIZES.values())
+
+
+def test_index_is_reloaded(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.ensure("https://example.com/a", file=True)
+    time.sleep(0.01)
+    cache.ensure("https://example.com/b", file=True)
+    time.sleep(0.01)
+    cache.ensure("https://example.com/a", file=True)
+
+    reloaded = make_cache(tmp_path)
+    assert cached_urls(reloaded) == ["https://example.com/b", "https://example.com/a"]
+    assert reloaded.lru_entries == cache.lru_entries
+    assert reloaded.lru_entries[cache.weights_path("https://example.com/a") + ".safetensors"]["hits"] == 1
+
+    reloaded.ensure("https://example.com/b", file=True)
+    assert reloaded.downloads == []
+    assert reloaded._hits == 1
+
+
+def test_index_is_reconciled_with_the_files(tmp_path):
+    cache = make_cache(tmp_path)
+    a = cache.ensure("https://example.com/a", file=True)
+    b = cache.ensure("https://example.com/b", file=True)
+
+    os.remove(a)
+    unindexed = cache.weights_path("https://example.com/c") + ".safetensors"
+    with open(unindexed, "wb") as f:
+        f.write(b"\0" * 30)
+    with open(os.path.join(str(tmp_path), "notes.txt"), "w") as f:
+        f.write("not a cached weights file")
+
+    reloaded = make_cache(tmp_path)
+    assert set(reloaded.lru_entries) == {b, unindexed}
+    assert reloaded.lru_entries[unindexed]["size"] == 30
+
+    with open(reloaded.index_path, "r", encoding="utf8") as f:
+        assert set(json.load(f)) == {b, unindexed}
+
+
+def test_budget_is_applied_to_a_reloaded_index(tmp_path):
+    cache = make_cache(tmp_path)
+    a = cache.ensure("https://example.com/a", file=True)
+    time.sleep(0.01)
+    b = cache.ensure("https://example.com/b", file=True)
+    time.sleep(0.01)
+    c = cache.ensure("https://example.com/c", file=True)
+
+    reloaded = make_cache(tmp_path, max_bytes=200)
+    assert list(reloaded.lru_entries) == [b, c]
+    assert not os.path.exists(a)
+
+
+def test_pinned_weights_are_not_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=150)
+    a = cache.ensure_async("https://example.com/a", file=True, pin=True).result()
+    cache.ensure("https://example.com/b", file=True)
+    cache.ensure("https://example.com/c", file=True)
+
+    assert os.path.exists(a)
+    assert cached_urls(cache) == ["https://example.com/a", "https://example.com/c"]
+
+    cache.release("https://example.com/a", file=True)
+    cache.ensure("https://example.com/b", file=True)
+    assert not os.path.exists(a)
+    assert cached_urls(cache) == ["https://example.com/b"]
+
+
+def test_concurrent_requests_keep_their_weights(tmp_path):
+    # several predictions pin and download LoRAs at once while each download evicts others to fit the budget;
+    # a path handed to a prediction must stay on disk until it releases it
+    cache = make_cache(tmp_path, max_bytes=300, max_workers=4, delay=0.002)
+    urls = [f"https://example.com/lora{i}" for i in range(8)]
+    errors = []
+
+    def predict(seed):
+        generator = random.Random(seed)
+        for _ in range(20):
+            chosen = generator.sample(urls, 2)
+            futures = [cache.ensure_async(url, file=True, pin=True) for url in chosen]
+            try:
+                paths = [future.result() for future in futures]
+                time.sleep(0.001)  # waiting for the model lock
+                for path in paths:
+                    if not os.path.exists(path):
+                        errors.append(path)
+            finally:
+                for url in chosen:
+                    cache.release(url, file=True)
+
+    threads = [threading.Thread(target=predict, args=(seed,)) for seed in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert cache._pinned == {}
+    assert set(cache.lru_entries) == {path for path in cache.lru_entries if os.path.exists(path)}
+    cache.ensure(urls[0], file=True)
+    assert cache.total_bytes() <= 300
@@ -1,16 +1,25 @@
-from collections import deque
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import hashlib
+import json
 import os
+import re
 import shutil
 import subprocess
+import threading
 import time
 
 
 class WeightsDownloadCache:
+    INDEX_FILENAME = ".weights_index.json"
+    CACHED_NAME_PATTERN = re.compile(r"^[0-9a-f]{16}(\.safetensors)?$")
+
     def __init__(
         self,
         min_disk_free: int = 10 * (2**30),
         base_dir: str = "/src/models/Lora",
+        max_workers: int = 4,
+        max_bytes: int = None,
     ):
         """
         WeightsDownloadCache is meant to track and download weights files as fast
@@ -21,25 +30,93 @@ class WeightsDownloadCache:
 
         It will not re-download weights files that are already in the cache.
 
+        Downloads run on a thread pool: ensure_async() starts one and returns a future, and
+        concurrent requests for the same URL share a single in-flight download. Weights requested
+        with pin=True are never evicted until release() is called for them, so a path handed out
+        to a caller stays on disk until the caller has loaded it.
+
+        The LRU index (size, last access time and hit count of every cached path) is persisted
+        in base_dir and rebuilt from the files found there at startup, so a restarted
+        container keeps its cache hits.
+
         :param min_disk_free: Minimum disk space required to start download, in bytes.
         :param base_dir: The base directory to store weights files.
+        :param max_workers: Maximum number of concurrent downloads.
+        :param max_bytes: Maximum total size of cached weights, in bytes; None for no limit. A cache left
+            larger by a previous run is trimmed at startup.
         """
         self.min_disk_free = min_disk_free
         self.base_dir = base_dir
+        self.max_bytes = max_bytes
         self._hits = 0
         self._misses = 0
+        self._lock = threading.Lock()
+        self._inflight: dict[str, Future] = {}
+        self._pinned: Counter[str] = Counter()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="weights-download")
 
-        # Least Recently Used (LRU) cache for paths
-        self.lru_paths = deque()
+        # Least Recently Used (LRU) index: path -> {"size", "last_access", "hits"}, oldest first
+        self.lru_entries: OrderedDict[str, dict] = OrderedDict()
         if not os.path.exists(base_dir):
             os.makedirs(base_dir)
 
-    def _remove_least_recent(self) -> None:
+        self._rebuild_index()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.base_dir, self.INDEX_FILENAME)
+
+    def _rebuild_index(self) -> None:
         """
-        Remove the least recently used weights file from the cache and disk.
+        Load the persisted index and reconcile it with the files in base_dir: entries whose files
+        are gone are dropped, cached files missing from the index are added by mtime.
         """
-        oldest = self.lru_paths.popleft()
-        self._rm_disk(oldest)
+        try:
+            with open(self.index_path, "r", encoding="utf8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = {}
+        except Exception as e:
+            print(f"Ignoring unreadable weights index: {e}")
+            saved = {}
+
+        entries = {}
+        for name in os.listdir(self.base_dir):
+            if not self.CACHED_NAME_PATTERN.match(name):
+                continue
+            path = os.path.join(self.base_dir, name)
+            entry = saved.get(path) or {"last_access": os.path.getmtime(path), "hits": 0}
+            entry["size"] = self._disk_size(path)
+            entries[path] = entry
+
+        for path, entry in sorted(entries.items(), key=lambda x: x[1]["last_access"]):
+            self.lru_entries[path] = entry
+
+        self._save_index()
+        self._enforce_max_bytes(keep=None)
+        print(f"Weights cache index: {self.cache_info()}")
+
+    def _save_index(self) -> None:
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            json.dump(self.lru_entries, f)
+        os.replace(temp_path, self.index_path)
+
+    def _remove_least_recent(self, keep: str = None) -> bool:
+        """
+        Remove the least recently used weights file from the cache and disk, skipping `keep` and pinned paths.
+
+        :return: False if there was nothing that could be removed.
+        """
+        with self._lock:
+            oldest = next((path for path in self.lru_entries if path != keep and not self._pinned[path]), None)
+            if oldest is None:
+                return False
+            del self.lru_entries[oldest]
+            self._save_index()
+            # still under the lock, so a concurrent ensure_async cannot pin the path before it is gone
+            self._rm_disk(oldest)
+        return True
 
     def cache_info(self) -> str:
         """
@@ -48,7 +125,20 @@ class WeightsDownloadCache:
         :return: Cache information.
         """
 
-        return f"CacheInfo(hits={self._hits}, misses={self._misses}, base_dir='{self.base_dir}', currsize={len(self.lru_paths)})"
+        return f"CacheInfo(hits={self._hits}, misses={self._misses}, base_dir='{self.base_dir}', currsize={len(self.lru_entries)}, bytes={self.total_bytes()})"
+
+    def total_bytes(self) -> int:
+        return sum(entry["size"] for entry in list(self.lru_entries.values()))
+
+    @staticmethod
+    def _disk_size(path: str) -> int:
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                total += os.path.getsize(os.path.join(root, name))
+        return total
 
     def _rm_disk(self, path: str) -> None:
         """
@@ -62,30 +152,101 @@ class WeightsDownloadCache:
 
     def _has_enough_space(self) -> bool:
         disk_usage = shutil.disk_usage(self.base_dir)
-        return disk_usage.free >= self.min_disk_free
+        if disk_usage.free < self.min_disk_free:
+            return False
+        return self.max_bytes is None or self.total_bytes() < self.max_bytes
 
     def ensure(self, url: str, file: bool = False, mv_from: str = None) -> str:
+        """
+        Download the weights if needed and block until they are available.
+
+        :return: Path to the weights.
+        """
+        return self.ensure_async(url, file=file, mv_from=mv_from).result()
+
+    def ensure_async(self, url: str, file: bool = False, mv_from: str = None, pin: bool = False) -> Future:
+        """
+        Start making the weights available in the background.
+
+        :param pin: Keep the weights from being evicted until release() is called with the same arguments,
+            also when the download fails.
+        :return: Future resolving to the path to the weights; shared by all callers asking for the same URL meanwhile.
+        """
+        with self._lock:
+            if pin:
+                self._pinned[self.final_path(url, file=file, mv_from=mv_from)] += 1
+
+            future = self._inflight.get(url)
+            if future is not None:
+                return future
+
+            future = self._executor.submit(self._ensure, url, file, mv_from)
+            self._inflight[url] = future
+
+        future.add_done_callback(lambda f: self._forget_inflight(url, f))
+        return future
+
+    def _forget_inflight(self, url: str, future: Future) -> None:
+        with self._lock:
+            if self._inflight.get(url) is future:
+                del self._inflight[url]
+
+    def release(self, url: str, file: bool = False, mv_from: str = None) -> None:
+        """
+        Undo one ensure_async(..., pin=True) with the same arguments.
+        """
+        path = self.final_path(url, file=file, mv_from=mv_from)
+        with self._lock:
+            self._pinned[path] -= 1
+            if self._pinned[path] <= 0:
+                del self._pinned[path]
+
+    def final_path(self, url: str, file: bool = False, mv_from: str = None) -> str:
+        path = self.weights_path(url)
+        # file downloads and extracted archives both end up as a single .safetensors file
+        return f"{path}.safetensors" if file or mv_from else path
+
+    def _ensure(self, url: str, file: bool = False, mv_from: str = None) -> str:
         path = self.weights_path(url)
+        final_path = self.final_path(url, file=file, mv_from=mv_from)
+
+        with self._lock:
+            entry = self.lru_entries.pop(final_path, None)
+            hit = entry is not None and os.path.exists(final_path)
+            if hit:
+                # here we pop to re-add to the end of the LRU (marking it as recently used)
+                self._hits += 1
+            else:
+                self._misses += 1
 
-        if path in self.lru_paths:
-            # here we remove to re-add to the end of the LRU (marking it as recently used)
-            self._hits += 1
-            self.lru_paths.remove(path)
-        else:
-            self._misses += 1
+        if not hit:
             if file:
                 self.download_weights(url, path, file=True)
             else:
                 self.download_weights(url, path, file=False)
                 if mv_from:
                     mv_from = os.path.join(path, mv_from)
-                    mv_to = f"{path}.safetensors"
-                    shutil.move(mv_from, mv_to)
+                    shutil.move(mv_from, final_path)
                     self._rm_disk(path)
-                    path = mv_to
+            entry = {"size": self._disk_size(final_path), "hits": 0}
 
-        self.lru_paths.append(path)
-        return path
+        entry["last_access"] = time.time()
+        entry["hits"] += int(hit)
+
+        with self._lock:
+            self.lru_entries[final_path] = entry
+            self._save_index()
+
+        self._enforce_max_bytes(keep=final_path)
+        return final_path
+
+    def _enforce_max_bytes(self, keep: str) -> None:
+        """
+        Evict least recently used weights until the cache fits max_bytes again, never evicting `keep` or pinned paths.
+        """
+        while self.max_bytes is not None and self.total_bytes() > self.max_bytes:
+            if not self._remove_least_recent(keep=keep):
+                break
 
     def weights_path(self, url: str) -> str:
         """
@@ -107,8 +268,9 @@ class WeightsDownloadCache:
         :param file: If True, download the file as is, otherwise extract it.
         """
         print("Ensuring enough disk space...")
-        while not self._has_enough_space() and len(self.lru_paths) > 0:
-            self._remove_least_recent()
+        while not self._has_enough_space():
+            if not self._remove_least_recent():
+                break
 
         print(f"Downloading weights: {url}")
 